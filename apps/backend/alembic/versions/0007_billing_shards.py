@@ -0,0 +1,18 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0007_billing_shards'
+down_revision = '0006_notifications_and_marketplace'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('billing_shard_state',
+        sa.Column('shard', sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column('last_minute', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('fence', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+    )
+
+def downgrade():
+    op.drop_table('billing_shard_state')
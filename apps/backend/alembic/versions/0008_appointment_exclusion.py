@@ -0,0 +1,25 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0008_appointment_exclusion'
+down_revision = '0007_billing_shards'
+branch_labels = None
+depends_on = None
+
+# Existing overlapping active appointments must be resolved before this can apply.
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    op.execute(
+        "ALTER TABLE appointments ADD COLUMN during tsrange "
+        "GENERATED ALWAYS AS (tsrange(start_time, end_time, '[)')) STORED"
+    )
+    op.execute(
+        "ALTER TABLE appointments ADD CONSTRAINT appointments_reader_no_overlap "
+        "EXCLUDE USING gist (reader_id WITH =, during WITH &&) "
+        "WHERE (status IN ('scheduled', 'in_progress'))"
+    )
+
+def downgrade():
+    op.execute("ALTER TABLE appointments DROP CONSTRAINT appointments_reader_no_overlap")
+    op.drop_column('appointments', 'during')
@@ -0,0 +1,33 @@
+from alembic import op
+
+revision = '0009_hot_path_indexes'
+down_revision = '0008_appointment_exclusion'
+branch_labels = None
+depends_on = None
+
+# (name, table, columns). Built CONCURRENTLY so live tables keep taking writes.
+# wallets.user_id already has its unique index.
+INDEXES = [
+    ('ix_sessions_status_per_minute', 'sessions', ['status', 'per_minute']),
+    ('ix_sessions_reader_status', 'sessions', ['reader_id', 'status']),
+    ('ix_sessions_mode_status', 'sessions', ['mode', 'status']),
+    ('ix_sessions_appointment_id', 'sessions', ['appointment_id']),
+    ('ix_appointments_reader_status_start', 'appointments', ['reader_id', 'status', 'start_time']),
+    ('ix_appointments_client_status_start', 'appointments', ['client_id', 'status', 'start_time']),
+    ('ix_appointments_status_start', 'appointments', ['status', 'start_time']),
+    ('ix_availability_blocks_reader_start', 'availability_blocks', ['reader_id', 'start_time']),
+    ('ix_notifications_user_created', 'notifications', ['user_id', 'created_at']),
+    ('ix_ledger_entries_user_created', 'ledger_entries', ['user_id', 'created_at']),
+    ('ix_reader_ledger_entries_reader_created', 'reader_ledger_entries', ['reader_id', 'created_at']),
+    ('ix_orders_buyer_id', 'orders', ['buyer_id', 'id']),
+]
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
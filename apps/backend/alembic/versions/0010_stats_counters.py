@@ -0,0 +1,59 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0010_stats_counters'
+down_revision = '0009_hot_path_indexes'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('daily_stats',
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('metric', sa.String(length=32), primary_key=True),
+        sa.Column('slot', sa.SmallInteger(), primary_key=True, autoincrement=False),
+        sa.Column('value', sa.BigInteger(), nullable=False, server_default='0'),
+    )
+    op.create_table('stat_totals',
+        sa.Column('metric', sa.String(length=32), primary_key=True),
+        sa.Column('slot', sa.SmallInteger(), primary_key=True, autoincrement=False),
+        sa.Column('value', sa.BigInteger(), nullable=False, server_default='0'),
+    )
+    # Seed from existing rows; from here on the write paths keep the counters current
+    op.execute("""
+        INSERT INTO stat_totals (metric, slot, value)
+        SELECT 'users', 0, count(*) FROM users
+        UNION ALL SELECT 'readers', 0, count(*) FROM users WHERE role = 'reader'
+        UNION ALL SELECT 'sessions', 0, count(*) FROM sessions
+        UNION ALL SELECT 'appointments', 0, count(*) FROM appointments
+        UNION ALL SELECT 'orders', 0, count(*) FROM orders
+        UNION ALL SELECT 'revenue_transactions', 0, count(*) FROM ledger_entries WHERE kind = 'credit' AND ref_type = 'payment_intent'
+        UNION ALL SELECT 'revenue_cents', 0, coalesce(sum(amount_cents), 0) FROM ledger_entries WHERE kind = 'credit' AND ref_type = 'payment_intent'
+    """)
+    # Per-day history for every counter the dashboard charts. Sessions, appointments and
+    # orders have no creation timestamp: sessions use when they started (or ended), and
+    # bookings and orders the wallet debit written when they were placed.
+    op.execute("""
+        INSERT INTO daily_stats (day, metric, slot, value)
+        SELECT created_at::date, 'users', 0, count(*) FROM users GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 'readers', 0, count(*) FROM users WHERE role = 'reader' GROUP BY 1
+        UNION ALL
+        SELECT coalesce(started_at, ended_at)::date, 'sessions', 0, count(*) FROM sessions
+        WHERE coalesce(started_at, ended_at) IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 'appointments', 0, count(*) FROM ledger_entries
+        WHERE kind = 'debit' AND ref_type = 'appointment' GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 'orders', 0, count(*) FROM ledger_entries
+        WHERE kind = 'debit' AND ref_type = 'order' GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 'revenue_transactions', 0, count(*) FROM ledger_entries
+        WHERE kind = 'credit' AND ref_type = 'payment_intent' GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 'revenue_cents', 0, sum(amount_cents) FROM ledger_entries
+        WHERE kind = 'credit' AND ref_type = 'payment_intent' GROUP BY 1
+    """)
+
+def downgrade():
+    op.drop_table('stat_totals')
+    op.drop_table('daily_stats')
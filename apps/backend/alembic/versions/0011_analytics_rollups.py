@@ -0,0 +1,36 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0011_analytics_rollups'
+down_revision = '0010_stats_counters'
+branch_labels = None
+depends_on = None
+
+def _fact_table(name, bucket_type):
+    op.create_table(name,
+        sa.Column('bucket', bucket_type, primary_key=True),
+        sa.Column('source', sa.String(length=8), primary_key=True),
+        sa.Column('reader_id', sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column('mode', sa.String(length=16), primary_key=True),
+        sa.Column('ref_type', sa.String(length=32), primary_key=True),
+        sa.Column('kind', sa.String(length=24), primary_key=True),
+        sa.Column('amount_cents', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('entries', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('seconds', sa.BigInteger(), nullable=False, server_default='0'),
+    )
+    op.create_index(f'ix_{name}_reader_bucket', name, ['reader_id', 'bucket'])
+
+def upgrade():
+    _fact_table('analytics_hourly', sa.DateTime())
+    _fact_table('analytics_daily', sa.Date())
+    op.create_table('analytics_watermarks',
+        sa.Column('source', sa.String(length=8), primary_key=True),
+        sa.Column('last_id', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('last_ts', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+    )
+
+def downgrade():
+    op.drop_table('analytics_watermarks')
+    op.drop_table('analytics_daily')
+    op.drop_table('analytics_hourly')
@@ -0,0 +1,40 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0012_payout_runs'
+down_revision = '0011_analytics_rollups'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('payout_runs',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('run_date', sa.Date(), nullable=False, unique=True),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='running'),
+        sa.Column('payouts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('paid', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('failed', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('paid_cents', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('started_at', sa.DateTime(), nullable=False),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+    )
+    op.create_table('payouts',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('run_id', sa.Integer(), sa.ForeignKey('payout_runs.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('reader_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('account_id', sa.String(length=64), nullable=False),
+        sa.Column('amount_cents', sa.Integer(), nullable=False),
+        sa.Column('idempotency_key', sa.String(length=64), nullable=False, unique=True),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('stripe_transfer_id', sa.String(length=64), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.UniqueConstraint('run_id', 'reader_id', name='uq_payouts_run_reader'),
+    )
+    op.create_index('ix_payouts_run_status', 'payouts', ['run_id', 'status'])
+
+def downgrade():
+    op.drop_table('payouts')
+    op.drop_table('payout_runs')
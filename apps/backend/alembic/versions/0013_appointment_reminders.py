@@ -0,0 +1,17 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0013_appointment_reminders'
+down_revision = '0012_payout_runs'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.create_table('appointment_reminders',
+        sa.Column('appointment_id', sa.Integer(), sa.ForeignKey('appointments.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('minutes_before', sa.SmallInteger(), primary_key=True, autoincrement=False),
+        sa.Column('sent_at', sa.DateTime(), nullable=False),
+    )
+
+def downgrade():
+    op.drop_table('appointment_reminders')
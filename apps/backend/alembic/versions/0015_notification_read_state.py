@@ -0,0 +1,18 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0015_notification_read_state'
+down_revision = '0014_push_outbox'
+branch_labels = None
+depends_on = None
+
+# Unread counts and bulk mark-read scan only unread rows; the retention purge walks created_at
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_notifications_user_unread', 'notifications', ['user_id', 'id'], postgresql_where=sa.text('NOT read'), postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_notifications_created', 'notifications', ['created_at'], postgresql_concurrently=True, if_not_exists=True)
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_notifications_created', table_name='notifications', postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_notifications_user_unread', table_name='notifications', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,17 @@
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0016_product_sync'
+down_revision = '0015_notification_read_state'
+branch_labels = None
+depends_on = None
+
+def upgrade():
+    op.add_column('products', sa.Column('stripe_price_id', sa.String(length=64), nullable=True))
+    op.add_column('products', sa.Column('stripe_updated_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_products_stripe_price_id', 'products', ['stripe_price_id'])
+
+def downgrade():
+    op.drop_index('ix_products_stripe_price_id', table_name='products')
+    op.drop_column('products', 'stripe_updated_at')
+    op.drop_column('products', 'stripe_price_id')
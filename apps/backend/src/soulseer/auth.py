@@ -3,34 +3,106 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import httpx
 from jose import jwt
 from typing import Dict, Any
+from collections import OrderedDict
+import asyncio
+import hashlib
+import time
 from .config import settings
 
 bearer = HTTPBearer(auto_error=False)
 
+JWKS_MAX_AGE = 3600  # refresh the key set at least hourly
+JWKS_MIN_REFRESH_INTERVAL = 30  # unknown kids can't force refetches more often than this
+TOKEN_CACHE_SIZE = 10_000
+
 _jwks_cache: Dict[str, Any] | None = None
+_jwks_fetched_at: float = 0.0  # last successful fetch
+_jwks_last_attempt: float = 0.0  # last fetch, successful or not; rate-limits refetches
+_jwks_lock = asyncio.Lock()
+_http: httpx.AsyncClient | None = None
+
+# sha256(token) -> (exp, claims), most recently used last
+_verified: "OrderedDict[str, tuple[float, Dict[str, Any]]]" = OrderedDict()
 
-async def get_jwks() -> Dict[str, Any]:
-    global _jwks_cache
-    if _jwks_cache is None:
+def get_http_client() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=10)
+    return _http
+
+async def _refresh_jwks(seen_attempt: float) -> Dict[str, Any]:
+    """Fetch the key set once for all concurrent callers that saw the same attempt."""
+    global _jwks_cache, _jwks_fetched_at, _jwks_last_attempt
+    async with _jwks_lock:
+        if _jwks_cache is not None and _jwks_last_attempt != seen_attempt:
+            return _jwks_cache  # someone else tried while we waited
+        if _jwks_cache is not None and time.monotonic() - _jwks_last_attempt < JWKS_MIN_REFRESH_INTERVAL:
+            return _jwks_cache
+        _jwks_last_attempt = time.monotonic()
         url = settings.clerk_jwks_url or "https://clerk.dev/.well-known/jwks.json"
-        async with httpx.AsyncClient(timeout=10) as client:
-            res = await client.get(url)
+        try:
+            res = await get_http_client().get(str(url))
             res.raise_for_status()
             _jwks_cache = res.json()
+            _jwks_fetched_at = _jwks_last_attempt
+        except Exception:
+            if _jwks_cache is None:
+                raise
+            # keep serving the last good key set; the next attempt waits out the minimum interval
+        return _jwks_cache
+
+async def get_jwks(force: bool = False) -> Dict[str, Any]:
+    if _jwks_cache is None or force or time.monotonic() - _jwks_fetched_at > JWKS_MAX_AGE:
+        return await _refresh_jwks(_jwks_last_attempt)
     return _jwks_cache
 
-async def get_current_user_token(creds: HTTPAuthorizationCredentials | None = Depends(bearer)) -> Dict[str, Any]:
-    if not creds or creds.scheme.lower() != 'bearer':
-        raise HTTPException(status_code=401, detail="Missing token")
-    token = creds.credentials
+async def get_signing_key(kid: str | None) -> Dict[str, Any] | None:
     jwks = await get_jwks()
+    key = next((k for k in jwks["keys"] if k["kid"] == kid), None)
+    if key is None:
+        # Unknown kid usually means Clerk rotated keys
+        jwks = await get_jwks(force=True)
+        key = next((k for k in jwks["keys"] if k["kid"] == kid), None)
+    return key
+
+def _cached_claims(digest: str) -> Dict[str, Any] | None:
+    hit = _verified.get(digest)
+    if hit is None:
+        return None
+    exp, payload = hit
+    if exp <= time.time():
+        _verified.pop(digest, None)
+        return None
+    _verified.move_to_end(digest)
+    return payload
+
+def _remember_claims(digest: str, payload: Dict[str, Any]):
+    exp = payload.get("exp")
+    if not isinstance(exp, (int, float)):
+        return
+    _verified[digest] = (float(exp), payload)
+    _verified.move_to_end(digest)
+    while len(_verified) > TOKEN_CACHE_SIZE:
+        _verified.popitem(last=False)
+
+async def verify_token(token: str) -> Dict[str, Any]:
+    """Verify a Clerk JWT and return its claims. Raises HTTPException(401) if invalid."""
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    cached = _cached_claims(digest)
+    if cached is not None:
+        return cached
     try:
         header = jwt.get_unverified_header(token)
-        kid = header.get("kid")
-        key = next((k for k in jwks["keys"] if k["kid"] == kid), None)
+        key = await get_signing_key(header.get("kid"))
         if not key:
             raise HTTPException(status_code=401, detail="Invalid token")
         payload = jwt.decode(token, key, algorithms=[key["alg"]], audience=None, options={"verify_aud": False})
-        return payload
     except Exception:
-        raise HTTPException(status_code=401, detail="Invalid token")
\ No newline at end of file
+        raise HTTPException(status_code=401, detail="Invalid token")
+    _remember_claims(digest, payload)
+    return payload
+
+async def get_current_user_token(creds: HTTPAuthorizationCredentials | None = Depends(bearer)) -> Dict[str, Any]:
+    if not creds or creds.scheme.lower() != 'bearer':
+        raise HTTPException(status_code=401, detail="Missing token")
+    return await verify_token(creds.credentials)
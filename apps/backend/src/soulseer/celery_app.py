@@ -3,7 +3,7 @@ from .config import settings
 from .db import SessionLocal
 from . import models
 from sqlalchemy.orm import Session
-from .services.billing import bill_one_minute
+from .services.billing import bill_active_sessions
 from redis import Redis
 
 celery = Celery(
@@ -16,145 +16,147 @@ celery = Celery(
 def setup_periodic_tasks(sender, **kwargs):
     # Daily payouts at 2am UTC
     sender.add_periodic_task(24*60*60, run_daily_payouts.s(), name='daily_payouts')
-    # Billing tick every minute
-    sender.add_periodic_task(60.0, billing_tick.s(), name='billing_tick')
+    if settings.billing_mode == 'metered':
+        # Write Redis-metered session totals back to Postgres
+        sender.add_periodic_task(settings.metering_settle_interval_seconds, settle_metering.s(), name='settle_metering')
+    else:
+        # Billing tick every minute
+        sender.add_periodic_task(60.0, billing_tick.s(), name='billing_tick')
     # Appointment reminders every 5 minutes
     sender.add_periodic_task(5*60.0, appointment_reminders.s(), name='appointment_reminders')
+    # Deliver queued push notifications
+    sender.add_periodic_task(settings.push_outbox_interval_seconds, drain_push_outbox.s(), name='drain_push_outbox')
+    # Drop notifications and finished pushes past their retention windows
+    sender.add_periodic_task(24*60*60, purge_notifications.s(), name='purge_notifications')
+    # Sweep stale reader presence and write statuses back to reader profiles
+    sender.add_periodic_task(settings.reader_presence_flush_interval_seconds, flush_reader_presence.s(), name='flush_reader_presence')
+    # Fold new ledger rows and ended sessions into the analytics buckets
+    sender.add_periodic_task(settings.analytics_rollup_interval_seconds, rollup_analytics.s(), name='rollup_analytics')
 
 @celery.task
 def run_daily_payouts():
-    # Implement Stripe Connect transfers to readers with balance > $15
+    # Stripe Connect transfers to readers with balance > $15; resumable, see services.payouts
     import stripe
-    from datetime import datetime
+    from .services.payouts import run_payouts
     stripe.api_key = settings.stripe_secret_key
     db: Session = SessionLocal()
     try:
-        # join balances and stripe accounts
-        rows = (
-            db.query(models.ReaderBalance, models.StripeAccount)
-            .join(models.StripeAccount, models.StripeAccount.user_id == models.ReaderBalance.user_id)
-            .filter(models.ReaderBalance.balance_cents > 1500, models.StripeAccount.details_submitted == True)
-            .all()
-        )
-        for rb, sa in rows:
-            amount = int(rb.balance_cents)
-            if amount <= 0:
-                continue
-            idempotency_key = f"payout:{rb.user_id}:{datetime.utcnow().strftime('%Y%m%d')}:{amount}"
-            try:
-                stripe.Transfer.create(
-                    amount=amount,
-                    currency='usd',
-                    destination=sa.account_id,
-                    description='SoulSeer daily payout',
-                    idempotency_key=idempotency_key,
-                )
-            except Exception:
-                # skip on failure
-                continue
-            # record ledger and zero out balance
-            db.add(models.ReaderLedgerEntry(reader_id=rb.user_id, kind='payout', amount_cents=amount, ref_type='transfer', ref_id=idempotency_key))
-            rb.balance_cents = 0
-            db.add(rb)
-        db.commit()
+        return run_payouts(db, settings.payout_concurrency)
     finally:
         db.close()
-    return True
 
 @celery.task
 def appointment_reminders():
     """Send appointment reminders 1 hour and 15 minutes before start"""
-    from datetime import datetime, timedelta
-    from .services.notifications import notify_appointment_reminder
     import asyncio
-    
+    return asyncio.run(_appointment_reminders())
+
+async def _appointment_reminders():
+    from datetime import datetime
+    from redis.asyncio import Redis as AsyncRedis
+    from .db import AsyncSessionLocal, async_engine
+    from .services.reminders import send_due_reminders
+
+    r = AsyncRedis.from_url(settings.redis_url, decode_responses=True)
+    try:
+        async with AsyncSessionLocal() as db:
+            return await send_due_reminders(db, r, datetime.utcnow())
+    finally:
+        # Pooled connections belong to this event loop; don't carry them into the next run
+        await r.aclose()
+        await async_engine.dispose()
+
+@celery.task
+def drain_push_outbox():
+    import asyncio
+    return asyncio.run(_drain_push_outbox())
+
+async def _drain_push_outbox():
+    from .db import AsyncSessionLocal, async_engine
+    from .services.notifications import drain_push_outbox as drain
+
+    try:
+        async with AsyncSessionLocal() as db:
+            return await drain(db)
+    finally:
+        await async_engine.dispose()
+
+@celery.task
+def purge_notifications():
+    from .services.notifications import purge_notifications as purge, purge_push_outbox
+    r = Redis.from_url(settings.redis_url, decode_responses=True)
     db: Session = SessionLocal()
     try:
-        now = datetime.utcnow()
-        
-        # 1 hour reminder
-        hour_window_start = now + timedelta(minutes=59)
-        hour_window_end = now + timedelta(minutes=61)
-        
-        appts_1h = db.query(models.Appointment).filter(
-            models.Appointment.status == 'scheduled',
-            models.Appointment.start_time >= hour_window_start,
-            models.Appointment.start_time <= hour_window_end
-        ).all()
-        
-        for appt in appts_1h:
-            asyncio.run(notify_appointment_reminder(db, appt.client_id, appt, 60))
-            asyncio.run(notify_appointment_reminder(db, appt.reader_id, appt, 60))
-        
-        # 15 minutes reminder
-        min15_window_start = now + timedelta(minutes=14)
-        min15_window_end = now + timedelta(minutes=16)
-        
-        appts_15m = db.query(models.Appointment).filter(
-            models.Appointment.status == 'scheduled',
-            models.Appointment.start_time >= min15_window_start,
-            models.Appointment.start_time <= min15_window_end
-        ).all()
-        
-        for appt in appts_15m:
-            asyncio.run(notify_appointment_reminder(db, appt.client_id, appt, 15))
-            asyncio.run(notify_appointment_reminder(db, appt.reader_id, appt, 15))
-        
-        db.commit()
+        return {
+            "notifications": purge(db, r, settings.notification_retention_days),
+            "push_outbox": purge_push_outbox(db, settings.push_outbox_retention_days),
+        }
     finally:
         db.close()
-    return True
 
 @celery.task
 def billing_tick():
+    # Fan the minute out to one subtask per shard; shards bill independently
+    from celery import group
+    import time
+    minute = int(time.time() // 60)
+    group(bill_shard.s(shard, minute) for shard in range(settings.billing_shards)).apply_async()
+    return minute
+
+@celery.task(bind=True, acks_late=True, max_retries=5, default_retry_delay=5)
+def bill_shard(self, shard: int, minute: int):
+    from .services.billing import claim_shard_minute
+    from .services.locks import acquire_lease, release_lease, advance_fence
     r = Redis.from_url(settings.redis_url, decode_responses=True)
+    name = f"billing:shard:{shard}"
+    token = acquire_lease(r, name, settings.billing_lease_ms)
+    if token is None:
+        # Previous run for this shard still in progress; try again shortly
+        raise self.retry()
     db: Session = SessionLocal()
     try:
-        # Find active sessions
-        sessions = db.query(models.Session).filter(models.Session.status == 'active', models.Session.per_minute == True).all()
-        for s in sessions:
-            # Presence check: both client and reader seen recently
-            p_client = r.get(f'session:{s.session_uid}:user:{s.client_id}')
-            p_reader = r.get(f'session:{s.session_uid}:user:{s.reader_id}')
-            if not (p_client and p_reader):
-                continue
-            # Determine per-minute rate
-            rp = db.query(models.ReaderProfile).filter(models.ReaderProfile.user_id == s.reader_id).one_or_none()
-            if not rp:
-                continue
-            if s.mode == 'chat':
-                rate = rp.rate_chat_ppm
-            elif s.mode == 'voice':
-                rate = rp.rate_voice_ppm
-            else:
-                rate = rp.rate_video_ppm
-            ok = bill_one_minute(db, s, rate)
-            if not ok:
-                # End session
-                s.status = 'ended'
-                db.add(s)
+        minutes = claim_shard_minute(db, shard, minute, token)
+        if not minutes:
+            db.rollback()
+            state = db.get(models.BillingShardState, shard)
+            if state and state.last_minute < minute:
+                # Rejected on the fence alone: Redis lost its counter, resync it
+                advance_fence(r, name, state.fence)
+                raise self.retry(countdown=0)
+            return {"shard": shard, "minute": minute, "skipped": True}
+        # Also covers earlier minutes whose runs never committed
+        result = bill_active_sessions(db, r, shard=shard, shard_count=settings.billing_shards, minutes=minutes)
         db.commit()
     finally:
         db.close()
-    return True
-
-from celery import Celery
-from .config import settings
+        release_lease(r, name, token)
+    return {"shard": shard, "minute": minute, **result}
 
-celery = Celery(
-    'soulseer',
-    broker=settings.redis_url,
-    backend=settings.redis_url
-)
+@celery.task
+def settle_metering():
+    from .services.metering import settle_metered_sessions
+    r = Redis.from_url(settings.redis_url, decode_responses=True)
+    db: Session = SessionLocal()
+    try:
+        return settle_metered_sessions(db, r)
+    finally:
+        db.close()
 
-@celery.on_after_configure.connect
-def setup_periodic_tasks(sender, **kwargs):
-    # Daily payouts at 2am UTC
-    sender.add_periodic_task(24*60*60, run_daily_payouts.s(), name='daily_payouts')
-    # Billing tick every minute
-    sender.add_periodic_task(60.0, billing_tick.s(), name='billing_tick')
+@celery.task
+def flush_reader_presence():
+    from .services.presence import flush_presence
+    r = Redis.from_url(settings.redis_url, decode_responses=True)
+    db: Session = SessionLocal()
+    try:
+        return flush_presence(db, r)
+    finally:
+        db.close()
 
 @celery.task
-def run_daily_payouts():
-    # TODO: Implement Stripe Connect transfers to readers with balance > $15
-    return True
\ No newline at end of file
+def rollup_analytics():
+    from .services.analytics import rollup_analytics as run_rollup
+    db: Session = SessionLocal()
+    try:
+        return run_rollup(db)
+    finally:
+        db.close()
@@ -8,6 +8,8 @@ class Settings(BaseSettings):
     admin_email: str
 
     database_url: str
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
     redis_url: str = "redis://localhost:6379/0"
 
     clerk_secret_key: str
@@ -22,6 +24,12 @@ class Settings(BaseSettings):
 
     reader_share_pct: int = 70  # percent to readers
 
+    billing_mode: str = "minute"  # minute|metered
+    billing_shards: int = 8
+    billing_lease_ms: int = 55_000
+    metering_max_gap_seconds: int = 15  # longest gap between heartbeats that is still billed
+    metering_settle_interval_seconds: float = 30.0
+
     webrtc_turn_servers: str = "relay1.expressturn.com:3480"
     webrtc_turn_username: Optional[str] = None
     webrtc_turn_credential: Optional[str] = None
@@ -39,6 +47,18 @@ class Settings(BaseSettings):
     onesignal_api_key: Optional[str] = None
     
     enable_push_notifications: bool = False
+    push_outbox_interval_seconds: float = 5.0
+    notification_retention_days: int = 90
+    push_outbox_retention_days: int = 7  # delivered, skipped and failed pushes
+
+    stream_viewer_count_interval: float = 1.0  # seconds between viewer count broadcasts
+
+    reader_presence_ttl_seconds: int = 90  # readers not seen for this long count as offline
+    reader_presence_flush_interval_seconds: float = 30.0
+
+    analytics_rollup_interval_seconds: float = 300.0
+
+    payout_concurrency: int = 8  # Stripe transfers in flight at once
 
     class Config:
         env_file = ".env"
@@ -1,10 +1,57 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, sessionmaker, DeclarativeBase
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from .config import settings
+from typing import AsyncIterator, Awaitable, Callable
 
 engine = create_engine(settings.database_url, pool_pre_ping=True, pool_recycle=300)
 
+def async_database_url(url: str) -> str:
+    # psycopg 3 drives both engines, so the async URL only swaps the dialect prefix
+    for prefix in ("postgresql+psycopg2://", "postgresql+psycopg://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    return url
+
+async_engine = create_async_engine(
+    async_database_url(settings.database_url),
+    pool_pre_ping=True,
+    pool_recycle=300,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+)
+
 class Base(DeclarativeBase):
     pass
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
\ No newline at end of file
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Undo steps for side effects made outside Postgres, keyed in Session.info. They're dropped
+# when the transaction commits and run by get_db when the request ends without committing.
+_UNDO = "undo_on_rollback"
+_UNDO_DUE = "undo_due"
+
+
+def on_rollback(db: AsyncSession, undo: Callable[[], Awaitable[None]]):
+    """Run `undo` at the end of the request unless the current transaction commits."""
+    db.info.setdefault(_UNDO, []).append(undo)
+
+
+@event.listens_for(Session, "after_commit")
+def _drop_undo(session: Session):
+    session.info.pop(_UNDO, None)
+
+
+@event.listens_for(Session, "after_rollback")
+def _undo_due(session: Session):
+    session.info.setdefault(_UNDO_DUE, []).extend(session.info.pop(_UNDO, []))
+
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        finally:
+            for undo in db.info.pop(_UNDO_DUE, []) + db.info.pop(_UNDO, []):
+                await undo()
@@ -0,0 +1,95 @@
+"""Resolve a Clerk user ID to a compact user record.
+
+Lookups go request state -> in-process TTL cache -> Redis -> Postgres. Anything that
+changes a user's role, email or display name must call `invalidate_user`.
+"""
+from fastapi import Depends, HTTPException, Request
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from dataclasses import dataclass, asdict
+from typing import Dict, Any
+import json
+import time
+from . import models
+from .auth import get_current_user_token
+from .db import AsyncSessionLocal, get_db
+from .redis_client import get_async_redis
+
+LOCAL_TTL = 30  # seconds; bounds how long another process can serve a stale role
+LOCAL_MAX = 50_000
+REDIS_TTL = 600
+
+@dataclass(frozen=True, slots=True)
+class CurrentUser:
+    id: int
+    clerk_user_id: str
+    role: str
+    email: str
+    display_name: str
+
+_local: Dict[str, tuple[float, CurrentUser]] = {}
+
+def _redis_key(clerk_user_id: str) -> str:
+    return f"user:clerk:{clerk_user_id}"
+
+def _remember_local(user: CurrentUser):
+    if len(_local) >= LOCAL_MAX:
+        _local.clear()
+    _local[user.clerk_user_id] = (time.monotonic() + LOCAL_TTL, user)
+
+def to_current_user(u: models.User) -> CurrentUser:
+    return CurrentUser(id=u.id, clerk_user_id=u.clerk_user_id, role=u.role, email=u.email, display_name=u.display_name)
+
+async def resolve_user(clerk_user_id: str, db: AsyncSession | None = None) -> CurrentUser | None:
+    hit = _local.get(clerk_user_id)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    r = await get_async_redis()
+    try:
+        raw = await r.get(_redis_key(clerk_user_id))
+    except Exception:
+        raw = None  # Redis is only a cache; fall through to Postgres
+    if raw:
+        user = CurrentUser(**json.loads(raw))
+        _remember_local(user)
+        return user
+    stmt = select(models.User).where(models.User.clerk_user_id == clerk_user_id)
+    if db is None:
+        async with AsyncSessionLocal() as own_db:
+            u = (await own_db.execute(stmt)).scalar_one_or_none()
+    else:
+        u = (await db.execute(stmt)).scalar_one_or_none()
+    if not u:
+        return None
+    user = to_current_user(u)
+    await cache_user(user)
+    return user
+
+async def cache_user(user: CurrentUser):
+    _remember_local(user)
+    try:
+        r = await get_async_redis()
+        await r.set(_redis_key(user.clerk_user_id), json.dumps(asdict(user)), ex=REDIS_TTL)
+    except Exception:
+        pass
+
+async def invalidate_user(clerk_user_id: str):
+    _local.pop(clerk_user_id, None)
+    try:
+        r = await get_async_redis()
+        await r.delete(_redis_key(clerk_user_id))
+    except Exception:
+        pass
+
+async def current_user(request: Request, token: Dict[str, Any] = Depends(get_current_user_token), db: AsyncSession = Depends(get_db)) -> CurrentUser:
+    cached = getattr(request.state, "current_user", None)
+    if cached is not None:
+        return cached
+    clerk_user_id = token.get("sub")
+    if not clerk_user_id:
+        raise HTTPException(401, "Invalid token")
+    user = await resolve_user(clerk_user_id, db)
+    if user is None:
+        raise HTTPException(401, "Unknown user")
+    request.state.current_user = user
+    return user
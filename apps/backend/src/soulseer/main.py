@@ -14,6 +14,7 @@ from .routers import appointments as appointments_router
 from .routers import notifications as notifications_router
 from .routers import marketplace as marketplace_router
 from .routers import signaling as signaling_router
+from .routers import events as events_router
 import sentry_sdk
 
 if settings.sentry_dsn_backend:
@@ -42,6 +43,7 @@ app.include_router(sessions_router.router)
 app.include_router(readers_router.router)
 app.include_router(streams_router.router)
 app.include_router(signaling_router.router)
+app.include_router(events_router.router)
 app.include_router(connect_router.router)
 app.include_router(appointments_router.router)
 app.include_router(notifications_router.router)
@@ -1,8 +1,9 @@
 from __future__ import annotations
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey, String, Integer, DateTime, Boolean, Numeric, Text, UniqueConstraint
+from sqlalchemy import ForeignKey, String, Integer, SmallInteger, BigInteger, Date, DateTime, Boolean, Numeric, Text, UniqueConstraint, Computed, DDL, Index, event, text
+from sqlalchemy.dialects.postgresql import JSONB, ExcludeConstraint, Range, TSRANGE
 from .db import Base
-from datetime import datetime
+from datetime import date, datetime
 
 class User(Base):
     __tablename__ = "users"
@@ -46,6 +47,8 @@ class LedgerEntry(Base):
     ref_id: Mapped[str] = mapped_column(String(64))
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index("ix_ledger_entries_user_created", "user_id", "created_at"),)
+
 class Session(Base):
     __tablename__ = "sessions"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -61,6 +64,13 @@ class Session(Base):
     per_minute: Mapped[bool] = mapped_column(Boolean, default=True)
     appointment_id: Mapped[int | None] = mapped_column(ForeignKey("appointments.id"), nullable=True)
 
+    __table_args__ = (
+        Index("ix_sessions_status_per_minute", "status", "per_minute"),
+        Index("ix_sessions_reader_status", "reader_id", "status"),
+        Index("ix_sessions_mode_status", "mode", "status"),
+        Index("ix_sessions_appointment_id", "appointment_id"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -81,6 +91,22 @@ class Appointment(Base):
     start_time: Mapped[datetime]
     end_time: Mapped[datetime]
     status: Mapped[str] = mapped_column(String(16), default="scheduled")  # scheduled|canceled|completed|in_progress
+    during: Mapped[Range[datetime]] = mapped_column(TSRANGE, Computed("tsrange(start_time, end_time, '[)')", persisted=True))
+
+    # A reader can't have two active appointments whose times overlap
+    __table_args__ = (
+        ExcludeConstraint(
+            ("reader_id", "="), ("during", "&&"),
+            name="appointments_reader_no_overlap",
+            using="gist",
+            where=text("status IN ('scheduled', 'in_progress')"),
+        ),
+        Index("ix_appointments_reader_status_start", "reader_id", "status", "start_time"),
+        Index("ix_appointments_client_status_start", "client_id", "status", "start_time"),
+        Index("ix_appointments_status_start", "status", "start_time"),
+    )
+
+event.listen(Appointment.__table__, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS btree_gist"))
 
 class StripeAccount(Base):
     __tablename__ = "stripe_accounts"
@@ -105,6 +131,8 @@ class AvailabilityBlock(Base):
     end_time: Mapped[datetime]
     timezone: Mapped[str] = mapped_column(String(64), default="UTC")
 
+    __table_args__ = (Index("ix_availability_blocks_reader_start", "reader_id", "start_time"),)
+
 class Product(Base):
     __tablename__ = "products"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -117,6 +145,8 @@ class Product(Base):
     stock_quantity: Mapped[int] = mapped_column(Integer, default=-1)  # -1 = unlimited
     reader_id: Mapped[int | None] = mapped_column(ForeignKey("users.id"), nullable=True)
     active: Mapped[bool] = mapped_column(Boolean, default=True)
+    stripe_price_id: Mapped[str | None] = mapped_column(String(64), nullable=True, index=True)  # default price
+    stripe_updated_at: Mapped[datetime | None]  # Stripe's `updated`; older webhook deliveries are ignored
 
 class Gift(Base):
     __tablename__ = "gifts"
@@ -143,6 +173,8 @@ class ReaderLedgerEntry(Base):
     ref_id: Mapped[str] = mapped_column(String(64))
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (Index("ix_reader_ledger_entries_reader_created", "reader_id", "created_at"),)
+
 class StreamGift(Base):
     __tablename__ = "stream_gifts"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -162,6 +194,12 @@ class Notification(Base):
     read: Mapped[bool] = mapped_column(Boolean, default=False)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_notifications_user_created", "user_id", "created_at"),
+        Index("ix_notifications_user_unread", "user_id", "id", postgresql_where=text("NOT read")),
+        Index("ix_notifications_created", "created_at"),
+    )
+
 class PushSubscription(Base):
     __tablename__ = "push_subscriptions"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -207,6 +245,117 @@ class Order(Base):
     total_cents: Mapped[int] = mapped_column(Integer)
     status: Mapped[str] = mapped_column(String(16), default="created")  # created|paid|fulfilled|canceled
 
+    __table_args__ = (Index("ix_orders_buyer_id", "buyer_id", "id"),)
+
+class BillingShardState(Base):
+    __tablename__ = "billing_shard_state"
+    shard: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    last_minute: Mapped[int] = mapped_column(BigInteger, default=0)  # last epoch minute billed
+    fence: Mapped[int] = mapped_column(BigInteger, default=0)  # highest lease token accepted
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DailyStat(Base):
+    __tablename__ = "daily_stats"
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    metric: Mapped[str] = mapped_column(String(32), primary_key=True)
+    slot: Mapped[int] = mapped_column(SmallInteger, primary_key=True, autoincrement=False)  # spreads hot counters over rows
+    value: Mapped[int] = mapped_column(BigInteger, default=0)
+
+class StatTotal(Base):
+    __tablename__ = "stat_totals"
+    metric: Mapped[str] = mapped_column(String(32), primary_key=True)
+    slot: Mapped[int] = mapped_column(SmallInteger, primary_key=True, autoincrement=False)
+    value: Mapped[int] = mapped_column(BigInteger, default=0)
+
+class AnalyticsHourly(Base):
+    __tablename__ = "analytics_hourly"
+    bucket: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    source: Mapped[str] = mapped_column(String(8), primary_key=True)  # client|reader|session
+    reader_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)  # 0 when not attributable
+    mode: Mapped[str] = mapped_column(String(16), primary_key=True)  # '' when not a session
+    ref_type: Mapped[str] = mapped_column(String(32), primary_key=True)
+    kind: Mapped[str] = mapped_column(String(24), primary_key=True)
+    amount_cents: Mapped[int] = mapped_column(BigInteger, default=0)
+    entries: Mapped[int] = mapped_column(Integer, default=0)
+    seconds: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    __table_args__ = (Index("ix_analytics_hourly_reader_bucket", "reader_id", "bucket"),)
+
+class AnalyticsDaily(Base):
+    __tablename__ = "analytics_daily"
+    bucket: Mapped[date] = mapped_column(Date, primary_key=True)
+    source: Mapped[str] = mapped_column(String(8), primary_key=True)
+    reader_id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    mode: Mapped[str] = mapped_column(String(16), primary_key=True)
+    ref_type: Mapped[str] = mapped_column(String(32), primary_key=True)
+    kind: Mapped[str] = mapped_column(String(24), primary_key=True)
+    amount_cents: Mapped[int] = mapped_column(BigInteger, default=0)
+    entries: Mapped[int] = mapped_column(Integer, default=0)
+    seconds: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    __table_args__ = (Index("ix_analytics_daily_reader_bucket", "reader_id", "bucket"),)
+
+class AnalyticsWatermark(Base):
+    __tablename__ = "analytics_watermarks"
+    source: Mapped[str] = mapped_column(String(8), primary_key=True)
+    last_id: Mapped[int] = mapped_column(BigInteger, default=0)  # highest source row id rolled up
+    last_ts: Mapped[datetime | None]  # for sources rolled up by time instead of id
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PayoutRun(Base):
+    __tablename__ = "payout_runs"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    run_date: Mapped[date] = mapped_column(Date, unique=True)
+    status: Mapped[str] = mapped_column(String(16), default="running")  # running|completed
+    payouts: Mapped[int] = mapped_column(Integer, default=0)
+    paid: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    paid_cents: Mapped[int] = mapped_column(BigInteger, default=0)
+    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    finished_at: Mapped[datetime | None]
+
+class Payout(Base):
+    __tablename__ = "payouts"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    run_id: Mapped[int] = mapped_column(ForeignKey("payout_runs.id", ondelete="CASCADE"))
+    reader_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    account_id: Mapped[str] = mapped_column(String(64))
+    amount_cents: Mapped[int] = mapped_column(Integer)
+    idempotency_key: Mapped[str] = mapped_column(String(64), unique=True)
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending|paid|failed|abandoned
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    stripe_transfer_id: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("run_id", "reader_id", name="uq_payouts_run_reader"),
+        Index("ix_payouts_run_status", "run_id", "status"),
+    )
+
+class AppointmentReminder(Base):
+    __tablename__ = "appointment_reminders"
+    appointment_id: Mapped[int] = mapped_column(ForeignKey("appointments.id", ondelete="CASCADE"), primary_key=True)
+    minutes_before: Mapped[int] = mapped_column(SmallInteger, primary_key=True, autoincrement=False)  # 60|15
+    sent_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class PushOutbox(Base):
+    __tablename__ = "push_outbox"
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
+    title: Mapped[str] = mapped_column(String(200))
+    body: Mapped[str] = mapped_column(Text)
+    data: Mapped[dict] = mapped_column(JSONB, default=dict)
+    status: Mapped[str] = mapped_column(String(16), default="pending")  # pending|sent|skipped|failed
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    sent_at: Mapped[datetime | None]
+
+    __table_args__ = (Index("ix_push_outbox_due", "next_attempt_at", postgresql_where=text("status = 'pending'")),)
+
 __all__ = [
     "User",
     "ReaderProfile",
@@ -227,4 +376,14 @@ __all__ = [
     "OrderItem",
     "ShippingAddress",
     "DigitalDownload",
+    "BillingShardState",
+    "DailyStat",
+    "StatTotal",
+    "AnalyticsHourly",
+    "AnalyticsDaily",
+    "AnalyticsWatermark",
+    "PayoutRun",
+    "Payout",
+    "AppointmentReminder",
+    "PushOutbox",
 ]
\ No newline at end of file
@@ -0,0 +1,52 @@
+"""Keyset pagination with opaque cursors.
+
+A page is fetched with `WHERE (k1, k2) < (:last_k1, :last_k2) ORDER BY k1 DESC, k2 DESC
+LIMIT n + 1`, so with an index on the filter columns followed by the keys every page
+costs the same as the first. The cursor is the last row's key values, base64-encoded.
+"""
+from fastapi import HTTPException
+from sqlalchemy import Select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import Any, List, Sequence, Tuple
+import base64
+import orjson
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    raw = orjson.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, keys: Sequence[Any]) -> List[Any]:
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError(cursor)
+        return [
+            datetime.fromisoformat(v) if key.type.python_type is datetime else key.type.python_type(v)
+            for key, v in zip(keys, values)
+        ]
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+
+
+async def paginate(db: AsyncSession, stmt: Select, keys: Sequence[Any], cursor: str | None = None, limit: int = DEFAULT_LIMIT, descending: bool = True) -> Tuple[list, str | None]:
+    """Run `stmt` (a select of one entity) a page at a time ordered by `keys`.
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+    if cursor:
+        after = decode_cursor(cursor, keys)
+        row_keys, row_after = (keys[0], after[0]) if len(keys) == 1 else (tuple_(*keys), tuple_(*after, types=[k.type for k in keys]))
+        stmt = stmt.where(row_keys < row_after if descending else row_keys > row_after)
+    stmt = stmt.order_by(*[k.desc() if descending else k.asc() for k in keys]).limit(limit + 1)
+    rows = (await db.execute(stmt)).scalars().all()
+    if len(rows) <= limit:
+        return list(rows), None
+    rows = rows[:limit]
+    return list(rows), encode_cursor([getattr(rows[-1], k.key) for k in keys])
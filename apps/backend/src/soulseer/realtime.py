@@ -0,0 +1,279 @@
+"""Cross-process WebSocket fan-out over Redis pub/sub.
+
+Each process keeps its own sockets per channel and holds at most one Redis subscription
+per channel, shared by all of them. A published message is delivered to local sockets
+directly and relayed through Redis to every other process; a process ignores its own
+messages when they come back from Redis.
+
+Every socket gets an `Outbox`: a bounded queue drained by its own writer task, so a
+broadcast is a non-blocking enqueue per recipient and one slow client never delays the
+rest. Messages to a full outbox are dropped; a client that keeps falling behind is
+disconnected.
+"""
+from fastapi import WebSocket
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.client import PubSub
+from typing import Dict, Set
+import asyncio
+import json
+import logging
+import os
+import uuid
+from .redis_client import get_async_redis
+
+log = logging.getLogger(__name__)
+
+PROCESS_ID = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+OUTBOX_SIZE = 256
+MAX_CONSECUTIVE_DROPS = 64
+SLOW_CONSUMER_CLOSE_CODE = 1013  # try again later
+
+_background: Set[asyncio.Task] = set()
+
+
+class Outbox:
+    """Bounded outgoing queue for one socket, drained by its own writer task."""
+
+    def __init__(self, ws: WebSocket, maxsize: int = OUTBOX_SIZE, max_drops: int = MAX_CONSECUTIVE_DROPS):
+        self.ws = ws
+        self.closed = False
+        self.dropped = 0
+        self._drops_in_a_row = 0
+        self._max_drops = max_drops
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize)
+        self._writer = asyncio.create_task(self._write())
+
+    def offer(self, data: str):
+        if self.closed:
+            return
+        try:
+            self._queue.put_nowait(data)
+            self._drops_in_a_row = 0
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._drops_in_a_row += 1
+            if self._drops_in_a_row >= self._max_drops:
+                self.close(SLOW_CONSUMER_CLOSE_CODE)
+
+    async def _write(self):
+        try:
+            while True:
+                data = await self._queue.get()
+                await self.ws.send_text(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
+
+    def close(self, code: int | None = None):
+        if self.closed and self._writer.done():
+            return
+        self.closed = True
+        self._writer.cancel()
+        if code is not None:
+            task = asyncio.create_task(self._close_socket(code))
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.ws.close(code=code)
+        except Exception:
+            pass
+
+
+class ChannelHub:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.local: Dict[str, Dict[WebSocket, Outbox]] = {}
+        self._pubsub: PubSub | None = None
+        self._reader: asyncio.Task | None = None
+
+    def _redis_channel(self, channel: str) -> str:
+        return f"{self.prefix}:{channel}"
+
+    async def _get_pubsub(self) -> PubSub:
+        if self._pubsub is None:
+            r = await get_async_redis()
+            self._pubsub = r.pubsub(ignore_subscribe_messages=True)
+        return self._pubsub
+
+    async def join(self, channel: str, ws: WebSocket) -> Outbox:
+        outbox = Outbox(ws)
+        sockets = self.local.get(channel)
+        if sockets is None:
+            sockets = self.local[channel] = {ws: outbox}
+            pubsub = await self._get_pubsub()
+            await pubsub.subscribe(self._redis_channel(channel))
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read())
+        else:
+            sockets[ws] = outbox
+        return outbox
+
+    async def leave(self, channel: str, ws: WebSocket):
+        sockets = self.local.get(channel)
+        if sockets is None:
+            return
+        outbox = sockets.pop(ws, None)
+        if outbox is not None:
+            outbox.close()
+        if not sockets:
+            del self.local[channel]
+            try:
+                await (await self._get_pubsub()).unsubscribe(self._redis_channel(channel))
+            except Exception:
+                log.exception("unsubscribe failed for %s", channel)
+
+    def local_count(self, channel: str) -> int:
+        return len(self.local.get(channel, ()))
+
+    async def publish(self, channel: str, data: str, origin: WebSocket | None = None, redis: AsyncRedis | None = None):
+        """Send `data` to every socket on `channel` except `origin`, on all processes.
+
+        Pass `redis` when publishing from outside the API's event loop (e.g. a worker).
+        """
+        self.deliver_local(channel, data, origin)
+        envelope = json.dumps({"p": PROCESS_ID, "d": data})
+        r = redis or await get_async_redis()
+        await r.publish(self._redis_channel(channel), envelope)
+
+    def deliver_local(self, channel: str, data: str, origin: WebSocket | None = None):
+        """Enqueue `data` for this process's sockets on `channel`; never waits on a client."""
+        sockets = self.local.get(channel)
+        if not sockets:
+            return
+        for ws, outbox in list(sockets.items()):
+            if ws is not origin:
+                outbox.offer(data)
+
+    async def _read(self):
+        prefix_len = len(self.prefix) + 1
+        while True:
+            if not self.local:
+                # Last channel left; the next join starts a new reader
+                self._reader = None
+                return
+            try:
+                msg = await (await self._get_pubsub()).get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("pubsub read failed; resubscribing")
+                try:
+                    await self._reset()
+                except Exception:
+                    pass
+                continue
+            if not msg or msg.get("type") != "message":
+                continue
+            try:
+                envelope = json.loads(msg["data"])
+            except ValueError:
+                continue
+            if envelope.get("p") == PROCESS_ID:
+                continue
+            self.deliver_local(msg["channel"][prefix_len:], envelope["d"])
+
+    async def _reset(self):
+        await asyncio.sleep(1.0)
+        old, self._pubsub = self._pubsub, None
+        if old is not None:
+            try:
+                await old.reset()
+            except Exception:
+                pass
+        if self.local:
+            pubsub = await self._get_pubsub()
+            await pubsub.subscribe(*[self._redis_channel(c) for c in self.local])
+
+
+# KEYS: per-channel hash of process -> "count:seen_at". ARGV: process id, local count, stale after (s)
+# Records this process's count and returns the sum over processes seen recently.
+VIEWER_TOTAL_LUA = """
+local now = tonumber(redis.call('TIME')[1])
+if tonumber(ARGV[2]) > 0 then
+  redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ':' .. now)
+else
+  redis.call('HDEL', KEYS[1], ARGV[1])
+end
+local total = 0
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 1, #entries, 2 do
+  local count, seen = string.match(entries[i + 1], '(%d+):(%d+)')
+  if tonumber(seen) < now - tonumber(ARGV[3]) then
+    redis.call('HDEL', KEYS[1], entries[i])
+  else
+    total = total + tonumber(count)
+  end
+end
+if total > 0 then redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]) * 2) end
+return total
+"""
+
+
+class ViewerCounts:
+    """Cluster-wide viewer counts for a hub's channels, broadcast at most once per interval.
+
+    Joins and leaves only mark a channel dirty. A per-process ticker publishes this
+    process's counts to Redis, reads back the totals and sends a count message to local
+    sockets when the total changed or someone new joined. A process that stops
+    reporting drops out of the totals after `stale_after` seconds.
+    """
+
+    def __init__(self, hub: ChannelHub, interval: float, stale_after: int = 10):
+        self.hub = hub
+        self.interval = interval
+        self.stale_after = stale_after
+        self._dirty: Set[str] = set()
+        self._joined: Set[str] = set()
+        self._last: Dict[str, int] = {}
+        self._ticker: asyncio.Task | None = None
+
+    def _key(self, channel: str) -> str:
+        return f"{self.hub.prefix}:viewers:{channel}"
+
+    def joined(self, channel: str):
+        self._joined.add(channel)
+        self._mark(channel)
+
+    def left(self, channel: str):
+        self._mark(channel)
+
+    def _mark(self, channel: str):
+        self._dirty.add(channel)
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.hub.local or self._dirty:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("viewer count tick failed")
+        self._ticker = None
+
+    async def _tick(self):
+        # Every local channel is reported each tick so this process stays "seen"
+        channels = list(set(self.hub.local) | self._dirty)
+        joined = self._joined
+        self._dirty, self._joined = set(), set()
+        r = await get_async_redis()
+        script = r.register_script(VIEWER_TOTAL_LUA)
+        pipe = r.pipeline(transaction=False)
+        for channel in channels:
+            await script(keys=[self._key(channel)], args=[PROCESS_ID, self.hub.local_count(channel), self.stale_after], client=pipe)
+        totals = await pipe.execute()
+        for channel, total in zip(channels, totals):
+            total = int(total)
+            if not self.hub.local_count(channel):
+                self._last.pop(channel, None)
+                continue
+            if total != self._last.get(channel) or channel in joined:
+                self._last[channel] = total
+                self.hub.deliver_local(channel, json.dumps({"type": "viewers", "count": total}))
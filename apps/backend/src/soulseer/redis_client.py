@@ -0,0 +1,18 @@
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from .config import settings
+
+_redis: Redis | None = None
+_aredis: AsyncRedis | None = None
+
+def get_redis() -> Redis:
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(settings.redis_url, decode_responses=True)
+    return _redis
+
+async def get_async_redis() -> AsyncRedis:
+    global _aredis
+    if _aredis is None:
+        _aredis = AsyncRedis.from_url(settings.redis_url, decode_responses=True)
+    return _aredis
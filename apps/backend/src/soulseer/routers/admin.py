@@ -1,70 +1,88 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from ..db import SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db import get_db
 from .. import models
 from ..auth import get_current_user_token
 from ..config import settings
+from ..identity import invalidate_user
+from ..pagination import DEFAULT_LIMIT, paginate
+from ..services.stats import bump, get_daily, get_totals
+from ..services.analytics import DIMENSIONS, parse_range, query_buckets
+from ..services.directory import refresh_reader
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 def _ensure_admin(token):
     email = token.get("email")
     if not email or email.lower() != settings.admin_email.lower():
         raise HTTPException(403, "Admins only")
 
 @router.post("/readers/{user_id}/promote")
-async def promote_reader(user_id: int, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def promote_reader(user_id: int, token=Depends(get_current_user_token), db: AsyncSession = Depends(get_db)):
     _ensure_admin(token)
-    user = db.query(models.User).filter(models.User.id == user_id).one_or_none()
+    user = await db.get(models.User, user_id)
     if not user:
         raise HTTPException(404, "User not found")
+    if user.role != "reader":
+        await bump(db, readers=1)
     user.role = "reader"
     db.add(user)
     # Create reader profile if missing
-    rp = db.query(models.ReaderProfile).filter(models.ReaderProfile.user_id == user.id).one_or_none()
+    rp = (await db.execute(select(models.ReaderProfile).where(models.ReaderProfile.user_id == user.id))).scalar_one_or_none()
     if not rp:
         rp = models.ReaderProfile(user_id=user.id)
         db.add(rp)
-    db.commit()
+    await db.commit()
+    await invalidate_user(user.clerk_user_id)
+    await refresh_reader(db, user.id)
     return {"ok": True, "user_id": user.id, "role": user.role}
 
+MAX_STATS_DAYS = 90
+
 @router.get("/stats")
-async def admin_stats(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def admin_stats(days: int = 0, token=Depends(get_current_user_token), db: AsyncSession = Depends(get_db)):
     _ensure_admin(token)
-    
-    # Get counts
-    total_users = db.query(models.User).count()
-    total_readers = db.query(models.User).filter(models.User.role == 'reader').count()
-    total_sessions = db.query(models.Session).count()
-    total_appointments = db.query(models.Appointment).count()
-    total_orders = db.query(models.Order).count()
-    
-    # Revenue
-    total_revenue = db.query(models.LedgerEntry).filter(
-        models.LedgerEntry.kind == 'credit',
-        models.LedgerEntry.ref_type == 'payment_intent'
-    ).count()
-    
-    return {
-        "users": total_users,
-        "readers": total_readers,
-        "sessions": total_sessions,
-        "appointments": total_appointments,
-        "orders": total_orders,
-        "revenue_transactions": total_revenue
+    totals = await get_totals(db)
+    result = {
+        "users": totals["users"],
+        "readers": totals["readers"],
+        "sessions": totals["sessions"],
+        "appointments": totals["appointments"],
+        "orders": totals["orders"],
+        "revenue_transactions": totals["revenue_transactions"],
+        "revenue_cents": totals["revenue_cents"],
     }
+    if days > 0:
+        result["daily"] = await get_daily(db, min(days, MAX_STATS_DAYS))
+    return result
+
+@router.get("/analytics")
+async def analytics(
+    start: str,
+    end: str,
+    granularity: str = "day",
+    group_by: str = "source,kind",
+    source: str | None = None,
+    reader_id: int | None = None,
+    mode: str | None = None,
+    ref_type: str | None = None,
+    kind: str | None = None,
+    token=Depends(get_current_user_token),
+    db: AsyncSession = Depends(get_db),
+):
+    _ensure_admin(token)
+    start_at, end_at = parse_range(granularity, start, end)
+    dims = [d for d in group_by.split(",") if d]
+    if any(d not in DIMENSIONS for d in dims):
+        raise HTTPException(400, f"group_by must be drawn from {', '.join(DIMENSIONS)}")
+    filters = {"source": source, "reader_id": reader_id, "mode": mode, "ref_type": ref_type, "kind": kind}
+    return {"granularity": granularity, "items": await query_buckets(db, granularity, start_at, end_at, filters, dims)}
 
 @router.get("/users")
-async def list_users(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def list_users(cursor: str | None = None, limit: int = DEFAULT_LIMIT, token=Depends(get_current_user_token), db: AsyncSession = Depends(get_db)):
     _ensure_admin(token)
-    users = db.query(models.User).limit(100).all()
+    users, next_cursor = await paginate(db, select(models.User), [models.User.id], cursor, limit, descending=False)
     return {
         "items": [
             {
@@ -75,13 +93,14 @@ async def list_users(token=Depends(get_current_user_token), db: Session = Depend
                 "created_at": u.created_at
             }
             for u in users
-        ]
+        ],
+        "next_cursor": next_cursor,
     }
 
 @router.post("/users/{user_id}/role")
-async def update_role(user_id: int, payload: dict, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def update_role(user_id: int, payload: dict, token=Depends(get_current_user_token), db: AsyncSession = Depends(get_db)):
     _ensure_admin(token)
-    user = db.query(models.User).filter(models.User.id == user_id).one_or_none()
+    user = await db.get(models.User, user_id)
     if not user:
         raise HTTPException(404, "User not found")
     
@@ -89,6 +108,10 @@ async def update_role(user_id: int, payload: dict, token=Depends(get_current_use
     if new_role not in ['client', 'reader', 'admin']:
         raise HTTPException(400, "Invalid role")
     
+    if user.role != new_role and 'reader' in (user.role, new_role):
+        await bump(db, readers=1 if new_role == 'reader' else -1)
     user.role = new_role
-    db.commit()
+    await db.commit()
+    await invalidate_user(user.clerk_user_id)
+    await refresh_reader(db, user_id)
     return {"ok": True}
@@ -1,22 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 import secrets
-from ..db import SessionLocal
+from ..db import get_db
 from .. import models
-from ..auth import get_current_user_token
+from ..identity import CurrentUser, current_user
+from ..pagination import DEFAULT_LIMIT, paginate
+from ..services.stats import bump
+from ..redis_client import get_async_redis
+from ..services.slots import invalidate_slots, is_bookable, is_slot_aligned, parse_utc
+from ..services.events import publish_events
 
 router = APIRouter(prefix="/appointments", tags=["appointments"])
 
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 ALLOWED_LENGTHS = {15, 30, 45, 60}
+EXCLUSION_VIOLATION = '23P01'
 
 
 def compute_price_cents(rp: models.ReaderProfile, mode: str, length: int) -> int:
@@ -32,27 +32,35 @@ def compute_price_cents(rp: models.ReaderProfile, mode: str, length: int) -> int
     return int(base)
 
 @router.get("/me")
-async def my_appointments(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    upcoming = db.query(models.Appointment).filter(models.Appointment.client_id == user.id, models.Appointment.status.in_(['scheduled','in_progress'])).order_by(models.Appointment.start_time).all()
-    history = db.query(models.Appointment).filter(models.Appointment.client_id == user.id, models.Appointment.status.in_(['completed','canceled'])).order_by(models.Appointment.start_time.desc()).limit(50).all()
+async def my_appointments(cursor: str | None = None, limit: int = DEFAULT_LIMIT, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    # `cursor` pages through history; upcoming is always returned in full
+    upcoming = (await db.execute(select(models.Appointment).where(models.Appointment.client_id == user.id, models.Appointment.status.in_(['scheduled','in_progress'])).order_by(models.Appointment.start_time))).scalars().all()
+    history, next_cursor = await paginate(
+        db,
+        select(models.Appointment).where(models.Appointment.client_id == user.id, models.Appointment.status.in_(['completed','canceled'])),
+        [models.Appointment.start_time, models.Appointment.id],
+        cursor, limit,
+    )
     return {
         "upcoming": [{"booking_uid": a.booking_uid, "reader_id": a.reader_id, "mode": a.mode, "start_time": a.start_time, "length_minutes": a.length_minutes, "status": a.status} for a in upcoming],
-        "history": [{"booking_uid": a.booking_uid, "reader_id": a.reader_id, "mode": a.mode, "start_time": a.start_time, "length_minutes": a.length_minutes, "status": a.status} for a in history]
+        "history": [{"booking_uid": a.booking_uid, "reader_id": a.reader_id, "mode": a.mode, "start_time": a.start_time, "length_minutes": a.length_minutes, "status": a.status} for a in history],
+        "next_cursor": next_cursor,
     }
 
 @router.get("/reader")
-async def reader_appointments(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
+async def reader_appointments(user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     if user.role != 'reader':
         raise HTTPException(403, 'Readers only')
-    upcoming = db.query(models.Appointment).filter(models.Appointment.reader_id == user.id, models.Appointment.status.in_(['scheduled','in_progress'])).order_by(models.Appointment.start_time).all()
+    upcoming = (await db.execute(select(models.Appointment).where(models.Appointment.reader_id == user.id, models.Appointment.status.in_(['scheduled','in_progress'])).order_by(models.Appointment.start_time))).scalars().all()
     return {
         "upcoming": [{"booking_uid": a.booking_uid, "client_id": a.client_id, "mode": a.mode, "start_time": a.start_time, "length_minutes": a.length_minutes, "status": a.status} for a in upcoming]
     }
 
+def _appointment_event(appt: models.Appointment) -> dict:
+    return {"booking_uid": appt.booking_uid, "status": appt.status, "mode": appt.mode, "start_time": appt.start_time, "end_time": appt.end_time}
+
 @router.post("/book")
-async def book(payload: dict, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def book(payload: dict, client: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     reader_id = int(payload.get('reader_id'))
     mode = payload.get('mode')
     length = int(payload.get('length_minutes'))
@@ -62,33 +70,26 @@ async def book(payload: dict, token=Depends(get_current_user_token), db: Session
     if length not in ALLOWED_LENGTHS:
         raise HTTPException(400, 'Invalid length')
     try:
-        start_time = datetime.fromisoformat(start_time_str)
+        start_time = parse_utc(start_time_str)
     except Exception:
         raise HTTPException(400, 'Invalid start_time')
+    if not is_slot_aligned(start_time):
+        raise HTTPException(400, 'start_time must be on a 15-minute boundary')
     end_time = start_time + timedelta(minutes=length)
 
-    client = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    reader = db.query(models.User).filter(models.User.id == reader_id).one_or_none()
+    reader = await db.get(models.User, reader_id)
     if not reader or reader.role != 'reader':
         raise HTTPException(404, 'Reader not found')
-    rp = db.query(models.ReaderProfile).filter(models.ReaderProfile.user_id == reader_id).one_or_none()
+    rp = (await db.execute(select(models.ReaderProfile).where(models.ReaderProfile.user_id == reader_id))).scalar_one_or_none()
     if not rp:
         raise HTTPException(400, 'Reader profile missing')
 
-    # Ensure availability: check availability_blocks has a covering block and no overlapping appointments
-    block = db.query(models.AvailabilityBlock).filter(models.AvailabilityBlock.reader_id == reader_id, models.AvailabilityBlock.start_time <= start_time, models.AvailabilityBlock.end_time >= end_time).one_or_none()
-    if not block:
+    # Ensure availability against the reader's free slots; overlaps are enforced on insert
+    r = await get_async_redis()
+    if not await is_bookable(db, r, reader_id, start_time, length):
         raise HTTPException(409, 'Requested time not available')
-    overlapping = db.query(models.Appointment).filter(models.Appointment.reader_id == reader_id, models.Appointment.status.in_(['scheduled','in_progress']), models.Appointment.start_time < end_time, models.Appointment.end_time > start_time).count()
-    if overlapping:
-        raise HTTPException(409, 'Time already booked')
-
     price_cents = compute_price_cents(rp, mode, length)
 
-    # Debit client wallet now; reader is credited upon completion to allow refunds
-    from ..services.wallet import debit
-    debit(db, client.id, price_cents, ref_type='appointment', ref_id='pending')
-
     appt = models.Appointment(
         booking_uid=secrets.token_urlsafe(12),
         reader_id=reader_id,
@@ -101,14 +102,28 @@ async def book(payload: dict, token=Depends(get_current_user_token), db: Session
         status='scheduled'
     )
     db.add(appt)
-    db.commit()
-    db.refresh(appt)
+    try:
+        # The exclusion constraint rejects overlapping active bookings atomically
+        await db.flush()
+    except IntegrityError as e:
+        await db.rollback()
+        if getattr(e.orig, 'sqlstate', None) == EXCLUSION_VIOLATION:
+            raise HTTPException(409, 'Time already booked')
+        raise
+
+    # Debit client wallet now; reader is credited upon completion to allow refunds
+    from ..services.wallet import debit
+    await debit(db, client.id, price_cents, ref_type='appointment', ref_id='pending')
+    await bump(db, appointments=1)
+    await db.commit()
+    await db.refresh(appt)
+    await invalidate_slots(r, reader_id, start_time, end_time)
+    await publish_events(r, [(reader_id, "appointment", _appointment_event(appt))])
     return {"booking_uid": appt.booking_uid, "start_time": appt.start_time, "end_time": appt.end_time, "price_cents": price_cents}
 
 @router.post("/{booking_uid}/cancel")
-async def cancel(booking_uid: str, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    appt = db.query(models.Appointment).filter(models.Appointment.booking_uid == booking_uid).one_or_none()
+async def cancel(booking_uid: str, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    appt = (await db.execute(select(models.Appointment).where(models.Appointment.booking_uid == booking_uid))).scalar_one_or_none()
     if not appt:
         raise HTTPException(404, 'Not found')
     if appt.client_id != user.id and user.role != 'admin' and user.id != appt.reader_id:
@@ -127,17 +142,19 @@ async def cancel(booking_uid: str, token=Depends(get_current_user_token), db: Se
     refund = appt.price_cents * refund_pct // 100
     if refund > 0:
         from ..services.wallet import credit
-        credit(db, appt.client_id, refund, ref_type='refund', ref_id=appt.booking_uid)
+        await credit(db, appt.client_id, refund, ref_type='refund', ref_id=appt.booking_uid)
     appt.status = 'canceled'
     db.add(appt)
-    db.commit()
+    await db.commit()
+    r = await get_async_redis()
+    await invalidate_slots(r, appt.reader_id, appt.start_time, appt.end_time)
+    await publish_events(r, [(user_id, "appointment", _appointment_event(appt)) for user_id in (appt.client_id, appt.reader_id) if user_id != user.id])
     return {"ok": True, "refund_cents": refund}
 
 @router.post("/{booking_uid}/start")
-async def start(booking_uid: str, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def start(booking_uid: str, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     # Either party can start at or after start_time
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    appt = db.query(models.Appointment).filter(models.Appointment.booking_uid == booking_uid).one_or_none()
+    appt = (await db.execute(select(models.Appointment).where(models.Appointment.booking_uid == booking_uid))).scalar_one_or_none()
     if not appt:
         raise HTTPException(404, 'Not found')
     if user.id not in {appt.client_id, appt.reader_id}:
@@ -148,7 +165,7 @@ async def start(booking_uid: str, token=Depends(get_current_user_token), db: Ses
     if appt.status not in {'scheduled','in_progress'}:
         raise HTTPException(400, 'Invalid state')
     # Create or reuse session
-    sess = db.query(models.Session).filter(models.Session.appointment_id == appt.id).one_or_none()
+    sess = (await db.execute(select(models.Session).where(models.Session.appointment_id == appt.id))).scalar_one_or_none()
     import secrets as _secrets
     if not sess:
         sess = models.Session(
@@ -164,6 +181,9 @@ async def start(booking_uid: str, token=Depends(get_current_user_token), db: Ses
         db.add(sess)
         appt.status = 'in_progress'
         db.add(appt)
-        db.commit()
-        db.refresh(sess)
+        await bump(db, sessions=1)
+        await db.commit()
+        await db.refresh(sess)
+        other = appt.reader_id if user.id == appt.client_id else appt.client_id
+        await publish_events(await get_async_redis(), [(other, "appointment", {**_appointment_event(appt), "session_uid": sess.session_uid})])
     return {"session_uid": sess.session_uid}
\ No newline at end of file
@@ -0,0 +1,45 @@
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from ..auth import verify_token
+from ..identity import resolve_user
+from ..redis_client import get_async_redis
+from ..services.events import latest_id, replay, user_hub, valid_event_id
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+@router.websocket("/ws")
+async def events_websocket(ws: WebSocket):
+    """The caller's realtime events. Pass ?token=... and, after a reconnect, ?last_event_id=..."""
+    token = ws.query_params.get('token')
+    if not token:
+        await ws.close(code=4401)
+        return
+    try:
+        payload = await verify_token(token)
+        user = await resolve_user(payload.get('sub'))
+        if not user:
+            await ws.close(code=4401)
+            return
+    except Exception:
+        await ws.close(code=4401)
+        return
+    await ws.accept()
+    r = await get_async_redis()
+    channel = str(user.id)
+    last_id = ws.query_params.get('last_event_id', '')
+    try:
+        if valid_event_id(last_id):
+            for last_id, data in await replay(r, user.id, last_id):
+                await ws.send_text(data)
+        else:
+            last_id = await latest_id(r, user.id)
+        outbox = await user_hub.join(channel, ws)
+        # Catch up on anything published between the replay above and joining the hub
+        for _, data in await replay(r, user.id, last_id):
+            outbox.offer(data)
+        while True:
+            # Nothing is expected from the client; reading just notices the disconnect
+            await ws.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await user_hub.leave(channel, ws)
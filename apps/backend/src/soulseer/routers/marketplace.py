@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from ..db import SessionLocal
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db import get_db
 from .. import models
-from ..auth import get_current_user_token
+from ..identity import CurrentUser, current_user
+from ..pagination import DEFAULT_LIMIT, paginate
+from ..services.catalog import MAX_PAGE_SIZE, PAGE_SIZE, PRODUCT_KINDS, catalog_page, refresh_products, sync_catalog
+from ..services.stats import bump
 from ..config import settings
 import stripe
 import secrets
@@ -10,84 +14,35 @@ import secrets
 router = APIRouter(prefix="/marketplace", tags=["marketplace"])
 stripe.api_key = settings.stripe_secret_key
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+CATALOG_MAX_AGE = 15  # seconds
 
 @router.post("/sync")
-async def sync_products(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def sync_products(user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     """Sync products from Stripe catalog"""
     # Admin only
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
     if user.email.lower() != settings.admin_email.lower():
         raise HTTPException(403, "Admin only")
-    
-    # Fetch from Stripe
-    products = stripe.Product.list(active=True, limit=100)
-    
-    for sp in products.data:
-        # Check if exists
-        existing = db.query(models.Product).filter(
-            models.Product.stripe_product_id == sp.id
-        ).one_or_none()
-        
-        # Get default price
-        prices = stripe.Price.list(product=sp.id, active=True, limit=1)
-        price_cents = prices.data[0].unit_amount if prices.data else 0
-        
-        if existing:
-            existing.name = sp.name
-            existing.active = sp.active
-            existing.description = sp.description or ""
-            existing.price_cents = price_cents
-            existing.image_url = sp.images[0] if sp.images else ""
-        else:
-            product = models.Product(
-                stripe_product_id=sp.id,
-                name=sp.name,
-                kind=sp.metadata.get('kind', 'digital'),
-                active=sp.active,
-                description=sp.description or "",
-                price_cents=price_cents,
-                image_url=sp.images[0] if sp.images else "",
-                stock_quantity=-1  # Unlimited by default
-            )
-            db.add(product)
-    
-    db.commit()
-    return {"ok": True}
+
+    return {"ok": True, **await sync_catalog(db)}
 
 @router.get("/products")
-async def list_products(kind: str = None, db: Session = Depends(get_db)):
-    query = db.query(models.Product).filter(models.Product.active == True)
-    if kind:
-        query = query.filter(models.Product.kind == kind)
-    
-    products = query.all()
-    return {
-        "items": [
-            {
-                "id": p.id,
-                "stripe_product_id": p.stripe_product_id,
-                "name": p.name,
-                "description": p.description,
-                "price_cents": p.price_cents,
-                "image_url": p.image_url,
-                "kind": p.kind,
-                "stock_quantity": p.stock_quantity,
-                "reader_id": p.reader_id
-            }
-            for p in products
-        ]
-    }
+async def list_products(request: Request, kind: str | None = None, cursor: str | None = None, limit: int = PAGE_SIZE, db: AsyncSession = Depends(get_db)):
+    if kind is not None and kind not in PRODUCT_KINDS:
+        raise HTTPException(400, "Invalid kind")
+    try:
+        after = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+    etag, body = await catalog_page(db, kind, after, max(1, min(limit, MAX_PAGE_SIZE)))
+    # Short shared caching absorbs storefront spikes; stock is re-checked at checkout
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={CATALOG_MAX_AGE}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
 @router.post("/checkout")
-async def create_checkout(payload: dict, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def create_checkout(payload: dict, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     """Create order and process payment"""
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
     items = payload.get('items', [])
     shipping_address = payload.get('shipping_address')
     
@@ -98,9 +53,7 @@ async def create_checkout(payload: dict, token=Depends(get_current_user_token),
     order_items = []
     
     for item in items:
-        product = db.query(models.Product).filter(
-            models.Product.id == item['product_id']
-        ).one_or_none()
+        product = await db.get(models.Product, item['product_id'])
         
         if not product or not product.active:
             raise HTTPException(404, f"Product {item['product_id']} not available")
@@ -121,7 +74,7 @@ async def create_checkout(payload: dict, token=Depends(get_current_user_token),
     # Debit wallet
     from ..services.wallet import debit
     try:
-        debit(db, user.id, total_cents, ref_type='order', ref_id='pending')
+        await debit(db, user.id, total_cents, ref_type='order', ref_id='pending')
     except:
         raise HTTPException(402, "Insufficient balance")
     
@@ -133,7 +86,8 @@ async def create_checkout(payload: dict, token=Depends(get_current_user_token),
         status='paid'
     )
     db.add(order)
-    db.flush()
+    await db.flush()
+    await bump(db, orders=1)
     
     # Add order items
     for oi in order_items:
@@ -145,15 +99,25 @@ async def create_checkout(payload: dict, token=Depends(get_current_user_token),
         )
         db.add(order_item)
         
-        # Update stock
+        # Take stock in one conditional UPDATE so concurrent checkouts can't oversell
         if oi['product'].stock_quantity != -1:
-            oi['product'].stock_quantity -= oi['quantity']
+            taken = await db.scalar(
+                update(models.Product)
+                .where(models.Product.id == oi['product'].id, models.Product.stock_quantity >= oi['quantity'])
+                .values(stock_quantity=models.Product.stock_quantity - oi['quantity'])
+                .returning(models.Product.id)
+                .execution_options(synchronize_session=False)
+            )
+            if taken is None:
+                name = oi['product'].name  # rollback expires the instance
+                await db.rollback()
+                raise HTTPException(400, f"Insufficient stock for {name}")
         
         # Credit reader if product belongs to one
         if oi['product'].reader_id:
             from ..services.billing import credit_reader
             reader_amount = oi['price_cents'] * oi['quantity'] * settings.reader_share_pct // 100
-            credit_reader(db, oi['product'].reader_id, reader_amount, ref_type='order', ref_id=order.order_uid)
+            await credit_reader(db, oi['product'].reader_id, reader_amount, ref_type='order', ref_id=order.order_uid)
     
     # Add shipping address if physical products
     if shipping_address and any(oi['product'].kind == 'physical' for oi in order_items):
@@ -169,15 +133,13 @@ async def create_checkout(payload: dict, token=Depends(get_current_user_token),
         )
         db.add(addr)
     
-    db.commit()
+    await db.commit()
+    await refresh_products(db, [oi['product'].id for oi in order_items if oi['product'].stock_quantity != -1])
     return {"order_uid": order.order_uid, "total_cents": total_cents}
 
 @router.get("/orders")
-async def list_orders(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    orders = db.query(models.Order).filter(
-        models.Order.buyer_id == user.id
-    ).order_by(models.Order.id.desc()).limit(50).all()
+async def list_orders(cursor: str | None = None, limit: int = DEFAULT_LIMIT, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    orders, next_cursor = await paginate(db, select(models.Order).where(models.Order.buyer_id == user.id), [models.Order.id], cursor, limit)
     
     return {
         "items": [
@@ -187,5 +149,6 @@ async def list_orders(token=Depends(get_current_user_token), db: Session = Depen
                 "status": o.status
             }
             for o in orders
-        ]
+        ],
+        "next_cursor": next_cursor,
     }
\ No newline at end of file
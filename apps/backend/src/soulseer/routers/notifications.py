@@ -1,24 +1,23 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from ..db import SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db import get_db
 from .. import models
-from ..auth import get_current_user_token
+from ..identity import CurrentUser, current_user
+from ..pagination import DEFAULT_LIMIT, paginate
+from ..redis_client import get_async_redis
+from ..services.notifications import mark_read as mark_notifications_read, unread_count as get_unread_count
 
 router = APIRouter(prefix="/notifications", tags=["notifications"])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 @router.get("/")
-async def list_notifications(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    notifs = db.query(models.Notification).filter(
-        models.Notification.user_id == user.id
-    ).order_by(models.Notification.created_at.desc()).limit(50).all()
+async def list_notifications(cursor: str | None = None, limit: int = DEFAULT_LIMIT, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    notifs, next_cursor = await paginate(
+        db,
+        select(models.Notification).where(models.Notification.user_id == user.id),
+        [models.Notification.created_at, models.Notification.id],
+        cursor, limit,
+    )
     
     return {
         "items": [
@@ -31,27 +30,33 @@ async def list_notifications(token=Depends(get_current_user_token), db: Session
                 "created_at": n.created_at
             }
             for n in notifs
-        ]
+        ],
+        "next_cursor": next_cursor,
     }
 
+@router.get("/unread_count")
+async def unread_count(user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    return {"unread": await get_unread_count(db, await get_async_redis(), user.id)}
+
+@router.post("/read-all")
+async def mark_all_read(up_to_id: int | None = None, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    # Everything unread, or only up to the newest item the client has shown
+    updated = await mark_notifications_read(db, await get_async_redis(), user.id, up_to_id=up_to_id)
+    return {"ok": True, "updated": updated}
+
 @router.post("/{notif_id}/read")
-async def mark_read(notif_id: int, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    notif = db.query(models.Notification).filter(
+async def mark_read(notif_id: int, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    exists = await db.scalar(select(models.Notification.id).where(
         models.Notification.id == notif_id,
         models.Notification.user_id == user.id
-    ).one_or_none()
-    
-    if not notif:
+    ))
+    if not exists:
         raise HTTPException(404, "Notification not found")
-    
-    notif.read = True
-    db.commit()
+    await mark_notifications_read(db, await get_async_redis(), user.id, ids=[notif_id])
     return {"ok": True}
 
 @router.post("/subscribe")
-async def subscribe_push(payload: dict, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
+async def subscribe_push(payload: dict, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     player_id = payload.get('player_id')
     device_type = payload.get('device_type', 'web')
     
@@ -59,9 +64,9 @@ async def subscribe_push(payload: dict, token=Depends(get_current_user_token), d
         raise HTTPException(400, "player_id required")
     
     # Check if already exists
-    existing = db.query(models.PushSubscription).filter(
+    existing = (await db.execute(select(models.PushSubscription).where(
         models.PushSubscription.player_id == player_id
-    ).one_or_none()
+    ))).scalar_one_or_none()
     
     if existing:
         existing.user_id = user.id
@@ -74,5 +79,5 @@ async def subscribe_push(payload: dict, token=Depends(get_current_user_token), d
         )
         db.add(sub)
     
-    db.commit()
+    await db.commit()
     return {"ok": True}
\ No newline at end of file
@@ -1,23 +1,17 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy.orm import Session
-from ..db import SessionLocal
+from sqlalchemy import select
+from ..db import AsyncSessionLocal
 from .. import models
 from ..auth import get_current_user_token
 from ..config import settings
 from ..services.wallet import credit
+from ..services.stats import bump
 import stripe
 
 stripe.api_key = settings.stripe_secret_key
 
 router = APIRouter(prefix="/payments", tags=["payments"])
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 @router.post("/topup/intents")
 async def create_topup_intent(payload: dict, token=Depends(get_current_user_token)):
     # Create a PaymentIntent for client wallet top-up
@@ -46,25 +40,24 @@ async def stripe_webhook(request: Request):
         amount = int(pi["amount"])  # cents
         clerk_user_id = pi["metadata"].get("clerk_user_id") if pi.get("metadata") else None
         if clerk_user_id:
-            db = SessionLocal()
-            try:
-                user = db.query(models.User).filter(models.User.clerk_user_id == clerk_user_id).one_or_none()
-                if user:
-                    credit(db, user.id, amount, ref_type="payment_intent", ref_id=pi["id"])
-                    db.commit()
-            finally:
-                db.close()
+            async with AsyncSessionLocal() as db:
+                user_id = await db.scalar(select(models.User.id).where(models.User.clerk_user_id == clerk_user_id))
+                if user_id:
+                    await credit(db, user_id, amount, ref_type="payment_intent", ref_id=pi["id"])
+                    await bump(db, revenue_transactions=1, revenue_cents=amount)
+                    await db.commit()
     elif event["type"] == "account.updated":
         acct = event["data"]["object"]
         account_id = acct["id"]
         details_submitted = acct.get("details_submitted", False)
-        db = SessionLocal()
-        try:
-            sa = db.query(models.StripeAccount).filter(models.StripeAccount.account_id == account_id).one_or_none()
+        async with AsyncSessionLocal() as db:
+            sa = (await db.execute(select(models.StripeAccount).where(models.StripeAccount.account_id == account_id))).scalar_one_or_none()
             if sa:
                 sa.details_submitted = bool(details_submitted)
                 db.add(sa)
-                db.commit()
-        finally:
-            db.close()
+                await db.commit()
+    elif event["type"].startswith(("product.", "price.")):
+        from ..services.catalog import apply_catalog_event
+        async with AsyncSessionLocal() as db:
+            await apply_catalog_event(db, event)
     return {"received": True}
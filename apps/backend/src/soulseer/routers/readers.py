@@ -1,88 +1,157 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from ..db import SessionLocal
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db import get_db
 from .. import models
-from ..auth import get_current_user_token
+from ..identity import CurrentUser, current_user
+from ..pagination import DEFAULT_LIMIT, paginate
+from ..services.analytics import parse_range, query_buckets
+from ..services.directory import MAX_PAGE_SIZE, PAGE_SIZE, READER_STATUSES, directory_page, refresh_reader
+from ..services.presence import MODES, online_readers, set_reader_presence
+from ..services.slots import MAX_DAYS, SLOT_LENGTHS, SLOT_MINUTES, invalidate_slots, parse_utc, reader_slots
+from ..redis_client import get_async_redis
 
 router = APIRouter(prefix="/readers", tags=["readers"]) 
 
-def get_db():
-    db = SessionLocal()
+@router.get("")
+async def list_readers(request: Request, status: str | None = None, cursor: str | None = None, limit: int = PAGE_SIZE, db: AsyncSession = Depends(get_db)):
+    if status is not None and status not in READER_STATUSES:
+        raise HTTPException(400, 'Invalid status')
     try:
-        yield db
-    finally:
-        db.close()
+        after = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(400, 'Invalid cursor')
+    etag, body = await directory_page(db, status, after, max(1, min(limit, MAX_PAGE_SIZE)))
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
 
-@router.get("")
-async def list_readers(db: Session = Depends(get_db)):
-    q = (
-        db.query(models.ReaderProfile, models.User)
-        .join(models.User, models.User.id == models.ReaderProfile.user_id)
-    )
-    items = []
-    for rp, u in q.all():
-        items.append({
-            "user_id": u.id,
-            "display_name": u.display_name or u.email.split('@')[0],
-            "avatar_url": rp.avatar_url,
-            "rate_chat_ppm": rp.rate_chat_ppm,
-            "rate_voice_ppm": rp.rate_voice_ppm,
-            "rate_video_ppm": rp.rate_video_ppm,
-            "status": rp.status,
-        })
-    return {"items": items}
+PROFILE_TEXT_FIELDS = ('bio', 'avatar_url')
+PROFILE_RATE_FIELDS = ('rate_chat_ppm', 'rate_voice_ppm', 'rate_video_ppm', 'rate_scheduled_15', 'rate_scheduled_30', 'rate_scheduled_45', 'rate_scheduled_60')
+
+@router.post("/me/profile")
+async def update_profile(payload: dict, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    if user.role != 'reader':
+        raise HTTPException(403, 'Readers only')
+    rp = (await db.execute(select(models.ReaderProfile).where(models.ReaderProfile.user_id == user.id))).scalar_one_or_none()
+    if not rp:
+        raise HTTPException(404, 'Reader profile not found')
+    for field in PROFILE_TEXT_FIELDS:
+        if field in payload:
+            setattr(rp, field, str(payload[field] or ''))
+    for field in PROFILE_RATE_FIELDS:
+        if field in payload:
+            rate = payload[field]
+            if not isinstance(rate, int) or rate < 0:
+                raise HTTPException(400, f'Invalid {field}')
+            setattr(rp, field, rate)
+    if 'status' in payload:
+        if payload['status'] not in READER_STATUSES:
+            raise HTTPException(400, 'Invalid status')
+        rp.status = payload['status']
+    await db.commit()
+    await refresh_reader(db, user.id)
+    if 'status' in payload:
+        await set_reader_presence(await get_async_redis(), user.id, rp.status)
+    return {"ok": True}
+
+@router.post("/me/presence")
+async def presence_heartbeat(payload: dict, user: CurrentUser = Depends(current_user)):
+    if user.role != 'reader':
+        raise HTTPException(403, 'Readers only')
+    status = payload.get('status') or ''
+    modes = payload.get('modes')
+    if status and status not in READER_STATUSES:
+        raise HTTPException(400, 'Invalid status')
+    if modes is not None and (not isinstance(modes, list) or any(m not in MODES for m in modes)):
+        raise HTTPException(400, 'Invalid modes')
+    await set_reader_presence(await get_async_redis(), user.id, status, modes)
+    return {"ok": True}
+
+@router.get("/online")
+async def list_online(mode: str | None = None, page: int = 0, limit: int = PAGE_SIZE):
+    if mode is not None and mode not in MODES:
+        raise HTTPException(400, 'Invalid mode')
+    ids, total = await online_readers(await get_async_redis(), max(page, 0), max(1, min(limit, MAX_PAGE_SIZE)), mode)
+    return {"items": ids, "total": total, "page": page}
 
 @router.post("/me/availability")
-async def add_availability(payload: dict, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
+async def add_availability(payload: dict, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     if user.role != 'reader':
         raise HTTPException(403, 'Readers only')
     start_str = payload.get('start_time')
     end_str = payload.get('end_time')
     tz = payload.get('timezone') or 'UTC'
-    from datetime import datetime
     try:
-        start_time = datetime.fromisoformat(start_str)
-        end_time = datetime.fromisoformat(end_str)
+        start_time = parse_utc(start_str)
+        end_time = parse_utc(end_str)
     except Exception:
         raise HTTPException(400, 'Invalid datetime')
     if end_time <= start_time:
         raise HTTPException(400, 'Invalid range')
     # prevent overlap with existing availability for same reader
-    overlap = db.query(models.AvailabilityBlock).filter(models.AvailabilityBlock.reader_id == user.id, models.AvailabilityBlock.start_time < end_time, models.AvailabilityBlock.end_time > start_time).count()
+    overlap = await db.scalar(select(models.AvailabilityBlock.id).where(models.AvailabilityBlock.reader_id == user.id, models.AvailabilityBlock.start_time < end_time, models.AvailabilityBlock.end_time > start_time).limit(1))
     if overlap:
         raise HTTPException(409, 'Overlaps with existing availability')
     ab = models.AvailabilityBlock(reader_id=user.id, start_time=start_time, end_time=end_time, timezone=tz)
     db.add(ab)
-    db.commit()
+    await db.commit()
+    await invalidate_slots(await get_async_redis(), user.id, start_time, end_time)
     return {"ok": True}
 
-@router.get("/{reader_id}/availability")
-async def get_availability(reader_id: int, start: str, end: str, db: Session = Depends(get_db)):
+MAX_SLOT_READERS = 100
+
+@router.get("/slots")
+async def list_slots(reader_ids: str, start: str, days: int = 7, length: int | None = None, db: AsyncSession = Depends(get_db)):
+    """Ready-to-book slot start times for several readers over whole UTC days."""
     from datetime import datetime
     try:
-        start_time = datetime.fromisoformat(start)
-        end_time = datetime.fromisoformat(end)
+        ids = sorted({int(i) for i in reader_ids.split(',') if i.strip()})
+        # A plain date or a full timestamp; either way the UTC day is used
+        first_day = parse_utc(start).date()
+    except ValueError:
+        raise HTTPException(400, 'Invalid reader_ids or start')
+    if not ids or len(ids) > MAX_SLOT_READERS:
+        raise HTTPException(400, f'Between 1 and {MAX_SLOT_READERS} readers')
+    if not 1 <= days <= MAX_DAYS:
+        raise HTTPException(400, f'days must be between 1 and {MAX_DAYS}')
+    if length is not None and length not in SLOT_LENGTHS:
+        raise HTTPException(400, 'Invalid length')
+    lengths = [length] if length else SLOT_LENGTHS
+    slots = await reader_slots(db, await get_async_redis(), ids, first_day, days, lengths, not_before=datetime.utcnow())
+    return {
+        "slot_minutes": SLOT_MINUTES,
+        "readers": {
+            str(reader_id): {str(n): [s.isoformat() for s in starts] for n, starts in by_length.items()}
+            for reader_id, by_length in slots.items()
+        },
+    }
+
+@router.get("/{reader_id}/availability")
+async def get_availability(reader_id: int, start: str, end: str, db: AsyncSession = Depends(get_db)):
+    try:
+        start_time = parse_utc(start)
+        end_time = parse_utc(end)
     except Exception:
         raise HTTPException(400, 'Invalid date range')
-    blocks = db.query(models.AvailabilityBlock).filter(models.AvailabilityBlock.reader_id == reader_id, models.AvailabilityBlock.start_time < end_time, models.AvailabilityBlock.end_time > start_time).all()
+    blocks = (await db.execute(select(models.AvailabilityBlock).where(models.AvailabilityBlock.reader_id == reader_id, models.AvailabilityBlock.start_time < end_time, models.AvailabilityBlock.end_time > start_time))).scalars().all()
     # subtract existing appointments
-    appts = db.query(models.Appointment).filter(models.Appointment.reader_id == reader_id, models.Appointment.status.in_(['scheduled','in_progress']), models.Appointment.start_time < end_time, models.Appointment.end_time > start_time).all()
+    appts = (await db.execute(select(models.Appointment).where(models.Appointment.reader_id == reader_id, models.Appointment.status.in_(['scheduled','in_progress']), models.Appointment.start_time < end_time, models.Appointment.end_time > start_time))).scalars().all()
     return {
         "blocks": [{"start_time": b.start_time, "end_time": b.end_time, "timezone": b.timezone} for b in blocks],
         "booked": [{"start_time": a.start_time, "end_time": a.end_time} for a in appts]
     }
 
 @router.get("/me/balance")
-async def my_balance(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    rb = db.query(models.ReaderBalance).filter(models.ReaderBalance.user_id == user.id).one_or_none()
+async def my_balance(user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    rb = (await db.execute(select(models.ReaderBalance).where(models.ReaderBalance.user_id == user.id))).scalar_one_or_none()
     if not rb:
         rb = models.ReaderBalance(user_id=user.id, balance_cents=0)
         db.add(rb)
-        db.commit()
-        db.refresh(rb)
-    sa = db.query(models.StripeAccount).filter(models.StripeAccount.user_id == user.id).one_or_none()
+        await db.commit()
+        await db.refresh(rb)
+    sa = (await db.execute(select(models.StripeAccount).where(models.StripeAccount.user_id == user.id))).scalar_one_or_none()
     return {
         "balance_cents": rb.balance_cents,
         "stripe": {
@@ -92,14 +161,12 @@ async def my_balance(token=Depends(get_current_user_token), db: Session = Depend
     }
 
 @router.get("/me/ledger")
-async def my_ledger(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    rows = (
-        db.query(models.ReaderLedgerEntry)
-        .filter(models.ReaderLedgerEntry.reader_id == user.id)
-        .order_by(models.ReaderLedgerEntry.created_at.desc())
-        .limit(50)
-        .all()
+async def my_ledger(cursor: str | None = None, limit: int = DEFAULT_LIMIT, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    rows, next_cursor = await paginate(
+        db,
+        select(models.ReaderLedgerEntry).where(models.ReaderLedgerEntry.reader_id == user.id),
+        [models.ReaderLedgerEntry.created_at, models.ReaderLedgerEntry.id],
+        cursor, limit,
     )
     items = [
         {
@@ -111,4 +178,12 @@ async def my_ledger(token=Depends(get_current_user_token), db: Session = Depends
         }
         for r in rows
     ]
-    return {"items": items}
+    return {"items": items, "next_cursor": next_cursor}
+
+@router.get("/me/earnings")
+async def my_earnings(start: str, end: str, granularity: str = "day", user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    if user.role != 'reader':
+        raise HTTPException(403, 'Readers only')
+    start_at, end_at = parse_range(granularity, start, end)
+    items = await query_buckets(db, granularity, start_at, end_at, {"source": "reader", "reader_id": user.id}, ["ref_type", "kind"])
+    return {"granularity": granularity, "items": items}
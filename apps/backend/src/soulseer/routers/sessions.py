@@ -1,42 +1,34 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from ..db import SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db import get_db
 from .. import models
 from ..auth import get_current_user_token
+from ..identity import CurrentUser, current_user
+from ..services.events import notification_event, publish_events
+from ..services.presence import set_reader_presence
+from ..services.stats import bump
 from datetime import datetime
 from fastapi import Request
 from ..config import settings
-from redis import Redis
+from ..redis_client import get_async_redis
 import secrets
 
 router = APIRouter(prefix="/sessions", tags=["sessions"]) 
 
-redis_client: Redis | None = None
-
-def get_redis() -> Redis:
-    global redis_client
-    if redis_client is None:
-        redis_client = Redis.from_url(settings.redis_url, decode_responses=True)
-    return redis_client
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def _get_session(db: AsyncSession, session_uid: str) -> models.Session | None:
+    return (await db.execute(select(models.Session).where(models.Session.session_uid == session_uid))).scalar_one_or_none()
 
 @router.get("/incoming")
-async def incoming(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def incoming(user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     # For reader: list requested sessions
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get("sub")).one()
-    q = db.query(models.Session).filter(models.Session.reader_id == user.id, models.Session.status == 'requested')
-    items = [{"session_uid": s.session_uid, "mode": s.mode, "client_id": s.client_id} for s in q.all()]
+    q = select(models.Session).where(models.Session.reader_id == user.id, models.Session.status == 'requested')
+    items = [{"session_uid": s.session_uid, "mode": s.mode, "client_id": s.client_id} for s in (await db.execute(q)).scalars()]
     return {"items": items}
 
 @router.get("/{session_uid}")
-async def get_session(session_uid: str, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    sess = db.query(models.Session).filter(models.Session.session_uid == session_uid).one_or_none()
+async def get_session(session_uid: str, token=Depends(get_current_user_token), db: AsyncSession = Depends(get_db)):
+    sess = await _get_session(db, session_uid)
     if not sess:
         raise HTTPException(404, "Not found")
     return {
@@ -50,12 +42,11 @@ async def get_session(session_uid: str, token=Depends(get_current_user_token), d
     }
 
 @router.post("/request")
-async def request_session(payload: dict, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def request_session(payload: dict, client_user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     reader_id = int(payload.get("reader_id"))
     mode = payload.get("mode")
     if mode not in {"chat","voice","video"}:
         raise HTTPException(400, "Invalid mode")
-    client_user = db.query(models.User).filter(models.User.clerk_user_id == token.get("sub")).one()
     session = models.Session(
         session_uid=secrets.token_urlsafe(12),
         reader_id=reader_id,
@@ -64,22 +55,24 @@ async def request_session(payload: dict, token=Depends(get_current_user_token),
         status="requested"
     )
     db.add(session)
-    db.commit()
-    db.refresh(session)
     # Send notification to reader
-    from ..services.notifications import notify_session_request
-    import asyncio
-    asyncio.create_task(notify_session_request(db, reader_id, session.session_uid))
-    # Notify reader via Redis channel
-    r = get_redis()
-    r.publish(f"user_notify:{reader_id}", f"new_session:{session.session_uid}")
+    from ..services.notifications import adjust_unread, notify_session_request
+    notif = await notify_session_request(db, reader_id, session.session_uid)
+    await bump(db, sessions=1)
+    await db.commit()
+    r = await get_async_redis()
+    await adjust_unread(r, {reader_id: 1})
+    # Reader's realtime channel
+    await publish_events(r, [
+        (reader_id, "session_request", {"session_uid": session.session_uid, "mode": mode, "client_id": client_user.id}),
+        (reader_id, "notification", notification_event(notif)),
+    ])
     return {"session_uid": session.session_uid, "status": session.status}
 
 @router.post("/{session_uid}/accept")
-async def accept_session(session_uid: str, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def accept_session(session_uid: str, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     # Reader accepts
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get("sub")).one()
-    sess = db.query(models.Session).filter(models.Session.session_uid == session_uid).one_or_none()
+    sess = await _get_session(db, session_uid)
     if not sess:
         raise HTTPException(404, "Not found")
     if user.role != "reader" or user.id != sess.reader_id:
@@ -87,13 +80,19 @@ async def accept_session(session_uid: str, token=Depends(get_current_user_token)
     sess.status = "active"
     sess.started_at = datetime.utcnow()
     db.add(sess)
-    db.commit()
+    await db.commit()
+    await set_reader_presence(await get_async_redis(), sess.reader_id, "busy")
+    await publish_events(await get_async_redis(), [(sess.client_id, "session_update", {"session_uid": sess.session_uid, "status": sess.status})])
+    if settings.billing_mode == 'metered' and sess.per_minute:
+        from ..services.metering import start_metering
+        rp = (await db.execute(select(models.ReaderProfile).where(models.ReaderProfile.user_id == sess.reader_id))).scalar_one()
+        rate = rp.rate_chat_ppm if sess.mode == 'chat' else rp.rate_voice_ppm if sess.mode == 'voice' else rp.rate_video_ppm
+        await start_metering(db, await get_async_redis(), sess, rate)
     return {"ok": True}
 
 @router.post("/{session_uid}/reject")
-async def reject_session(session_uid: str, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get("sub")).one()
-    sess = db.query(models.Session).filter(models.Session.session_uid == session_uid).one_or_none()
+async def reject_session(session_uid: str, user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
+    sess = await _get_session(db, session_uid)
     if not sess:
         raise HTTPException(404, "Not found")
     if user.role != "reader" or user.id != sess.reader_id:
@@ -103,21 +102,23 @@ async def reject_session(session_uid: str, token=Depends(get_current_user_token)
     sess.status = "canceled"
     sess.ended_at = datetime.utcnow()
     db.add(sess)
-    db.commit()
+    await db.commit()
+    await publish_events(await get_async_redis(), [(sess.client_id, "session_update", {"session_uid": sess.session_uid, "status": sess.status})])
     return {"ok": True}
 
 @router.post("/{session_uid}/end")
-async def end_session(session_uid: str, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def end_session(session_uid: str, token=Depends(get_current_user_token), db: AsyncSession = Depends(get_db)):
     # Either party can end
-    sess = db.query(models.Session).filter(models.Session.session_uid == session_uid).one_or_none()
+    sess = await _get_session(db, session_uid)
     if not sess:
         raise HTTPException(404, "Not found")
+    was_active = sess.status == "active"
     sess.status = "ended"
     sess.ended_at = datetime.utcnow()
     db.add(sess)
     # If scheduled appointment, credit reader now
     if sess.appointment_id and not sess.per_minute:
-        appt = db.query(models.Appointment).filter(models.Appointment.id == sess.appointment_id).one_or_none()
+        appt = await db.get(models.Appointment, sess.appointment_id)
         if appt and appt.status in {'scheduled','in_progress'}:
             appt.status = 'completed'
             db.add(appt)
@@ -126,6 +127,15 @@ async def end_session(session_uid: str, token=Depends(get_current_user_token), d
             from ..config import settings as _settings
             reader_share = _settings.reader_share_pct
             amount = appt.price_cents * reader_share // 100
-            credit_reader(db, sess.reader_id, amount, ref_type='appointment', ref_id=appt.booking_uid)
-    db.commit()
+            await credit_reader(db, sess.reader_id, amount, ref_type='appointment', ref_id=appt.booking_uid)
+    await db.commit()
+    if was_active:
+        await set_reader_presence(await get_async_redis(), sess.reader_id, "online")
+    await publish_events(await get_async_redis(), [
+        (user_id, "session_update", {"session_uid": sess.session_uid, "status": sess.status})
+        for user_id in (sess.client_id, sess.reader_id)
+    ])
+    if settings.billing_mode == 'metered' and sess.per_minute:
+        from ..services.metering import stop_metering
+        await stop_metering(await get_async_redis(), sess.session_uid)
     return {"ok": True}
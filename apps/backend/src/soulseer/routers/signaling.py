@@ -1,24 +1,18 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from jose import jwt
-from ..auth import get_jwks
-from redis.asyncio import Redis as AsyncRedis
+from ..auth import verify_token
+from ..redis_client import get_async_redis
+from ..realtime import ChannelHub
 from ..config import settings
-from ..db import SessionLocal
-from .. import models
-from typing import Dict, Any
+from ..identity import resolve_user
+from ..services.metering import meter_tick, METER_EXHAUSTED
+from ..services.presence import set_reader_presence
 import json
 from ..config import settings
 
 router = APIRouter(prefix="/signaling", tags=["signaling"]) 
-aredis: AsyncRedis | None = None
-async def get_async_redis():
-    global aredis
-    if aredis is None:
-        aredis = AsyncRedis.from_url(settings.redis_url, decode_responses=True)
-    return aredis
 
-# In-memory connections per session (prod: use Redis pubsub or connection manager)
-session_peers: Dict[str, set[WebSocket]] = {}
+# Signaling messages fan out to every process that has a peer of the session
+signaling_hub = ChannelHub("signal")
 
 @router.websocket("/ws/{session_uid}")
 async def websocket_endpoint(ws: WebSocket, session_uid: str):
@@ -29,32 +23,22 @@ async def websocket_endpoint(ws: WebSocket, session_uid: str):
         return
     # Verify token
     try:
-        jwks = await get_jwks()
-        header = jwt.get_unverified_header(token)
-        kid = header.get("kid")
-        key = next((k for k in jwks["keys"] if k["kid"] == kid), None)
-        payload = jwt.decode(token, key, algorithms=[key["alg"]], audience=None, options={"verify_aud": False})
-        clerk_id = payload.get('sub')
+        payload = await verify_token(token)
         # map to numeric user id
-        db = SessionLocal()
-        try:
-            u = db.query(models.User).filter(models.User.clerk_user_id == clerk_id).one_or_none()
-            if not u:
-                await ws.close(code=4401)
-                return
-            user_id = u.id
-        finally:
-            db.close()
+        user = await resolve_user(payload.get('sub'))
+        if not user:
+            await ws.close(code=4401)
+            return
+        user_id = user.id
     except Exception:
         await ws.close(code=4401)
         return
     await ws.accept()
-    peers = session_peers.setdefault(session_uid, set())
     r = await get_async_redis()
     # Presence key for this user
     presence_key = f"session:{session_uid}:user:{user_id}"
     await r.set(presence_key, "1", ex=15)
-    peers.add(ws)
+    await signaling_hub.join(session_uid, ws)
     try:
         while True:
             data = await ws.receive_text()
@@ -62,21 +46,22 @@ async def websocket_endpoint(ws: WebSocket, session_uid: str):
             if msg.get('type') == 'heartbeat':
                 # refresh presence
                 await r.expire(presence_key, 15)
+                if user.role == 'reader':
+                    await set_reader_presence(r, user_id)
+                if settings.billing_mode == 'metered':
+                    state, balance_cents = await meter_tick(r, session_uid)
+                    if state == METER_EXHAUSTED:
+                        ended = json.dumps({"type": "session_ended", "reason": "insufficient_funds"})
+                        await signaling_hub.publish(session_uid, ended)
                 continue
-            # Broadcast to other peers in the same session
-            for peer in list(peers):
-                if peer is not ws:
-                    try:
-                        await peer.send_text(json.dumps(msg))
-                    except Exception:
-                        pass
+            # Relay to the other peers in the same session
+            await signaling_hub.publish(session_uid, data, origin=ws)
     except WebSocketDisconnect:
-        peers.remove(ws)
-        if not peers:
-            session_peers.pop(session_uid, None)
+        pass
+    finally:
+        await signaling_hub.leave(session_uid, ws)
         # clear presence
         try:
-            r2 = await get_async_redis()
-            await r2.delete(presence_key)
+            await r.delete(presence_key)
         except Exception:
             pass
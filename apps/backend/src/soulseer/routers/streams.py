@@ -1,37 +1,27 @@
 from fastapi import APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
-from sqlalchemy.orm import Session
-from ..db import SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..db import get_db
 from .. import models
-from ..auth import get_current_user_token
+from ..identity import CurrentUser, current_user
+from ..services.stats import bump
 from datetime import datetime
 import secrets
 import json
-from typing import Dict, Set
-from redis.asyncio import Redis as AsyncRedis
+from ..realtime import ChannelHub, ViewerCounts
+from ..redis_client import get_async_redis
+from ..services.events import publish_events
 from ..config import settings
 
 router = APIRouter(prefix="/streams", tags=["streams"])
 
-# Stream viewer connections
-stream_viewers: Dict[str, Set[WebSocket]] = {}
-
-aredis: AsyncRedis | None = None
-async def get_async_redis():
-    global aredis
-    if aredis is None:
-        aredis = AsyncRedis.from_url(settings.redis_url, decode_responses=True)
-    return aredis
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Stream viewer connections; chat and gifts fan out across processes
+stream_hub = ChannelHub("stream")
+viewer_counts = ViewerCounts(stream_hub, interval=settings.stream_viewer_count_interval)
 
 @router.get("")
-async def list_streams(db: Session = Depends(get_db)):
-    q = db.query(models.Session).filter(models.Session.mode == "stream", models.Session.status == "active")
+async def list_streams(db: AsyncSession = Depends(get_db)):
+    q = select(models.Session).where(models.Session.mode == "stream", models.Session.status == "active")
     items = [
         {
             "session_uid": s.session_uid,
@@ -39,22 +29,21 @@ async def list_streams(db: Session = Depends(get_db)):
             "started_at": s.started_at,
             "status": s.status,
         }
-        for s in q.all()
+        for s in (await db.execute(q)).scalars()
     ]
     return {"items": items}
 
 @router.post("/start")
-async def start_stream(token=Depends(get_current_user_token), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
+async def start_stream(user: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     if user.role != 'reader':
         raise HTTPException(403, 'Only readers can start streams')
     
     # Check if already streaming
-    existing = db.query(models.Session).filter(
+    existing = (await db.execute(select(models.Session).where(
         models.Session.reader_id == user.id,
         models.Session.mode == 'stream',
         models.Session.status == 'active'
-    ).first()
+    ).limit(1))).scalar_one_or_none()
     
     if existing:
         return {"session_uid": existing.session_uid}
@@ -70,13 +59,14 @@ async def start_stream(token=Depends(get_current_user_token), db: Session = Depe
         per_minute=False
     )
     db.add(sess)
-    db.commit()
-    db.refresh(sess)
+    await bump(db, sessions=1)
+    await db.commit()
+    await db.refresh(sess)
     return {"session_uid": sess.session_uid}
 
 @router.get("/gifts")
-async def list_gifts(db: Session = Depends(get_db)):
-    gifts = db.query(models.Gift).filter(models.Gift.active == True).all()
+async def list_gifts(db: AsyncSession = Depends(get_db)):
+    gifts = (await db.execute(select(models.Gift).where(models.Gift.active == True))).scalars().all()
     return {
         "items": [
             {
@@ -90,38 +80,35 @@ async def list_gifts(db: Session = Depends(get_db)):
     }
 
 @router.post("/{session_uid}/gift")
-async def send_gift(session_uid: str, payload: dict, token=Depends(get_current_user_token), db: Session = Depends(get_db)):
+async def send_gift(session_uid: str, payload: dict, sender: CurrentUser = Depends(current_user), db: AsyncSession = Depends(get_db)):
     gift_id = int(payload.get('gift_id'))
     
     # Verify session exists and is a stream
-    sess = db.query(models.Session).filter(
+    sess = (await db.execute(select(models.Session).where(
         models.Session.session_uid == session_uid,
         models.Session.mode == 'stream',
         models.Session.status == 'active'
-    ).one_or_none()
+    ))).scalar_one_or_none()
     
     if not sess:
         raise HTTPException(404, 'Stream not found')
     
     # Get gift
-    gift = db.query(models.Gift).filter(models.Gift.id == gift_id).one_or_none()
+    gift = await db.get(models.Gift, gift_id)
     if not gift:
         raise HTTPException(404, 'Gift not found')
     
-    # Get sender
-    sender = db.query(models.User).filter(models.User.clerk_user_id == token.get('sub')).one()
-    
     # Debit sender wallet
     from ..services.wallet import debit
     try:
-        debit(db, sender.id, gift.price_cents, ref_type='gift', ref_id=f'stream:{session_uid}')
+        await debit(db, sender.id, gift.price_cents, ref_type='gift', ref_id=f'stream:{session_uid}')
     except Exception:
         raise HTTPException(402, 'Insufficient balance')
     
     # Credit reader (70% share)
     from ..services.billing import credit_reader
     reader_amount = gift.price_cents * settings.reader_share_pct // 100
-    credit_reader(db, sess.reader_id, reader_amount, ref_type='gift', ref_id=f'stream:{session_uid}')
+    await credit_reader(db, sess.reader_id, reader_amount, ref_type='gift', ref_id=f'stream:{session_uid}')
     
     # Record gift
     stream_gift = models.StreamGift(
@@ -131,22 +118,23 @@ async def send_gift(session_uid: str, payload: dict, token=Depends(get_current_u
         amount_cents=gift.price_cents
     )
     db.add(stream_gift)
-    db.commit()
-    
-    # Broadcast gift event to viewers
-    if session_uid in stream_viewers:
-        gift_event = json.dumps({
-            "type": "gift",
-            "sender": sender.display_name or sender.email.split('@')[0],
-            "gift_name": gift.name,
-            "gift_image": gift.image_url
-        })
-        for ws in stream_viewers[session_uid]:
-            try:
-                import asyncio
-                asyncio.create_task(ws.send_text(gift_event))
-            except:
-                pass
+    await db.commit()
+    
+    # Broadcast gift event to viewers on every process
+    gift_event = json.dumps({
+        "type": "gift",
+        "sender": sender.display_name or sender.email.split('@')[0],
+        "gift_name": gift.name,
+        "gift_image": gift.image_url
+    })
+    await stream_hub.publish(session_uid, gift_event)
+    await publish_events(await get_async_redis(), [(sess.reader_id, "gift", {
+        "session_uid": session_uid,
+        "sender_id": sender.id,
+        "gift_name": gift.name,
+        "amount_cents": gift.price_cents,
+        "reader_amount_cents": reader_amount,
+    })])
     
     return {"ok": True}
 
@@ -154,44 +142,20 @@ async def send_gift(session_uid: str, payload: dict, token=Depends(get_current_u
 async def stream_websocket(ws: WebSocket, session_uid: str):
     await ws.accept()
     
-    # Add to viewers
-    if session_uid not in stream_viewers:
-        stream_viewers[session_uid] = set()
-    stream_viewers[session_uid].add(ws)
-    
-    # Send current viewer count
-    viewer_count = len(stream_viewers[session_uid])
-    await ws.send_text(json.dumps({"type": "viewers", "count": viewer_count}))
-    
-    # Broadcast viewer count to all
-    for viewer in stream_viewers[session_uid]:
-        try:
-            await viewer.send_text(json.dumps({"type": "viewers", "count": viewer_count}))
-        except:
-            pass
+    # Add to viewers; the count goes out with the next coalesced update
+    await stream_hub.join(session_uid, ws)
+    viewer_counts.joined(session_uid)
     
     try:
         while True:
             data = await ws.receive_text()
             msg = json.loads(data)
             
-            # Broadcast chat messages
+            # Broadcast chat messages as received; serialized once for all viewers
             if msg.get('type') == 'chat':
-                for viewer in stream_viewers[session_uid]:
-                    if viewer != ws:
-                        try:
-                            await viewer.send_text(json.dumps(msg))
-                        except:
-                            pass
+                await stream_hub.publish(session_uid, data, origin=ws)
     except WebSocketDisconnect:
-        stream_viewers[session_uid].remove(ws)
-        if not stream_viewers[session_uid]:
-            del stream_viewers[session_uid]
-        else:
-            # Update viewer count
-            viewer_count = len(stream_viewers[session_uid])
-            for viewer in stream_viewers[session_uid]:
-                try:
-                    await viewer.send_text(json.dumps({"type": "viewers", "count": viewer_count}))
-                except:
-                    pass
+        pass
+    finally:
+        await stream_hub.leave(session_uid, ws)
+        viewer_counts.left(session_uid)
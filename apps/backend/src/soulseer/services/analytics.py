@@ -0,0 +1,171 @@
+"""Hourly and daily revenue, earnings and session-minute rollups.
+
+`rollup_analytics` folds new rows from the client ledger, the reader ledger and ended
+sessions into the analytics_hourly and analytics_daily fact tables, keyed by reader,
+session mode, ref_type and kind. Each source keeps a high-water mark in
+analytics_watermarks that advances in the same transaction as the upserts, so every row
+is counted exactly once. Rows are picked up only after ROLLUP_LAG so transactions still
+in flight have committed by then.
+"""
+from fastapi import HTTPException
+from sqlalchemy import Date, and_, cast, func, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from .. import models
+
+ROLLUP_LAG = timedelta(minutes=2)
+ROLLUP_BATCH = 50_000
+GRANULARITIES = {"hour": (models.AnalyticsHourly, timedelta(days=31)), "day": (models.AnalyticsDaily, timedelta(days=366))}
+DIMENSIONS = ("source", "reader_id", "mode", "ref_type", "kind")
+FACT_COLUMNS = ["bucket", *DIMENSIONS, "amount_cents", "entries", "seconds"]
+
+
+def _session_join(ref_type, ref_id):
+    return and_(ref_type == 'session', models.Session.session_uid == ref_id)
+
+
+def _client_ledger(lo: int, hi: int):
+    L = models.LedgerEntry
+    return (
+        select(
+            L.created_at.label("ts"),
+            func.coalesce(models.Session.reader_id, 0).label("reader_id"),
+            func.coalesce(models.Session.mode, '').label("mode"),
+            L.ref_type, L.kind, L.amount_cents,
+            literal(0).label("seconds"),
+        )
+        .select_from(L)
+        .outerjoin(models.Session, _session_join(L.ref_type, L.ref_id))
+        .where(L.id > lo, L.id <= hi)
+        .subquery()
+    )
+
+
+def _reader_ledger(lo: int, hi: int):
+    R = models.ReaderLedgerEntry
+    return (
+        select(
+            R.created_at.label("ts"),
+            R.reader_id,
+            func.coalesce(models.Session.mode, '').label("mode"),
+            R.ref_type, R.kind, R.amount_cents,
+            literal(0).label("seconds"),
+        )
+        .select_from(R)
+        .outerjoin(models.Session, _session_join(R.ref_type, R.ref_id))
+        .where(R.id > lo, R.id <= hi)
+        .subquery()
+    )
+
+
+def _ended_sessions(after: datetime | None, until: datetime):
+    S = models.Session
+    q = select(
+        S.ended_at.label("ts"),
+        S.reader_id,
+        S.mode,
+        literal('session').label("ref_type"),
+        literal('ended').label("kind"),
+        S.amount_charged_cents.label("amount_cents"),
+        S.total_seconds.label("seconds"),
+    ).where(S.status == 'ended', S.ended_at <= until)
+    if after is not None:
+        q = q.where(S.ended_at > after)
+    return q.subquery()
+
+
+def _fold(db: Session, source: str, base):
+    """Aggregate `base` into both fact tables."""
+    for model, bucket in (
+        (models.AnalyticsHourly, func.date_trunc('hour', base.c.ts)),
+        (models.AnalyticsDaily, cast(func.date_trunc('day', base.c.ts), Date)),
+    ):
+        dims = [bucket, literal(source), base.c.reader_id, base.c.mode, base.c.ref_type, base.c.kind]
+        stmt = pg_insert(model).from_select(
+            FACT_COLUMNS,
+            select(*dims, func.sum(base.c.amount_cents), func.count(), func.sum(base.c.seconds)).group_by(*dims),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[model.bucket, *[getattr(model, d) for d in DIMENSIONS]],
+            set_={
+                "amount_cents": model.amount_cents + stmt.excluded.amount_cents,
+                "entries": model.entries + stmt.excluded.entries,
+                "seconds": model.seconds + stmt.excluded.seconds,
+            },
+        )
+        db.execute(stmt)
+
+
+def _watermark(db: Session, source: str) -> models.AnalyticsWatermark:
+    db.execute(pg_insert(models.AnalyticsWatermark).values(source=source, last_id=0, updated_at=datetime.utcnow()).on_conflict_do_nothing())
+    # Row lock keeps overlapping rollup runs from counting the same batch twice
+    return db.execute(select(models.AnalyticsWatermark).where(models.AnalyticsWatermark.source == source).with_for_update()).scalar_one()
+
+
+def _rollup_by_id(db: Session, source: str, table, build, cutoff: datetime) -> int:
+    rolled = 0
+    while True:
+        wm = _watermark(db, source)
+        lo = wm.last_id
+        top = db.scalar(select(func.max(table.id)).where(table.id > lo, table.created_at <= cutoff))
+        if top is None:
+            db.rollback()
+            return rolled
+        hi = min(top, lo + ROLLUP_BATCH)
+        _fold(db, source, build(lo, hi))
+        wm.last_id = hi
+        db.commit()
+        rolled += hi - lo
+        if hi == top:
+            return rolled
+
+
+def rollup_analytics(db: Session) -> dict:
+    cutoff = datetime.utcnow() - ROLLUP_LAG
+    result = {
+        "client": _rollup_by_id(db, "client", models.LedgerEntry, _client_ledger, cutoff),
+        "reader": _rollup_by_id(db, "reader", models.ReaderLedgerEntry, _reader_ledger, cutoff),
+    }
+    wm = _watermark(db, "session")
+    _fold(db, "session", _ended_sessions(wm.last_ts, cutoff))
+    wm.last_ts = cutoff
+    db.commit()
+    return result
+
+
+def parse_range(granularity: str, start: str, end: str) -> tuple[datetime, datetime]:
+    if granularity not in GRANULARITIES:
+        raise HTTPException(400, "granularity must be hour or day")
+    try:
+        start_at, end_at = datetime.fromisoformat(start), datetime.fromisoformat(end)
+    except ValueError:
+        raise HTTPException(400, "Invalid date range")
+    if end_at <= start_at or end_at - start_at > GRANULARITIES[granularity][1]:
+        raise HTTPException(400, f"Range must be positive and at most {GRANULARITIES[granularity][1].days} days for {granularity} buckets")
+    return start_at, end_at
+
+
+async def query_buckets(db: AsyncSession, granularity: str, start: datetime, end: datetime, filters: dict, group_by: list[str]) -> list[dict]:
+    """Summed facts per bucket (and per `group_by` dimension) in [start, end)."""
+    model = GRANULARITIES[granularity][0]
+    if granularity == "day":
+        start, end = start.date(), end.date()
+    cols = [model.bucket, *[getattr(model, d) for d in group_by]]
+    rows = (await db.execute(
+        select(*cols, func.sum(model.amount_cents), func.sum(model.entries), func.sum(model.seconds))
+        .where(model.bucket >= start, model.bucket < end, *[getattr(model, d) == v for d, v in filters.items() if v is not None])
+        .group_by(*cols)
+        .order_by(*cols)
+    )).all()
+    return [
+        {
+            "bucket": row[0].isoformat(),
+            **dict(zip(group_by, row[1:len(cols)])),
+            "amount_cents": int(row[-3]),
+            "entries": int(row[-2]),
+            "seconds": int(row[-1]),
+        }
+        for row in rows
+    ]
@@ -1,38 +1,232 @@
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Integer, case, column, func, insert, select, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from redis import Redis
+from datetime import datetime
+from collections import defaultdict
 from .. import models
-from ..services.wallet import debit
 from ..config import settings
 
 READER_SHARE = settings.reader_share_pct  # percent
 PLATFORM_SHARE = 100 - READER_SHARE
 
+PRESENCE_MGET_CHUNK = 1000
+MAX_BACKFILL_MINUTES = 10  # a longer outage isn't billed blind; presence is only known now
 
-def get_or_create_reader_balance(db: Session, reader_id: int) -> models.ReaderBalance:
-    rb = db.query(models.ReaderBalance).filter(models.ReaderBalance.user_id == reader_id).one_or_none()
-    if not rb:
-        rb = models.ReaderBalance(user_id=reader_id, balance_cents=0)
-        db.add(rb)
-        db.flush()
-    return rb
-
-
-def credit_reader(db: Session, reader_id: int, amount_cents: int, ref_type: str, ref_id: str):
-    rb = get_or_create_reader_balance(db, reader_id)
-    rb.balance_cents += amount_cents
-    db.add(models.ReaderLedgerEntry(reader_id=reader_id, kind='credit', amount_cents=amount_cents, ref_type=ref_type, ref_id=ref_id))
-
-
-def bill_one_minute(db: Session, sess: models.Session, rate_cents: int):
-    """Debit client balance and split to reader/platform. Returns True if billed, False if insufficient funds."""
-    try:
-        debit(db, sess.client_id, rate_cents, ref_type='session', ref_id=sess.session_uid)
-    except Exception:
-        return False
-    # reader share
-    reader_amount = rate_cents * READER_SHARE // 100
-    credit_reader(db, sess.reader_id, reader_amount, ref_type='session', ref_id=sess.session_uid)
-    # accumulate on session
-    sess.total_seconds += 60
-    sess.amount_charged_cents += rate_cents
-    db.add(sess)
-    return True
\ No newline at end of file
+
+async def credit_reader(db: AsyncSession, reader_id: int, amount_cents: int, ref_type: str, ref_id: str) -> int:
+    """Add to the reader's balance, creating it on first use. Returns the new balance."""
+    now = datetime.utcnow()
+    stmt = pg_insert(models.ReaderBalance).values(user_id=reader_id, balance_cents=amount_cents, updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.ReaderBalance.user_id],
+        set_={"balance_cents": models.ReaderBalance.balance_cents + stmt.excluded.balance_cents, "updated_at": stmt.excluded.updated_at},
+    ).returning(models.ReaderBalance.balance_cents)
+    balance = (await db.execute(stmt)).scalar_one()
+    db.add(models.ReaderLedgerEntry(reader_id=reader_id, kind='credit', amount_cents=amount_cents, ref_type=ref_type, ref_id=ref_id, created_at=now))
+    return balance
+
+
+def session_rate_column():
+    """Per-minute rate for a session's mode, resolved against ReaderProfile in SQL."""
+    return case(
+        (models.Session.mode == 'chat', models.ReaderProfile.rate_chat_ppm),
+        (models.Session.mode == 'voice', models.ReaderProfile.rate_voice_ppm),
+        else_=models.ReaderProfile.rate_video_ppm,
+    )
+
+
+def fetch_presence(r: Redis, rows) -> list[bool]:
+    """Return, per row, whether both client and reader are present. One pipelined round trip."""
+    keys = []
+    for row in rows:
+        keys.append(f'session:{row.session_uid}:user:{row.client_id}')
+        keys.append(f'session:{row.session_uid}:user:{row.reader_id}')
+    pipe = r.pipeline(transaction=False)
+    for i in range(0, len(keys), PRESENCE_MGET_CHUNK):
+        pipe.mget(keys[i:i + PRESENCE_MGET_CHUNK])
+    flat = [v for chunk in pipe.execute() for v in chunk] if keys else []
+    return [bool(flat[2 * i] and flat[2 * i + 1]) for i in range(len(rows))]
+
+
+def session_shard_column(shard_count: int):
+    """Stable shard number of a session, computed from a hash of session_uid."""
+    return func.hashtext(models.Session.session_uid).op('&')(0x7FFFFFFF) % shard_count
+
+
+def elapsed_minutes(last_minute: int, last_fence: int, minute: int, fence: int) -> int:
+    """Minutes a claim of `minute` under `fence` has to bill; 0 when the claim is rejected.
+
+    Everything after `last_minute` up to `minute` is owed, so a tick that never ran, or
+    whose retries ran out, is billed by the next successful claim. A late run of a minute
+    that is already covered bills nothing. Catch-up is capped at MAX_BACKFILL_MINUTES.
+    """
+    if minute <= last_minute or fence <= last_fence:
+        return 0
+    return min(minute - last_minute, MAX_BACKFILL_MINUTES)
+
+
+def claim_shard_minute(db: Session, shard: int, minute: int, fence: int) -> int:
+    """Record that `shard` is billing up to `minute` under lease token `fence`.
+
+    Returns how many minutes to bill (see `elapsed_minutes`), or 0 if this minute was
+    already covered or a newer lease holder has written since. The shard row stays
+    locked and the claim commits with the billing statements, so a crashed run leaves
+    its minutes unclaimed for the next one.
+    """
+    S = models.BillingShardState
+    now = datetime.utcnow()
+    db.execute(pg_insert(S).values(shard=shard, last_minute=minute - 1, fence=0, updated_at=now).on_conflict_do_nothing())
+    state = db.execute(select(S.last_minute, S.fence).where(S.shard == shard).with_for_update()).one()
+    minutes = elapsed_minutes(state.last_minute, state.fence, minute, fence)
+    if minutes:
+        db.execute(update(S).where(S.shard == shard).values(last_minute=minute, fence=fence, updated_at=now))
+    return minutes
+
+
+def fund_sessions(balances: dict[int, int], owed: list[tuple[str, int, int]]) -> set[str]:
+    """Session uids the clients' balances can pay for. `owed` holds (session_uid, client_id,
+    amount); each client's sessions are taken in session_uid order against a running
+    balance, and a session that doesn't fit is skipped."""
+    left = dict(balances)
+    covered = set()
+    for session_uid, client_id, amount in sorted(owed):
+        if left.get(client_id, 0) >= amount:
+            left[client_id] -= amount
+            covered.add(session_uid)
+    return covered
+
+
+def bill_active_sessions(db: Session, r: Redis, shard: int | None = None, shard_count: int = 1, minutes: int = 1) -> dict:
+    """Bill `minutes` minutes for every active per-minute session with both parties present.
+
+    Works in a constant number of statements regardless of session count: one join to
+    resolve rates, one wallet lock, one conditional wallet UPDATE, multi-row ledger
+    INSERTs, one reader balance upsert and two session UPDATEs. A client's sessions are
+    paid in session_uid order from a running balance (see `fund_sessions`); only those
+    the balance can't cover are ended. When `shard` is given only that shard's sessions are
+    billed. When catching up on several minutes, a session is never billed for more
+    minutes than it has been running. Caller commits.
+    """
+    q = (
+        select(
+            models.Session.id,
+            models.Session.session_uid,
+            models.Session.client_id,
+            models.Session.reader_id,
+            models.Session.started_at,
+            session_rate_column().label('rate'),
+        )
+        .join(models.ReaderProfile, models.ReaderProfile.user_id == models.Session.reader_id)
+        .where(models.Session.status == 'active', models.Session.per_minute == True)
+    )
+    if shard is not None:
+        q = q.where(session_shard_column(shard_count) == shard)
+    rows = db.execute(q).all()
+    if not rows:
+        return {"billed": 0, "ended": 0}
+    present = fetch_presence(r, rows)
+    due = [row for row, ok in zip(rows, present) if ok and row.rate > 0]
+    if not due:
+        return {"billed": 0, "ended": 0}
+
+    now = datetime.utcnow()
+    billable = {
+        row.id: min(minutes, max(1, int((now - (row.started_at or now)).total_seconds()) // 60))
+        for row in due
+    }
+    owed = {row.id: row.rate * billable[row.id] for row in due}
+
+    # Cover each client's sessions in session_uid order against their locked balance, then
+    # debit each client once for the sessions covered; the UPDATE re-checks the balance.
+    clients = sorted({row.client_id for row in due})
+    balances = dict(db.execute(
+        select(models.Wallet.user_id, models.Wallet.balance_cents)
+        .where(models.Wallet.user_id.in_(clients))
+        .order_by(models.Wallet.user_id)
+        .with_for_update()
+    ).all())
+    covered = fund_sessions(balances, [(row.session_uid, row.client_id, owed[row.id]) for row in due])
+    per_client: dict[int, int] = defaultdict(int)
+    for row in due:
+        if row.session_uid in covered:
+            per_client[row.client_id] += owed[row.id]
+    funded = set()
+    if per_client:
+        debits = values(column('user_id', Integer), column('amount', Integer), name='debits').data(list(per_client.items()))
+        funded = set(db.execute(
+            update(models.Wallet)
+            .where(models.Wallet.user_id == debits.c.user_id, models.Wallet.balance_cents >= debits.c.amount)
+            .values(balance_cents=models.Wallet.balance_cents - debits.c.amount, updated_at=now)
+            .returning(models.Wallet.user_id)
+            .execution_options(synchronize_session=False)
+        ).scalars())
+
+    billed = [row for row in due if row.session_uid in covered and row.client_id in funded]
+    unfunded = [row.id for row in due if not (row.session_uid in covered and row.client_id in funded)]
+    if billed:
+        db.execute(insert(models.LedgerEntry), [
+            {"user_id": row.client_id, "kind": 'debit', "amount_cents": owed[row.id], "ref_type": 'session', "ref_id": row.session_uid, "created_at": now}
+            for row in billed
+        ])
+        apply_session_charges(db, [
+            {"session_id": row.id, "session_uid": row.session_uid, "reader_id": row.reader_id, "amount_cents": owed[row.id], "seconds": 60 * billable[row.id]}
+            for row in billed
+        ], now)
+    if unfunded:
+        end_sessions(db, unfunded, now)
+    return {"billed": len(billed), "ended": len(unfunded)}
+
+
+def apply_session_charges(db: Session, charges: list[dict], now: datetime):
+    """Credit readers and accumulate totals for already-debited session charges.
+
+    Each charge carries session_id, session_uid, reader_id, amount_cents and seconds.
+    Reader ledger rows go in as one multi-row INSERT, balances as one upsert and the
+    session accumulators as one UPDATE ... FROM VALUES.
+    """
+    if not charges:
+        return
+    credits = [(c, c["amount_cents"] * READER_SHARE // 100) for c in charges]
+    credits = [(c, amount) for c, amount in credits if amount > 0]
+    if credits:
+        db.execute(insert(models.ReaderLedgerEntry), [
+            {"reader_id": c["reader_id"], "kind": 'credit', "amount_cents": amount, "ref_type": 'session', "ref_id": c["session_uid"], "created_at": now}
+            for c, amount in credits
+        ])
+        per_reader: dict[int, int] = defaultdict(int)
+        for c, amount in credits:
+            per_reader[c["reader_id"]] += amount
+        upsert = pg_insert(models.ReaderBalance).values([
+            {"user_id": reader_id, "balance_cents": amount, "updated_at": now}
+            for reader_id, amount in per_reader.items()
+        ])
+        db.execute(upsert.on_conflict_do_update(
+            index_elements=[models.ReaderBalance.user_id],
+            set_={
+                "balance_cents": models.ReaderBalance.balance_cents + upsert.excluded.balance_cents,
+                "updated_at": upsert.excluded.updated_at,
+            },
+        ))
+    totals = values(
+        column('id', Integer), column('amount', Integer), column('seconds', Integer), name='totals'
+    ).data([(c["session_id"], c["amount_cents"], c["seconds"]) for c in charges])
+    db.execute(
+        update(models.Session)
+        .where(models.Session.id == totals.c.id)
+        .values(
+            total_seconds=models.Session.total_seconds + totals.c.seconds,
+            amount_charged_cents=models.Session.amount_charged_cents + totals.c.amount,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def end_sessions(db: Session, session_ids: list[int], now: datetime):
+    db.execute(
+        update(models.Session)
+        .where(models.Session.id.in_(session_ids))
+        .values(status='ended', ended_at=func.coalesce(models.Session.ended_at, now))
+        .execution_options(synchronize_session=False)
+    )
@@ -0,0 +1,298 @@
+"""Stripe product catalog sync.
+
+A full sync walks every product page with the default price expanded inline (one API
+call per 100 products), then upserts the whole catalog with INSERT ... ON CONFLICT
+(stripe_product_id) in a few large statements. Products no longer in Stripe are
+deactivated. Day-to-day changes arrive as product.* / price.* webhooks and touch only
+the affected rows; price events re-read the product they belong to. Each row keeps
+Stripe's `updated` time, and an upsert never overwrites newer data, so late or repeated
+webhook deliveries are harmless.
+
+The storefront reads a cached projection of the active catalog: every product is
+serialized once into a Redis hash that each process mirrors in memory. A full rebuild
+bumps the version counter and makes every process reload the hash. Webhooks and checkout
+stock changes instead rewrite just the products they touch and record them in a change
+log under a sequence number, so processes fetch only those entries. Pages are memoized
+until the next change with their ETag, so serving the catalog costs one Redis round trip
+and no database work.
+"""
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple
+from bisect import bisect_right
+import asyncio
+import hashlib
+import orjson
+import stripe
+from .. import models
+from ..redis_client import get_async_redis
+
+UPSERT_BATCH = 2000
+SYNCED_COLUMNS = ("name", "kind", "active", "description", "price_cents", "image_url", "stripe_price_id", "stripe_updated_at")
+CATALOG_KEY = "products:catalog"
+CATALOG_VERSION_KEY = "products:catalog:version"
+CATALOG_SEQ_KEY = "products:catalog:seq"
+CATALOG_CHANGES_KEY = "products:catalog:changes"
+CATALOG_CHANGES_FLOOR_KEY = "products:catalog:changes:floor"
+CATALOG_CHANGES_KEPT = 10000
+REBUILD_LOCK_KEY = "products:catalog:rebuild"
+PRODUCT_KINDS = ("digital", "physical", "service")
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_CACHED_PAGES = 1024
+
+# KEYS: catalog hash, seq counter, change log, change log floor, version counter
+# ARGV: change log entries to keep, then product id / entry pairs ('' removes the product)
+# Patches entries in place and logs them under a new sequence number. Does nothing while
+# there is no projection; the next reader rebuilds it from Postgres.
+REFRESH_LUA = """
+if redis.call('EXISTS', KEYS[5]) == 0 then return 0 end
+local seq = redis.call('INCR', KEYS[2])
+for i = 2, #ARGV, 2 do
+  if ARGV[i + 1] == '' then
+    redis.call('HDEL', KEYS[1], ARGV[i])
+  else
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+  end
+  redis.call('ZADD', KEYS[3], seq, ARGV[i])
+end
+local floor = seq - tonumber(ARGV[1])
+if floor > 0 and redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', floor) > 0 then
+  redis.call('SET', KEYS[4], floor)
+end
+return seq
+"""
+
+# (version, change log seq, [(product_id, kind, entry json)] ordered by product_id)
+_projection: Tuple[str | None, int, List[Tuple[int, str, bytes]]] = (None, 0, [])
+# (kind, after, limit) -> (etag, body) for the current projection
+_pages: Dict[tuple, Tuple[str, bytes]] = {}
+
+
+def product_row(sp: Any, price: Any = None) -> Dict[str, Any]:
+    """Product columns from a Stripe product; `price` overrides an unexpanded default_price."""
+    default_price = price if price is not None else sp.get("default_price")
+    price_id = default_price if isinstance(default_price, str) else default_price.get("id") if default_price else None
+    return {
+        "stripe_product_id": sp["id"],
+        "name": sp.get("name") or "",
+        "kind": (sp.get("metadata") or {}).get("kind", "digital"),
+        "active": bool(sp.get("active")),
+        "description": sp.get("description") or "",
+        "price_cents": (default_price.get("unit_amount") or 0) if default_price and not isinstance(default_price, str) else 0,
+        "image_url": sp["images"][0] if sp.get("images") else "",
+        "stock_quantity": -1,  # Unlimited by default
+        "stripe_price_id": price_id,
+        "stripe_updated_at": datetime.utcfromtimestamp(sp["updated"]) if sp.get("updated") else None,
+    }
+
+
+async def upsert_products(db: AsyncSession, rows: List[Dict[str, Any]]) -> List[int]:
+    """Upsert rows; returns the ids of products actually inserted or changed."""
+    P = models.Product
+    ids = []
+    for i in range(0, len(rows), UPSERT_BATCH):
+        stmt = pg_insert(P).values(rows[i:i + UPSERT_BATCH])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[P.stripe_product_id],
+            set_={c: stmt.excluded[c] for c in SYNCED_COLUMNS},
+            where=(P.stripe_updated_at.is_(None)) | (stmt.excluded.stripe_updated_at.is_(None)) | (stmt.excluded.stripe_updated_at >= P.stripe_updated_at),
+        )
+        ids += (await db.execute(stmt.returning(P.id))).scalars().all()
+    return ids
+
+
+def _fetch_all() -> List[Dict[str, Any]]:
+    pages = stripe.Product.list(limit=100, expand=["data.default_price"])
+    return [product_row(sp) for sp in pages.auto_paging_iter()]
+
+
+async def sync_catalog(db: AsyncSession) -> dict:
+    """Full sync of every Stripe product. Commits."""
+    rows = await asyncio.to_thread(_fetch_all)
+    await upsert_products(db, rows)
+    seen = [row["stripe_product_id"] for row in rows]
+    missing = await db.execute(
+        update(models.Product)
+        .where(models.Product.active == True, ~models.Product.stripe_product_id.in_(seen))
+        .values(active=False)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    await rebuild_catalog(db)
+    return {"synced": len(rows), "deactivated": missing.rowcount}
+
+
+async def apply_catalog_event(db: AsyncSession, event: Any) -> bool:
+    """Apply a product.* or price.* webhook. Returns False for other event types. Commits."""
+    kind, obj = event["type"], event["data"]["object"]
+    P = models.Product
+    if kind in ("product.created", "product.updated"):
+        price = None
+        if isinstance(obj.get("default_price"), str):
+            price = await asyncio.to_thread(stripe.Price.retrieve, obj["default_price"])
+        ids = await upsert_products(db, [product_row(obj, price)])
+    elif kind == "product.deleted":
+        ids = (await db.execute(
+            update(P).where(P.stripe_product_id == obj["id"]).values(active=False).returning(P.id)
+            .execution_options(synchronize_session=False)
+        )).scalars().all()
+    elif kind in ("price.created", "price.updated"):
+        # Only matters when it's a product's default price. The product is re-read so the
+        # upsert's freshness check applies and a late delivery can't restore an old amount
+        stripe_ids = (await db.execute(select(P.stripe_product_id).where(P.stripe_price_id == obj["id"]))).scalars().all()
+        products = await asyncio.gather(*(
+            asyncio.to_thread(stripe.Product.retrieve, stripe_id, expand=["default_price"]) for stripe_id in stripe_ids
+        ))
+        ids = await upsert_products(db, [product_row(sp) for sp in products])
+    else:
+        return False
+    await db.commit()
+    await refresh_products(db, ids)
+    return True
+
+
+def _serialize(p: models.Product) -> bytes:
+    return orjson.dumps({
+        "id": p.id,
+        "stripe_product_id": p.stripe_product_id,
+        "name": p.name,
+        "description": p.description,
+        "price_cents": p.price_cents,
+        "image_url": p.image_url,
+        "kind": p.kind,
+        "stock_quantity": p.stock_quantity,
+        "reader_id": p.reader_id,
+    })
+
+
+async def rebuild_catalog(db: AsyncSession):
+    """Reload every active product from Postgres. Used after a full sync or when the cache is missing."""
+    products = (await db.execute(select(models.Product).where(models.Product.active == True))).scalars().all()
+    r = await get_async_redis()
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(CATALOG_KEY)
+    if products:
+        pipe.hset(CATALOG_KEY, mapping={str(p.id): _serialize(p) for p in products})
+    pipe.incr(CATALOG_VERSION_KEY)
+    await pipe.execute()
+
+
+async def refresh_products(db: AsyncSession, product_ids: Iterable[int]):
+    """Re-project products after their price, stock or active flag changed; call after commit.
+    Only the touched entries change, so other processes don't reload the whole catalog."""
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+    products = (await db.execute(
+        select(models.Product).where(models.Product.id.in_(product_ids)).execution_options(populate_existing=True)
+    )).scalars().all()
+    products = {p.id: p for p in products}
+    args: List[Any] = [CATALOG_CHANGES_KEPT]
+    for product_id in sorted(product_ids):
+        p = products.get(product_id)
+        args += [str(product_id), _serialize(p) if p is not None and p.active else ""]
+    r = await get_async_redis()
+    await r.register_script(REFRESH_LUA)(
+        keys=[CATALOG_KEY, CATALOG_SEQ_KEY, CATALOG_CHANGES_KEY, CATALOG_CHANGES_FLOOR_KEY, CATALOG_VERSION_KEY],
+        args=args,
+    )
+
+
+def _entry(product_id: int, data: str) -> Tuple[int, str, bytes]:
+    raw = data.encode()
+    return product_id, orjson.loads(raw)["kind"], raw
+
+
+def _patch(entries: List[Tuple[int, str, bytes]], changed: Dict[int, str | None]) -> List[Tuple[int, str, bytes]]:
+    entries = list(entries)
+    for product_id, data in changed.items():
+        i = bisect_right(entries, product_id - 1, key=lambda e: e[0])
+        present = i < len(entries) and entries[i][0] == product_id
+        if data is None:
+            if present:
+                del entries[i]
+        elif present:
+            entries[i] = _entry(product_id, data)
+        else:
+            entries.insert(i, _entry(product_id, data))
+    return entries
+
+
+async def _load(db: AsyncSession) -> List[Tuple[int, str, bytes]]:
+    global _projection
+    r = await get_async_redis()
+    cached_version, cached_seq, entries = _projection
+    pipe = r.pipeline(transaction=True)
+    pipe.get(CATALOG_VERSION_KEY)
+    pipe.get(CATALOG_SEQ_KEY)
+    pipe.get(CATALOG_CHANGES_FLOOR_KEY)
+    pipe.zrangebyscore(CATALOG_CHANGES_KEY, f"({cached_seq}", "+inf")
+    version, seq, floor, changed = await pipe.execute()
+    seq, floor = int(seq or 0), int(floor or 0)
+    if version is not None and version == cached_version:
+        if seq == cached_seq:
+            return entries
+        if cached_seq >= floor:
+            # Only some entries changed; fetch just those
+            if changed:
+                data = await r.hmget(CATALOG_KEY, changed)
+                entries = _patch(entries, {int(product_id): d for product_id, d in zip(changed, data)})
+            _projection = (version, seq, entries)
+            _pages.clear()
+            return entries
+    if version is None:
+        # One process rebuilds; the rest wait briefly for it instead of all querying Postgres
+        if await r.set(REBUILD_LOCK_KEY, "1", nx=True, ex=30):
+            try:
+                await rebuild_catalog(db)
+            finally:
+                await r.delete(REBUILD_LOCK_KEY)
+        else:
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if await r.exists(CATALOG_VERSION_KEY):
+                    break
+            else:
+                # Still no projection: serve straight from Postgres and leave it uncached
+                products = (await db.execute(select(models.Product).where(models.Product.active == True).order_by(models.Product.id))).scalars().all()
+                entries = [(p.id, p.kind, _serialize(p)) for p in products]
+                _projection = (None, 0, entries)
+                _pages.clear()
+                return entries
+    pipe = r.pipeline(transaction=True)
+    pipe.get(CATALOG_VERSION_KEY)
+    pipe.get(CATALOG_SEQ_KEY)
+    pipe.hgetall(CATALOG_KEY)
+    version, seq, raw = await pipe.execute()
+    entries = sorted(_entry(int(product_id), data) for product_id, data in raw.items())
+    _projection = (version, int(seq or 0), entries)
+    _pages.clear()
+    return entries
+
+
+async def catalog_page(db: AsyncSession, kind: str | None, after: int, limit: int) -> Tuple[str, bytes]:
+    """Return (etag, JSON body) for active products with id > `after`, optionally of one kind."""
+    entries = await _load(db)
+    key = (kind, after, limit)
+    page = _pages.get(key)
+    if page is not None:
+        return page
+    items = []
+    next_cursor = None
+    for product_id, product_kind, data in entries[bisect_right(entries, after, key=lambda e: e[0]):]:
+        if kind and product_kind != kind:
+            continue
+        if len(items) == limit:
+            next_cursor = str(last_id)
+            break
+        items.append(data)
+        last_id = product_id
+    body = b'{"items":[' + b','.join(items) + b'],"next_cursor":' + orjson.dumps(next_cursor) + b'}'
+    etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    if len(_pages) >= MAX_CACHED_PAGES:
+        _pages.clear()
+    _pages[key] = (etag, body)
+    return etag, body
@@ -0,0 +1,122 @@
+"""Cached projection of the public reader directory.
+
+Each reader's directory entry is serialized once and kept in a Redis hash, and a version
+counter is bumped whenever an entry changes. Every process holds the entries in memory
+and reloads them only when the version moves, so a directory page costs one Redis GET
+and no database work. Pages are built from the pre-serialized entries and memoized per
+version along with their ETag.
+"""
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import Dict, List, Tuple
+from bisect import bisect_right
+import hashlib
+import orjson
+from .. import models
+from ..redis_client import get_async_redis
+
+DIRECTORY_KEY = "readers:directory"
+VERSION_KEY = "readers:directory:version"
+
+READER_STATUSES = ("offline", "online", "busy")
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_CACHED_PAGES = 1024
+
+# (version, [(reader_id, status, entry json)] ordered by reader_id)
+_projection: Tuple[str | None, List[Tuple[int, str, bytes]]] = (None, [])
+# (status, after, limit) -> (etag, body) for the current version
+_pages: Dict[tuple, Tuple[str, bytes]] = {}
+
+
+def _directory_query():
+    # A demoted reader keeps their profile but leaves the directory
+    return (
+        select(models.ReaderProfile, models.User)
+        .join(models.User, models.User.id == models.ReaderProfile.user_id)
+        .where(models.User.role == 'reader')
+    )
+
+
+def _serialize(rp: models.ReaderProfile, u: models.User) -> bytes:
+    return orjson.dumps({
+        "user_id": u.id,
+        "display_name": u.display_name or u.email.split('@')[0],
+        "avatar_url": rp.avatar_url,
+        "rate_chat_ppm": rp.rate_chat_ppm,
+        "rate_voice_ppm": rp.rate_voice_ppm,
+        "rate_video_ppm": rp.rate_video_ppm,
+        "status": rp.status,
+    })
+
+
+async def rebuild_directory(db: AsyncSession):
+    """Reload every entry from Postgres. Used when the cache is missing."""
+    entries = {str(u.id): _serialize(rp, u) for rp, u in (await db.execute(_directory_query())).all()}
+    r = await get_async_redis()
+    pipe = r.pipeline(transaction=True)
+    pipe.delete(DIRECTORY_KEY)
+    if entries:
+        pipe.hset(DIRECTORY_KEY, mapping=entries)
+    pipe.incr(VERSION_KEY)
+    await pipe.execute()
+
+
+async def refresh_reader(db: AsyncSession, reader_id: int):
+    """Re-project one reader after their profile, rates, status or role changed."""
+    row = (await db.execute(_directory_query().where(models.ReaderProfile.user_id == reader_id))).first()
+    r = await get_async_redis()
+    pipe = r.pipeline(transaction=True)
+    if row is None:
+        pipe.hdel(DIRECTORY_KEY, str(reader_id))
+    else:
+        pipe.hset(DIRECTORY_KEY, str(reader_id), _serialize(*row))
+    pipe.incr(VERSION_KEY)
+    await pipe.execute()
+
+
+async def _load(db: AsyncSession) -> List[Tuple[int, str, bytes]]:
+    global _projection
+    r = await get_async_redis()
+    version = await r.get(VERSION_KEY)
+    if version is not None and version == _projection[0]:
+        return _projection[1]
+    if version is None:
+        await rebuild_directory(db)
+    pipe = r.pipeline(transaction=True)
+    pipe.get(VERSION_KEY)
+    pipe.hgetall(DIRECTORY_KEY)
+    version, raw = await pipe.execute()
+    entries = []
+    for reader_id, data in raw.items():
+        data = data.encode()
+        entries.append((int(reader_id), orjson.loads(data)["status"], data))
+    entries.sort(key=lambda e: e[0])
+    _projection = (version, entries)
+    _pages.clear()
+    return entries
+
+
+async def directory_page(db: AsyncSession, status: str | None, after: int, limit: int) -> Tuple[str, bytes]:
+    """Return (etag, JSON body) for readers with id > `after`, optionally filtered by status."""
+    entries = await _load(db)
+    key = (status, after, limit)
+    page = _pages.get(key)
+    if page is not None:
+        return page
+    items = []
+    next_cursor = None
+    for reader_id, reader_status, data in entries[bisect_right(entries, after, key=lambda e: e[0]):]:
+        if status and reader_status != status:
+            continue
+        if len(items) == limit:
+            next_cursor = str(last_id)
+            break
+        items.append(data)
+        last_id = reader_id
+    body = b'{"items":[' + b','.join(items) + b'],"next_cursor":' + orjson.dumps(next_cursor) + b'}'
+    etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+    if len(_pages) >= MAX_CACHED_PAGES:
+        _pages.clear()
+    _pages[key] = (etag, body)
+    return etag, body
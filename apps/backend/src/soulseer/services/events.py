@@ -0,0 +1,74 @@
+"""Per-user realtime events: session requests, notifications, gifts, appointment changes.
+
+Each event is appended to the user's capped Redis stream and fanned out live through
+`user_hub`. The stream entry id is the event id, so a client that reconnects with the
+last id it saw gets the missed events replayed from the stream before live delivery
+resumes. Replay and live delivery can overlap by a few events around a reconnect;
+clients drop ids they have already seen. If the requested id has already been trimmed
+from the stream the client gets a `resync` event and should reload over REST.
+"""
+from redis.asyncio import Redis as AsyncRedis
+from typing import Iterable, List, Tuple
+import json
+import re
+from ..realtime import ChannelHub
+from .. import models
+
+EVENT_HISTORY = 500  # events kept per user for replay
+EVENT_TTL_SECONDS = 24 * 3600
+
+_EVENT_ID = re.compile(r"^\d+-\d+$")
+
+user_hub = ChannelHub("user")
+
+
+def event_key(user_id: int) -> str:
+    return f"events:{user_id}"
+
+
+def frame(event_id: str, type: str, data: dict) -> str:
+    return json.dumps({"id": event_id, "type": type, "data": data}, default=str)
+
+
+def notification_event(n: models.Notification) -> dict:
+    return {"id": n.id, "title": n.title, "body": n.body, "type": n.type, "read": n.read, "created_at": n.created_at}
+
+
+async def publish_events(r: AsyncRedis, events: Iterable[Tuple[int, str, dict]]):
+    """Record and deliver (user_id, type, data) events; call after the change commits."""
+    events = list(events)
+    if not events:
+        return
+    pipe = r.pipeline(transaction=False)
+    for user_id, type, data in events:
+        pipe.xadd(event_key(user_id), {"type": type, "data": json.dumps(data, default=str)}, maxlen=EVENT_HISTORY, approximate=True)
+        pipe.expire(event_key(user_id), EVENT_TTL_SECONDS)
+    ids = (await pipe.execute())[::2]
+    for (user_id, type, data), event_id in zip(events, ids):
+        await user_hub.publish(str(user_id), frame(event_id, type, data), redis=r)
+
+
+def _id_tuple(event_id: str) -> Tuple[int, int]:
+    ms, seq = event_id.split("-")
+    return int(ms), int(seq)
+
+
+def valid_event_id(event_id: str) -> bool:
+    return bool(_EVENT_ID.match(event_id or ""))
+
+
+async def latest_id(r: AsyncRedis, user_id: int) -> str:
+    entries = await r.xrevrange(event_key(user_id), "+", "-", count=1)
+    return entries[0][0] if entries else "0-0"
+
+
+async def replay(r: AsyncRedis, user_id: int, last_id: str) -> List[Tuple[str, str]]:
+    """(id, frame) for every event after `last_id`, oldest first."""
+    key = event_key(user_id)
+    oldest = await r.xrange(key, "-", "+", count=1)
+    if last_id != "0-0" and oldest and _id_tuple(oldest[0][0]) > _id_tuple(last_id):
+        # Events between last_id and the oldest one kept may have been trimmed
+        latest = await latest_id(r, user_id)
+        return [(latest, frame(latest, "resync", {}))]
+    entries = await r.xrange(key, f"({last_id}", "+", count=EVENT_HISTORY)
+    return [(event_id, frame(event_id, fields["type"], json.loads(fields["data"]))) for event_id, fields in entries]
@@ -0,0 +1,52 @@
+"""Redis lease locks with monotonically increasing fencing tokens.
+
+A lease only keeps other workers out while it is held; a worker that stalls past the
+lease TTL can still wake up and write. Callers must therefore pass the returned token
+to the storage they write to and have it reject tokens older than the last one seen.
+"""
+from redis import Redis
+
+# KEYS: lock, fence counter. ARGV: ttl ms
+ACQUIRE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token, 'PX', ARGV[1])
+return token
+"""
+
+# KEYS: lock. ARGV: token
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+# KEYS: fence counter. ARGV: minimum token
+ADVANCE_LUA = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then redis.call('SET', KEYS[1], ARGV[1]) end
+return current
+"""
+
+
+def lock_key(name: str) -> str:
+    return f"lease:{name}"
+
+
+def fence_key(name: str) -> str:
+    return f"lease:{name}:fence"
+
+
+def acquire_lease(r: Redis, name: str, ttl_ms: int) -> int | None:
+    """Take the lease if free. Returns the fencing token, or None if someone else holds it."""
+    token = int(r.register_script(ACQUIRE_LUA)(keys=[lock_key(name), fence_key(name)], args=[ttl_ms]))
+    return token or None
+
+
+def release_lease(r: Redis, name: str, token: int) -> bool:
+    """Release the lease only if it is still ours."""
+    return bool(r.register_script(RELEASE_LUA)(keys=[lock_key(name)], args=[token]))
+
+
+def advance_fence(r: Redis, name: str, token: int):
+    """Make sure future tokens are greater than `token`, e.g. after Redis lost its counter."""
+    r.register_script(ADVANCE_LUA)(keys=[fence_key(name)], args=[token])
@@ -0,0 +1,289 @@
+"""Redis-resident per-second metering for live sessions.
+
+While a metered session is active the client's spendable balance lives in Redis and is
+debited atomically by a Lua script on every heartbeat. Amounts are tracked in units of
+1/60 cent so a per-minute rate in cents is exactly the per-second cost in units.
+`settle_metered_sessions` writes accumulated totals back to Postgres in batches.
+
+Other spends from a metered wallet (gifts, orders, bookings) reserve their amount from
+the Redis balance first, so they can't also spend what the session has already used.
+"""
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Integer, column, insert, select, update, values
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+from datetime import datetime
+from collections import defaultdict
+from .. import models
+from ..config import settings
+from .billing import apply_session_charges, end_sessions
+
+UNITS_PER_CENT = 60
+SETTLE_BATCH = 1000
+
+ACTIVE_KEY = "meter:active"
+
+# meter_tick results
+METER_INACTIVE = 0
+METER_ACTIVE = 1
+METER_EXHAUSTED = 2
+
+
+def session_key(session_uid: str) -> str:
+    return f"meter:session:{session_uid}"
+
+
+def wallet_key(client_id: int) -> str:
+    return f"meter:wallet:{client_id}"
+
+
+def wallet_sessions_key(client_id: int) -> str:
+    return f"meter:wallet:{client_id}:sessions"
+
+
+def presence_key(session_uid: str, user_id: int) -> str:
+    return f"session:{session_uid}:user:{user_id}"
+
+
+# KEYS: session hash, wallet hash, wallet sessions set, active set
+# ARGV: session_uid, client_id, reader_id, rate, wallet_cents, base_cents, base_seconds
+START_LUA = """
+local now = redis.call('TIME')[1]
+if redis.call('EXISTS', KEYS[2]) == 0 then
+  redis.call('HSET', KEYS[2], 'balance_units', tonumber(ARGV[5]) * 60, 'db_cents', ARGV[5])
+end
+redis.call('HSET', KEYS[1],
+  'client_id', ARGV[2], 'reader_id', ARGV[3], 'rate', ARGV[4], 'last_ts', now,
+  'charged_units', 0, 'billed_seconds', 0, 'base_cents', ARGV[6], 'base_seconds', ARGV[7],
+  'status', 'active')
+redis.call('SADD', KEYS[3], ARGV[1])
+redis.call('SADD', KEYS[4], ARGV[1])
+return 1
+"""
+
+# KEYS: session hash, wallet hash, client presence, reader presence
+# ARGV: max billable gap in seconds
+# Returns {state, remaining balance units}
+TICK_LUA = """
+if redis.call('HGET', KEYS[1], 'status') ~= 'active' then return {0, 0} end
+local balance = tonumber(redis.call('HGET', KEYS[2], 'balance_units') or '0')
+local now = tonumber(redis.call('TIME')[1])
+local elapsed = now - tonumber(redis.call('HGET', KEYS[1], 'last_ts'))
+if elapsed <= 0 then return {1, balance} end
+redis.call('HSET', KEYS[1], 'last_ts', now)
+if redis.call('EXISTS', KEYS[3]) == 0 or redis.call('EXISTS', KEYS[4]) == 0 then return {1, balance} end
+if elapsed > tonumber(ARGV[1]) then elapsed = tonumber(ARGV[1]) end
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate'))
+local seconds = elapsed
+local exhausted = false
+if rate > 0 then
+  local affordable = math.floor(balance / rate)
+  if affordable < seconds then
+    seconds = affordable
+    exhausted = true
+  end
+end
+local cost = seconds * rate
+if cost > 0 then
+  redis.call('HINCRBY', KEYS[2], 'balance_units', -cost)
+  redis.call('HINCRBY', KEYS[1], 'charged_units', cost)
+end
+redis.call('HINCRBY', KEYS[1], 'billed_seconds', seconds)
+if exhausted then
+  redis.call('HSET', KEYS[1], 'status', 'ended')
+  return {2, balance - cost}
+end
+return {1, balance - cost}
+"""
+
+# KEYS: wallet hash
+# ARGV: wallet balance in Postgres after settlement, cents settled for this wallet
+# Folds changes made to the wallet outside metering (top-ups, gifts) into the Redis balance.
+REBASE_LUA = """
+local prev = redis.call('HGET', KEYS[1], 'db_cents')
+if not prev then return 0 end
+local external = tonumber(ARGV[1]) - (tonumber(prev) - tonumber(ARGV[2]))
+if external ~= 0 then redis.call('HINCRBY', KEYS[1], 'balance_units', external * 60) end
+redis.call('HSET', KEYS[1], 'db_cents', ARGV[1])
+return external
+"""
+
+# KEYS: wallet hash
+# ARGV: cents (negative hands a reservation back)
+# Returns -1 when the wallet isn't metered, 0 when the balance doesn't cover it, 1 once reserved.
+# A reservation whose Postgres debit never commits is credited back by the next rebase.
+RESERVE_LUA = """
+local balance = redis.call('HGET', KEYS[1], 'balance_units')
+if not balance then return -1 end
+local units = tonumber(ARGV[1]) * 60
+if tonumber(balance) < units then return 0 end
+redis.call('HINCRBY', KEYS[1], 'balance_units', -units)
+redis.call('HINCRBY', KEYS[1], 'db_cents', -tonumber(ARGV[1]))
+return 1
+"""
+
+# KEYS: session hash, wallet hash, wallet sessions set, active set
+# ARGV: session_uid
+RELEASE_LUA = """
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[4], ARGV[1])
+redis.call('SREM', KEYS[3], ARGV[1])
+if redis.call('SCARD', KEYS[3]) == 0 then redis.call('DEL', KEYS[2]) end
+return 1
+"""
+
+
+async def start_metering(db: AsyncSession, r: AsyncRedis, sess: models.Session, rate_cents: int):
+    """Load the client's wallet into Redis (once per client) and begin metering the session."""
+    wallet_cents = await db.scalar(select(models.Wallet.balance_cents).where(models.Wallet.user_id == sess.client_id)) or 0
+    await r.register_script(START_LUA)(
+        keys=[session_key(sess.session_uid), wallet_key(sess.client_id), wallet_sessions_key(sess.client_id), ACTIVE_KEY],
+        args=[sess.session_uid, sess.client_id, sess.reader_id, rate_cents, wallet_cents, sess.amount_charged_cents, sess.total_seconds],
+    )
+
+
+async def stop_metering(r: AsyncRedis, session_uid: str):
+    """Stop charging; the next settlement writes the final totals and releases the keys."""
+    key = session_key(session_uid)
+    if await r.exists(key):
+        await r.hset(key, "status", "ended")
+
+
+async def meter_tick(r: AsyncRedis, session_uid: str) -> tuple[int, int]:
+    """Charge the seconds elapsed since the last tick. Returns (state, balance in cents)."""
+    key = session_key(session_uid)
+    client_id, reader_id = await r.hmget(key, ["client_id", "reader_id"])
+    if client_id is None:
+        return METER_INACTIVE, 0
+    state, balance_units = await r.register_script(TICK_LUA)(
+        keys=[key, wallet_key(int(client_id)), presence_key(session_uid, client_id), presence_key(session_uid, reader_id)],
+        args=[settings.metering_max_gap_seconds],
+    )
+    return int(state), int(balance_units) // UNITS_PER_CENT
+
+
+async def reserve_funds(r: AsyncRedis, client_id: int, amount_cents: int) -> bool | None:
+    """Take a non-session spend out of a metered wallet's Redis balance before it is debited
+    in Postgres. Returns None if the client isn't being metered, False if it can't cover it."""
+    reserved = int(await r.register_script(RESERVE_LUA)(keys=[wallet_key(client_id)], args=[amount_cents]))
+    return None if reserved < 0 else bool(reserved)
+
+
+async def release_funds(r: AsyncRedis, client_id: int, amount_cents: int):
+    """Undo `reserve_funds` when the Postgres debit doesn't go through."""
+    await r.register_script(RESERVE_LUA)(keys=[wallet_key(client_id)], args=[-amount_cents])
+
+
+def settle_metered_sessions(db: Session, r: Redis) -> dict:
+    """Write metered totals back to Postgres. Safe to re-run: each session's settled
+    amount is derived from the cumulative Redis counters against the session row."""
+    uids = sorted(r.smembers(ACTIVE_KEY))
+    settled = ended = 0
+    for i in range(0, len(uids), SETTLE_BATCH):
+        s, e = _settle_batch(db, r, uids[i:i + SETTLE_BATCH])
+        settled += s
+        ended += e
+    return {"settled": settled, "ended": ended}
+
+
+def _settle_batch(db: Session, r: Redis, uids: list[str]) -> tuple[int, int]:
+    pipe = r.pipeline(transaction=False)
+    for uid in uids:
+        pipe.hgetall(session_key(uid))
+    meters = {uid: m for uid, m in zip(uids, pipe.execute()) if m}
+    if not meters:
+        return 0, 0
+    rows = db.execute(
+        select(
+            models.Session.id,
+            models.Session.session_uid,
+            models.Session.client_id,
+            models.Session.reader_id,
+            models.Session.status,
+            models.Session.amount_charged_cents,
+            models.Session.total_seconds,
+        )
+        .where(models.Session.session_uid.in_(list(meters)))
+        .with_for_update()
+    ).all()
+    now = datetime.utcnow()
+    charges = []
+    per_client: dict[int, int] = defaultdict(int)
+    for row in rows:
+        m = meters[row.session_uid]
+        target_cents = int(m["base_cents"]) + int(m["charged_units"]) // UNITS_PER_CENT
+        target_seconds = int(m["base_seconds"]) + int(m["billed_seconds"])
+        amount = max(target_cents - row.amount_charged_cents, 0)
+        seconds = max(target_seconds - row.total_seconds, 0)
+        if amount or seconds:
+            charges.append({"session_id": row.id, "session_uid": row.session_uid, "client_id": row.client_id, "reader_id": row.reader_id, "amount_cents": amount, "seconds": seconds})
+            per_client[row.client_id] += amount
+
+    # The Redis reservation should always be covered, but the wallet is the source of
+    # truth: collect what it holds and end the sessions of any client who falls short
+    owed = {cid: amt for cid, amt in per_client.items() if amt > 0}
+    available = dict(db.execute(
+        select(models.Wallet.user_id, models.Wallet.balance_cents)
+        .where(models.Wallet.user_id.in_(list(owed)))
+        .order_by(models.Wallet.user_id)
+        .with_for_update()
+    ).all()) if owed else {}
+    shortfall = {cid for cid, amt in owed.items() if amt > available.get(cid, 0)}
+    if shortfall:
+        left = {cid: max(available.get(cid, 0), 0) for cid in shortfall}
+        for c in charges:
+            if c["client_id"] in shortfall:
+                c["amount_cents"] = min(c["amount_cents"], left[c["client_id"]])
+                left[c["client_id"]] -= c["amount_cents"]
+    debited: dict[int, int] = defaultdict(int)
+    for c in charges:
+        if c["amount_cents"] > 0:
+            debited[c["client_id"]] += c["amount_cents"]
+
+    to_end = []
+    released = []
+    for row in rows:
+        m = meters[row.session_uid]
+        if m["status"] != "active" or row.status != "active" or row.client_id in shortfall:
+            if row.status == "active":
+                to_end.append(row.id)
+            released.append((row.session_uid, row.client_id))
+    seen = {row.session_uid for row in rows}
+    released += [(uid, int(m["client_id"])) for uid, m in meters.items() if uid not in seen]
+    clients = {int(m["client_id"]) for m in meters.values()}
+
+    if debited:
+        debits = values(column('user_id', Integer), column('amount', Integer), name='debits').data(list(debited.items()))
+        updated = db.execute(
+            update(models.Wallet)
+            .where(models.Wallet.user_id == debits.c.user_id, models.Wallet.balance_cents >= debits.c.amount)
+            .values(balance_cents=models.Wallet.balance_cents - debits.c.amount, updated_at=now)
+            .returning(models.Wallet.user_id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+        if len(updated) != len(debited):
+            # Rows are locked above, so this only happens if that invariant is broken
+            db.rollback()
+            raise RuntimeError(f"wallet debit missed for clients {sorted(set(debited) - set(updated))}")
+        db.execute(insert(models.LedgerEntry), [
+            {"user_id": c["client_id"], "kind": 'debit', "amount_cents": c["amount_cents"], "ref_type": 'session', "ref_id": c["session_uid"], "created_at": now}
+            for c in charges if c["amount_cents"] > 0
+        ])
+    apply_session_charges(db, charges, now)
+    if to_end:
+        end_sessions(db, to_end, now)
+    balances = dict(db.execute(
+        select(models.Wallet.user_id, models.Wallet.balance_cents).where(models.Wallet.user_id.in_(clients))
+    ).all())
+    db.commit()
+
+    rebase = r.register_script(REBASE_LUA)
+    release = r.register_script(RELEASE_LUA)
+    pipe = r.pipeline(transaction=False)
+    for cid in clients:
+        rebase(keys=[wallet_key(cid)], args=[balances.get(cid, 0), debited.get(cid, 0)], client=pipe)
+    for uid, cid in released:
+        release(keys=[session_key(uid), wallet_key(cid), wallet_sessions_key(cid), ACTIVE_KEY], args=[uid], client=pipe)
+    pipe.execute()
+    return len(charges), len(to_end)
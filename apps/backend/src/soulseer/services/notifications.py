@@ -1,11 +1,131 @@
+"""In-app notifications and push delivery.
+
+Pushes are never sent from the request path. `enqueue_push` writes rows to push_outbox
+in the caller's transaction, so a push exists exactly when the change that caused it
+commits. `drain_push_outbox` claims due rows with SKIP LOCKED, looks up every
+recipient's devices in one query, sends each row to all of its recipient's devices in
+one OneSignal request keyed by the row id, concurrently over a shared keep-alive
+client, and reschedules failures with exponential backoff. Player ids OneSignal reports
+as invalid are deactivated. Finished rows are purged after a short retention window.
+
+Each user's unread count is cached in Redis. Creating and reading notifications adjust
+it after commit, but only while the key exists; a missing key is recounted from the
+database on the next read, and the TTL bounds how long any drift can survive.
+"""
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 from .. import models
 from ..config import settings
 import httpx
-from typing import Optional, List
-import json
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, List
+import asyncio
+import uuid
+
+ONESIGNAL_URL = 'https://onesignal.com/api/v1/notifications'
+PUSH_BATCH = 2000  # OneSignal's limit on include_player_ids per request
+PUSH_CONCURRENCY = 8
+OUTBOX_BATCH = 500
+MAX_PUSH_ATTEMPTS = 8
+BACKOFF_BASE = timedelta(seconds=15)
+BACKOFF_MAX = timedelta(hours=1)
+UNREAD_TTL_SECONDS = 24 * 3600
+PURGE_BATCH = 5000
+
+# KEYS: unread counter. ARGV: delta. Adjusts an existing counter, never below zero.
+ADJUST_UNREAD_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local n = redis.call('INCRBY', KEYS[1], ARGV[1])
+if n < 0 then redis.call('SET', KEYS[1], 0, 'KEEPTTL') n = 0 end
+return n
+"""
+
+def unread_key(user_id: int) -> str:
+    return f"notifications:unread:{user_id}"
+
+async def adjust_unread(r: AsyncRedis, deltas: Dict[int, int]):
+    """Apply per-user unread deltas after the change that caused them commits."""
+    deltas = {user_id: n for user_id, n in deltas.items() if n}
+    if not deltas:
+        return
+    script = r.register_script(ADJUST_UNREAD_LUA)
+    pipe = r.pipeline(transaction=False)
+    for user_id, n in deltas.items():
+        await script(keys=[unread_key(user_id)], args=[n], client=pipe)
+    await pipe.execute()
 
-def create_notification(db: Session, user_id: int, title: str, body: str, type: str):
+async def unread_count(db: AsyncSession, r: AsyncRedis, user_id: int) -> int:
+    cached = await r.get(unread_key(user_id))
+    if cached is not None:
+        return int(cached)
+    count = await db.scalar(select(func.count()).where(models.Notification.user_id == user_id, models.Notification.read == False))
+    # NX: a concurrent adjustment that recreated the key wins
+    await r.set(unread_key(user_id), count, ex=UNREAD_TTL_SECONDS, nx=True)
+    return count
+
+async def mark_read(db: AsyncSession, r: AsyncRedis, user_id: int, ids: List[int] | None = None, up_to_id: int | None = None) -> int:
+    """Mark the user's unread notifications read in one UPDATE: `ids`, those up to `up_to_id`, or all."""
+    stmt = update(models.Notification).where(models.Notification.user_id == user_id, models.Notification.read == False)
+    if ids is not None:
+        stmt = stmt.where(models.Notification.id.in_(ids))
+    if up_to_id is not None:
+        stmt = stmt.where(models.Notification.id <= up_to_id)
+    result = await db.execute(stmt.values(read=True).execution_options(synchronize_session=False))
+    await db.commit()
+    await adjust_unread(r, {user_id: -result.rowcount})
+    return result.rowcount
+
+def purge_notifications(db: Session, r: Redis, retention_days: int) -> int:
+    """Delete notifications older than the retention window in batches. Returns rows deleted."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    script = r.register_script(ADJUST_UNREAD_LUA)
+    deleted = 0
+    while True:
+        batch = select(models.Notification.id).where(models.Notification.created_at < cutoff).order_by(models.Notification.created_at).limit(PURGE_BATCH)
+        rows = db.execute(
+            delete(models.Notification)
+            .where(models.Notification.id.in_(batch.scalar_subquery()))
+            .returning(models.Notification.user_id, models.Notification.read)
+        ).all()
+        db.commit()
+        unread: Dict[int, int] = {}
+        for user_id, read in rows:
+            if not read:
+                unread[user_id] = unread.get(user_id, 0) - 1
+        pipe = r.pipeline(transaction=False)
+        for user_id, n in unread.items():
+            script(keys=[unread_key(user_id)], args=[n], client=pipe)
+        pipe.execute()
+        deleted += len(rows)
+        if len(rows) < PURGE_BATCH:
+            return deleted
+
+def purge_push_outbox(db: Session, retention_days: int) -> int:
+    """Delete outbox rows that are no longer pending and older than the retention window."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    deleted = 0
+    while True:
+        # Ids grow with created_at, so the oldest rows are at the front of the primary key
+        batch = (
+            select(models.PushOutbox.id)
+            .where(models.PushOutbox.created_at < cutoff, models.PushOutbox.status != 'pending')
+            .order_by(models.PushOutbox.id)
+            .limit(PURGE_BATCH)
+        )
+        n = db.execute(
+            delete(models.PushOutbox)
+            .where(models.PushOutbox.id.in_(batch.scalar_subquery()))
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.commit()
+        deleted += n
+        if n < PURGE_BATCH:
+            return deleted
+
+async def create_notification(db: AsyncSession, user_id: int, title: str, body: str, type: str):
     """Create an in-app notification"""
     notif = models.Notification(
         user_id=user_id,
@@ -14,75 +134,152 @@ def create_notification(db: Session, user_id: int, title: str, body: str, type:
         type=type
     )
     db.add(notif)
-    db.flush()
+    await db.flush()
     return notif
 
-async def send_push_notification(user_id: int, title: str, body: str, data: Optional[dict] = None):
-    """Send push notification via OneSignal"""
-    if not settings.enable_push_notifications or not settings.onesignal_app_id:
+def enqueue_push(db, user_ids: Iterable[int], title: str, body: str, data: Optional[dict] = None):
+    """Queue a push to every device of each user; delivered once the caller commits."""
+    if not push_enabled():
         return
-    
-    db = Session()
+    now = datetime.utcnow()
+    db.add_all([
+        models.PushOutbox(user_id=user_id, title=title, body=body, data=data or {}, status='pending', attempts=0, next_attempt_at=now, created_at=now)
+        for user_id in user_ids
+    ])
+
+def push_enabled() -> bool:
+    return settings.enable_push_notifications and bool(settings.onesignal_app_id)
+
+def onesignal_client() -> httpx.AsyncClient:
+    """Keep-alive client for OneSignal; close it when done (`async with`)."""
+    return httpx.AsyncClient(
+        headers={'Authorization': f'Basic {settings.onesignal_api_key}'},
+        limits=httpx.Limits(max_connections=PUSH_CONCURRENCY, max_keepalive_connections=PUSH_CONCURRENCY),
+        timeout=10,
+    )
+
+async def _player_ids(db: AsyncSession, user_ids: Iterable[int]) -> Dict[int, List[str]]:
+    rows = (await db.execute(select(models.PushSubscription.user_id, models.PushSubscription.player_id).where(
+        models.PushSubscription.user_id.in_(set(user_ids)),
+        models.PushSubscription.active == True
+    ))).all()
+    out: Dict[int, List[str]] = {}
+    for user_id, player_id in rows:
+        out.setdefault(user_id, []).append(player_id)
+    return out
+
+async def _post(client: httpx.AsyncClient, limit: asyncio.Semaphore, payload: dict) -> tuple[str | None, bool, List[str]]:
+    """Send one request. Returns (error or None, whether to retry, player ids OneSignal says are invalid)."""
+    async with limit:
+        try:
+            response = await client.post(ONESIGNAL_URL, json=payload)
+        except httpx.HTTPError as e:
+            return f"{type(e).__name__}: {e}", True, []
     try:
-        # Get user's push subscriptions
-        subs = db.query(models.PushSubscription).filter(
-            models.PushSubscription.user_id == user_id,
-            models.PushSubscription.active == True
-        ).all()
-        
-        if not subs:
-            return
-        
-        player_ids = [s.player_id for s in subs]
-        
-        # Send via OneSignal API
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                'https://onesignal.com/api/v1/notifications',
-                headers={
-                    'Authorization': f'Basic {settings.onesignal_api_key}',
-                    'Content-Type': 'application/json'
-                },
-                json={
-                    'app_id': settings.onesignal_app_id,
-                    'include_player_ids': player_ids,
-                    'headings': {'en': title},
-                    'contents': {'en': body},
-                    'data': data or {},
-                    'ios_badgeType': 'Increase',
-                    'ios_badgeCount': 1
-                }
-            )
-            return response.json()
-    finally:
-        db.close()
-
-async def notify_session_request(db: Session, reader_id: int, session_uid: str):
+        result = response.json()
+    except ValueError:
+        result = {}
+    errors = result.get('errors') if isinstance(result, dict) else None
+    invalid = errors.get('invalid_player_ids', []) if isinstance(errors, dict) else []
+    if response.status_code >= 500 or response.status_code == 429:
+        return f"HTTP {response.status_code}", True, invalid
+    if response.is_error and not invalid:
+        return f"HTTP {response.status_code}: {response.text[:500]}", False, invalid
+    # An audience of only invalid devices is also a 400; nothing left to deliver
+    return None, False, invalid
+
+def _backoff(attempts: int) -> timedelta:
+    return min(BACKOFF_BASE * (2 ** (attempts - 1)), BACKOFF_MAX)
+
+async def _drain_batch(db: AsyncSession, client: httpx.AsyncClient) -> int:
+    now = datetime.utcnow()
+    rows = (await db.execute(
+        select(models.PushOutbox)
+        .where(models.PushOutbox.status == 'pending', models.PushOutbox.next_attempt_at <= now)
+        .order_by(models.PushOutbox.next_attempt_at)
+        .limit(OUTBOX_BATCH)
+        .with_for_update(skip_locked=True)
+    )).scalars().all()
+    if not rows:
+        return 0
+    devices = await _player_ids(db, (row.user_id for row in rows))
+    # One request per recipient covering all their devices, so a resend is always the same
+    # request and OneSignal can drop it by external_id
+    sending: List[models.PushOutbox] = []
+    requests = []
+    for row in rows:
+        player_ids = devices.get(row.user_id)
+        if not player_ids:
+            row.status, row.sent_at = 'skipped', now
+            continue
+        sending.append(row)
+        for i in range(0, len(player_ids), PUSH_BATCH):
+            requests.append((row, {
+                'app_id': settings.onesignal_app_id,
+                'external_id': str(uuid.uuid5(uuid.NAMESPACE_URL, f"soulseer:push:{row.id}:{i}")),
+                'include_player_ids': player_ids[i:i + PUSH_BATCH],
+                'headings': {'en': row.title},
+                'contents': {'en': row.body},
+                'data': row.data,
+                'ios_badgeType': 'Increase',
+                'ios_badgeCount': 1
+            }))
+    limit = asyncio.Semaphore(PUSH_CONCURRENCY)
+    results = await asyncio.gather(*(_post(client, limit, payload) for _, payload in requests))
+    failed: Dict[int, tuple[str, bool]] = {}
+    invalid: List[str] = []
+    for (row, _), (error, retry, dead) in zip(requests, results):
+        invalid += dead
+        if error:
+            failed[row.id] = (error, retry)
+    for row in sending:
+        row.attempts += 1
+        if row.id not in failed:
+            row.status, row.sent_at, row.error = 'sent', now, None
+            continue
+        error, retry = failed[row.id]
+        if not retry or row.attempts >= MAX_PUSH_ATTEMPTS:
+            row.status, row.error = 'failed', error
+        else:
+            row.next_attempt_at, row.error = now + _backoff(row.attempts), error
+    if invalid:
+        await db.execute(
+            update(models.PushSubscription)
+            .where(models.PushSubscription.player_id.in_(invalid))
+            .values(active=False)
+            .execution_options(synchronize_session=False)
+        )
+    await db.commit()
+    return len(rows)
+
+async def drain_push_outbox(db: AsyncSession) -> int:
+    """Deliver every due outbox row. Returns the number of rows processed."""
+    if not push_enabled():
+        # Rows queued before push was turned off will never go out; let the purge take them
+        result = await db.execute(
+            update(models.PushOutbox)
+            .where(models.PushOutbox.status == 'pending')
+            .values(status='skipped', sent_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+        return result.rowcount
+    processed = 0
+    async with onesignal_client() as client:
+        while True:
+            n = await _drain_batch(db, client)
+            processed += n
+            if n < OUTBOX_BATCH:
+                return processed
+
+async def notify_session_request(db: AsyncSession, reader_id: int, session_uid: str):
     """Notify reader of new session request"""
     title = "New Reading Request"
     body = "You have a new reading request waiting"
-    
+
     # In-app notification
-    create_notification(db, reader_id, title, body, 'session_request')
-    
-    # Push notification
-    await send_push_notification(
-        reader_id, 
-        title, 
-        body,
-        {'type': 'session_request', 'session_uid': session_uid}
-    )
+    notif = await create_notification(db, reader_id, title, body, 'session_request')
 
-async def notify_appointment_reminder(db: Session, user_id: int, appointment: models.Appointment, minutes_before: int):
-    """Send appointment reminder"""
-    title = f"Appointment Reminder"
-    body = f"Your reading starts in {minutes_before} minutes"
-    
-    create_notification(db, user_id, title, body, 'appointment_reminder')
-    
-    await send_push_notification(
-        user_id,
-        title,
-        body,
-        {'type': 'appointment_reminder', 'booking_uid': appointment.booking_uid}
-    )
\ No newline at end of file
+    # Push notification, sent by the outbox worker after commit
+    enqueue_push(db, [reader_id], title, body, {'type': 'session_request', 'session_uid': session_uid})
+    return notif
@@ -0,0 +1,200 @@
+"""Daily Stripe Connect payouts to readers.
+
+A run is recorded per UTC day. Planning moves each eligible reader's balance into a
+pending `Payout` row (debiting the balance and writing the ledger entry) in small
+committed batches. Transfers are then sent from a thread pool and each result is
+committed as it arrives. Every transfer carries a per-reader, per-day idempotency key,
+so re-running after a crash resumes the same run without paying anyone twice. Failed
+transfers are retried on later runs and, after MAX_PAYOUT_ATTEMPTS, the amount is
+returned to the reader's balance.
+
+Stripe only remembers idempotency keys for about a day, so each transfer is also tagged
+with its key as `transfer_group`. Before a retry, and before giving up, the destination's
+transfers are searched for that group; one that already went through is recorded as paid
+instead of being sent again or reversed.
+"""
+from sqlalchemy import Integer, column, func, insert, select, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
+import stripe
+from .. import models
+
+PAYOUT_MINIMUM_CENTS = 1500
+MAX_PAYOUT_ATTEMPTS = 5
+PLAN_BATCH = 500
+RETRYABLE = ('pending', 'failed')
+
+
+def idempotency_key(reader_id: int, run_date: date) -> str:
+    return f"payout:{reader_id}:{run_date:%Y%m%d}"
+
+
+def get_or_create_run(db: Session, run_date: date) -> models.PayoutRun:
+    db.execute(pg_insert(models.PayoutRun).values(run_date=run_date, status='running', started_at=datetime.utcnow()).on_conflict_do_nothing())
+    db.commit()
+    return db.execute(select(models.PayoutRun).where(models.PayoutRun.run_date == run_date)).scalar_one()
+
+
+def plan_run(db: Session, run: models.PayoutRun) -> int:
+    """Reserve the balances of eligible readers not yet in this run. Returns payouts planned."""
+    RB, SA = models.ReaderBalance, models.StripeAccount
+    planned = 0
+    after = 0
+    while True:
+        rows = db.execute(
+            select(RB.user_id, RB.balance_cents, SA.account_id)
+            .join(SA, SA.user_id == RB.user_id)
+            .where(
+                RB.user_id > after,
+                RB.balance_cents > PAYOUT_MINIMUM_CENTS,
+                SA.details_submitted == True,
+                ~select(models.Payout.id).where(models.Payout.run_id == run.id, models.Payout.reader_id == RB.user_id).exists(),
+            )
+            .order_by(RB.user_id)
+            .limit(PLAN_BATCH)
+            .with_for_update(of=RB, skip_locked=True)
+        ).all()
+        if not rows:
+            return planned
+        now = datetime.utcnow()
+        db.execute(insert(models.Payout), [
+            {"run_id": run.id, "reader_id": r.user_id, "account_id": r.account_id, "amount_cents": r.balance_cents,
+             "idempotency_key": idempotency_key(r.user_id, run.run_date), "status": 'pending', "attempts": 0,
+             "created_at": now, "updated_at": now}
+            for r in rows
+        ])
+        amounts = values(column('user_id', Integer), column('amount', Integer), name='amounts').data([(r.user_id, r.balance_cents) for r in rows])
+        db.execute(
+            update(RB)
+            .where(RB.user_id == amounts.c.user_id)
+            .values(balance_cents=RB.balance_cents - amounts.c.amount, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        db.execute(insert(models.ReaderLedgerEntry), [
+            {"reader_id": r.user_id, "kind": 'payout', "amount_cents": r.balance_cents, "ref_type": 'transfer',
+             "ref_id": idempotency_key(r.user_id, run.run_date), "created_at": now}
+            for r in rows
+        ])
+        db.commit()
+        planned += len(rows)
+        after = rows[-1].user_id
+
+
+def _transfer(account_id: str, amount_cents: int, key: str):
+    return stripe.Transfer.create(
+        amount=amount_cents,
+        currency='usd',
+        destination=account_id,
+        description='SoulSeer daily payout',
+        transfer_group=key,
+        metadata={"payout_key": key},
+        idempotency_key=key,
+    )
+
+
+def _find_transfer(account_id: str, key: str):
+    """The transfer already made for this payout, if any."""
+    found = stripe.Transfer.list(destination=account_id, transfer_group=key, limit=1)
+    return found.data[0] if found.data else None
+
+
+def _send(account_id: str, amount_cents: int, key: str, attempts: int):
+    # An earlier attempt may have reached Stripe after its idempotency key expired
+    if attempts:
+        transfer = _find_transfer(account_id, key)
+        if transfer is not None:
+            return transfer
+    return _transfer(account_id, amount_cents, key)
+
+
+def _reverse(db: Session, reader_id: int, amount_cents: int, key: str, now: datetime):
+    # Give up on the transfer: the reserved amount goes back to the reader's balance
+    db.execute(
+        update(models.ReaderBalance)
+        .where(models.ReaderBalance.user_id == reader_id)
+        .values(balance_cents=models.ReaderBalance.balance_cents + amount_cents, updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.add(models.ReaderLedgerEntry(reader_id=reader_id, kind='credit', amount_cents=amount_cents, ref_type='payout_reversal', ref_id=key, created_at=now))
+
+
+def send_run(db: Session, run: models.PayoutRun, concurrency: int) -> dict:
+    """Send every retryable transfer in the run, committing each outcome as it completes."""
+    todo = db.execute(
+        select(models.Payout.id, models.Payout.reader_id, models.Payout.account_id, models.Payout.amount_cents, models.Payout.idempotency_key, models.Payout.attempts)
+        .where(models.Payout.run_id == run.id, models.Payout.status.in_(RETRYABLE), models.Payout.attempts < MAX_PAYOUT_ATTEMPTS)
+    ).all()
+    sent = failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(_send, p.account_id, p.amount_cents, p.idempotency_key, p.attempts): p for p in todo}
+        for future in as_completed(futures):
+            p = futures[future]
+            now = datetime.utcnow()
+            attempts = models.Payout.attempts + 1
+            try:
+                transfer = future.result()
+                changes = {"status": 'paid', "stripe_transfer_id": transfer["id"], "error": None}
+                sent += 1
+            except Exception as e:
+                changes = {"status": 'failed', "error": str(e)[:1000]}
+                failed += 1
+                if p.attempts + 1 >= MAX_PAYOUT_ATTEMPTS:
+                    # Only reverse once Stripe confirms the money never left
+                    try:
+                        transfer = _find_transfer(p.account_id, p.idempotency_key)
+                    except Exception as lookup_error:
+                        # Keep the attempt available so the next run checks again
+                        attempts = models.Payout.attempts
+                        changes["error"] = f"{e}; lookup failed: {lookup_error}"[:1000]
+                    else:
+                        if transfer is not None:
+                            changes = {"status": 'paid', "stripe_transfer_id": transfer["id"], "error": None}
+                            sent += 1
+                            failed -= 1
+                        else:
+                            changes["status"] = 'abandoned'
+                            _reverse(db, p.reader_id, p.amount_cents, p.idempotency_key, now)
+            db.execute(
+                update(models.Payout).where(models.Payout.id == p.id)
+                .values(attempts=attempts, updated_at=now, **changes)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+    _finish_run(db, run)
+    return {"sent": sent, "failed": failed}
+
+
+def _finish_run(db: Session, run: models.PayoutRun):
+    counts = dict(db.execute(
+        select(models.Payout.status, func.count()).where(models.Payout.run_id == run.id).group_by(models.Payout.status)
+    ).all())
+    run.payouts = sum(counts.values())
+    run.paid = counts.get('paid', 0)
+    run.failed = counts.get('failed', 0) + counts.get('abandoned', 0)
+    run.paid_cents = db.scalar(
+        select(func.coalesce(func.sum(models.Payout.amount_cents), 0)).where(models.Payout.run_id == run.id, models.Payout.status == 'paid')
+    )
+    retryable = db.scalar(
+        select(func.count()).where(models.Payout.run_id == run.id, models.Payout.status.in_(RETRYABLE), models.Payout.attempts < MAX_PAYOUT_ATTEMPTS)
+    )
+    if not retryable:
+        run.status = 'completed'
+        run.finished_at = datetime.utcnow()
+    db.commit()
+
+
+def run_payouts(db: Session, concurrency: int) -> dict:
+    """Plan today's run, then send it and anything still retryable from earlier runs."""
+    today = get_or_create_run(db, datetime.utcnow().date())
+    planned = plan_run(db, today)
+    runs = db.execute(
+        select(models.PayoutRun).where(models.PayoutRun.status == 'running').order_by(models.PayoutRun.run_date)
+    ).scalars().all()
+    result = {"planned": planned, "sent": 0, "failed": 0}
+    for run in runs:
+        r = send_run(db, run, concurrency)
+        result["sent"] += r["sent"]
+        result["failed"] += r["failed"]
+    return result
@@ -0,0 +1,172 @@
+"""Live reader presence kept in Redis.
+
+Heartbeats and status changes go through one Lua script that maintains:
+  - a sorted set of every present reader by last-seen time,
+  - a sorted set per status (online, busy) and per mode for online readers, scored by
+    last-seen, so "online now, page K" is a single ZREVRANGEBYSCORE,
+  - the reader's status in the cached directory entry.
+A reader that stops heartbeating drops out of queries after the presence TTL and is
+marked offline by the next sweep. Changed readers are queued and their status is
+written back to ReaderProfile in batches by `flush_presence`.
+"""
+from sqlalchemy import Integer, String, column, update, values
+from sqlalchemy.orm import Session
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+import time
+from .. import models
+from ..config import settings
+from .directory import DIRECTORY_KEY, VERSION_KEY
+
+SEEN_KEY = "presence:readers:seen"
+STATUS_KEY = "presence:readers:status"
+MODES_KEY = "presence:readers:modes"
+DIRTY_KEY = "presence:readers:dirty"
+
+MODES = ("chat", "voice", "video")
+SWEEP_BATCH = 1000
+
+
+def status_key(status: str) -> str:
+    return f"presence:readers:{status}"
+
+
+def mode_key(mode: str) -> str:
+    return f"presence:readers:online:{mode}"
+
+
+KEYS = [
+    SEEN_KEY, STATUS_KEY, MODES_KEY, DIRTY_KEY,
+    status_key("online"), status_key("busy"),
+    mode_key("chat"), mode_key("voice"), mode_key("video"),
+    DIRECTORY_KEY, VERSION_KEY,
+]
+
+# Shared by the scripts below; KEYS are laid out as in `KEYS`.
+_APPLY_LUA = """
+local MODE_KEYS = {chat = 7, voice = 8, video = 9}
+local function apply(id, prev, status, modes, now)
+  for i = 5, 9 do redis.call('ZREM', KEYS[i], id) end
+  if status == 'offline' then
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('HDEL', KEYS[2], id)
+  else
+    redis.call('ZADD', KEYS[1], now, id)
+    redis.call('HSET', KEYS[2], id, status)
+    redis.call('ZADD', status == 'busy' and KEYS[6] or KEYS[5], now, id)
+    if status == 'online' then
+      for mode in string.gmatch(modes, '[^,]+') do
+        if MODE_KEYS[mode] then redis.call('ZADD', KEYS[MODE_KEYS[mode]], now, id) end
+      end
+    end
+  end
+  if prev == status then return 0 end
+  redis.call('SADD', KEYS[4], id)
+  local entry = redis.call('HGET', KEYS[10], id)
+  if entry then
+    local d = cjson.decode(entry)
+    d['status'] = status
+    redis.call('HSET', KEYS[10], id, cjson.encode(d))
+    redis.call('INCR', KEYS[11])
+  end
+  return 1
+end
+"""
+
+# ARGV: reader_id, status ('' keeps the current one), modes csv ('' keeps the stored ones)
+# Returns 1 if the status changed.
+SET_LUA = _APPLY_LUA + """
+local id = ARGV[1]
+local prev = redis.call('HGET', KEYS[2], id) or 'offline'
+local status = ARGV[2]
+if status == '' then
+  status = prev
+  if status == 'offline' then status = 'online' end
+end
+local modes = ARGV[3]
+if modes == '' then modes = redis.call('HGET', KEYS[3], id) or 'chat,voice,video' end
+redis.call('HSET', KEYS[3], id, modes)
+return apply(id, prev, status, modes, tonumber(redis.call('TIME')[1]))
+"""
+
+# ARGV: last-seen cutoff, max readers to sweep. Returns the number marked offline.
+SWEEP_LUA = _APPLY_LUA + """
+local stale = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, id in ipairs(stale) do
+  apply(id, redis.call('HGET', KEYS[2], id) or 'offline', 'offline', '', 0)
+end
+return #stale
+"""
+
+# Atomically takes the changed-reader queue. Returns {id, status, id, status, ...}
+TAKE_DIRTY_LUA = """
+local ids = redis.call('SMEMBERS', KEYS[4])
+redis.call('DEL', KEYS[4])
+local out = {}
+for _, id in ipairs(ids) do
+  out[#out + 1] = id
+  out[#out + 1] = redis.call('HGET', KEYS[2], id) or 'offline'
+end
+return out
+"""
+
+
+def _cutoff() -> float:
+    return time.time() - settings.reader_presence_ttl_seconds
+
+
+async def set_reader_presence(r: AsyncRedis, reader_id: int, status: str = "", modes: list[str] | None = None) -> bool:
+    """Record a heartbeat and optionally a new status/modes. Returns True if the status changed."""
+    changed = await r.register_script(SET_LUA)(keys=KEYS, args=[reader_id, status, ",".join(modes or [])])
+    return bool(changed)
+
+
+async def reader_status(r: AsyncRedis, reader_id: int) -> str:
+    pipe = r.pipeline(transaction=False)
+    pipe.hget(STATUS_KEY, reader_id)
+    pipe.zscore(SEEN_KEY, reader_id)
+    status, seen = await pipe.execute()
+    if status is None or seen is None or seen < _cutoff():
+        return "offline"
+    return status
+
+
+async def online_readers(r: AsyncRedis, page: int = 0, limit: int = 50, mode: str | None = None, status: str = "online") -> tuple[list[int], int]:
+    """Reader ids present with `status` (and accepting `mode`), most recently seen first, and the total."""
+    key = mode_key(mode) if mode else status_key(status)
+    cutoff = _cutoff()
+    pipe = r.pipeline(transaction=False)
+    pipe.zrevrangebyscore(key, "+inf", cutoff, start=page * limit, num=limit)
+    pipe.zcount(key, cutoff, "+inf")
+    ids, total = await pipe.execute()
+    return [int(i) for i in ids], total
+
+
+def flush_presence(db: Session, r: Redis) -> dict:
+    """Mark stale readers offline and write changed statuses back to ReaderProfile."""
+    swept = 0
+    sweep = r.register_script(SWEEP_LUA)
+    while True:
+        n = sweep(keys=KEYS, args=[_cutoff(), SWEEP_BATCH])
+        swept += n
+        if n < SWEEP_BATCH:
+            break
+    flat = r.register_script(TAKE_DIRTY_LUA)(keys=KEYS)
+    changes = [(int(reader_id), status) for reader_id, status in zip(flat[::2], flat[1::2])]
+    if not changes:
+        return {"swept": swept, "flushed": 0}
+    try:
+        statuses = values(column('user_id', Integer), column('status', String), name='presence').data(changes)
+        db.execute(
+            update(models.ReaderProfile)
+            .where(models.ReaderProfile.user_id == statuses.c.user_id)
+            .values(status=statuses.c.status)
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        # Requeue so the next flush retries; the live status is still in Redis
+        r.sadd(DIRTY_KEY, *[reader_id for reader_id, _ in changes])
+        raise
+    return {"swept": swept, "flushed": len(changes)}
@@ -0,0 +1,69 @@
+"""Appointment reminders 60 and 15 minutes before start.
+
+Each run loads every scheduled appointment starting within the widest window in one
+query and picks the tightest window it is due for. Sends are claimed by inserting
+(appointment_id, minutes_before) into appointment_reminders with ON CONFLICT DO NOTHING,
+so overlapping runs never remind twice. In-app notifications and outbox pushes for the
+claimed reminders are written in bulk in the same transaction, and each recipient gets
+a realtime notification event once it commits.
+"""
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from redis.asyncio import Redis as AsyncRedis
+from datetime import datetime, timedelta
+from .. import models
+from .events import notification_event, publish_events
+from .notifications import adjust_unread, enqueue_push
+
+REMINDER_WINDOWS = (60, 15)  # minutes before start
+
+
+def _due_window(start_time: datetime, now: datetime) -> int:
+    return min(m for m in REMINDER_WINDOWS if start_time <= now + timedelta(minutes=m))
+
+
+def _reminder_body(start_time: datetime, now: datetime) -> str:
+    # The window only decides when to remind; the message states the actual time left
+    minutes = max(1, -(-int((start_time - now).total_seconds()) // 60))
+    return f"Your reading starts in {minutes} minute{'' if minutes == 1 else 's'}"
+
+
+async def send_due_reminders(db: AsyncSession, r: AsyncRedis, now: datetime) -> dict:
+    A, R = models.Appointment, models.AppointmentReminder
+    appts = (await db.execute(
+        select(A.id, A.booking_uid, A.client_id, A.reader_id, A.start_time)
+        .where(
+            A.status == 'scheduled',
+            A.start_time > now,
+            A.start_time <= now + timedelta(minutes=max(REMINDER_WINDOWS)),
+            ~select(R.appointment_id).where(R.appointment_id == A.id, R.minutes_before == min(REMINDER_WINDOWS)).exists(),
+        )
+    )).all()
+    if not appts:
+        return {"due": 0, "sent": 0}
+    due = {a.id: _due_window(a.start_time, now) for a in appts}
+    claimed = set((await db.execute(
+        pg_insert(R)
+        .values([{"appointment_id": appt_id, "minutes_before": m, "sent_at": now} for appt_id, m in due.items()])
+        .on_conflict_do_nothing()
+        .returning(R.appointment_id)
+    )).scalars().all())
+    reminders = [(a, due[a.id]) for a in appts if a.id in claimed]
+    notifs = []
+    if reminders:
+        notifs = (await db.execute(insert(models.Notification).returning(models.Notification), [
+            {"user_id": user_id, "title": "Appointment Reminder", "body": _reminder_body(a.start_time, now),
+             "type": 'appointment_reminder', "read": False, "created_at": now}
+            for a, _ in reminders for user_id in (a.client_id, a.reader_id)
+        ])).scalars().all()
+        for a, _ in reminders:
+            enqueue_push(db, (a.client_id, a.reader_id), "Appointment Reminder", _reminder_body(a.start_time, now),
+                         {'type': 'appointment_reminder', 'booking_uid': a.booking_uid})
+    await db.commit()
+    unread = {}
+    for n in notifs:
+        unread[n.user_id] = unread.get(n.user_id, 0) + 1
+    await adjust_unread(r, unread)
+    await publish_events(r, [(n.user_id, "notification", notification_event(n)) for n in notifs])
+    return {"due": len(due), "sent": len(reminders)}
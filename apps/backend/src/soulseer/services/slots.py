@@ -0,0 +1,143 @@
+"""Bookable appointment slots.
+
+A reader's day is a 96-bit mask with one bit per 15 minutes. Availability blocks set the
+quarters they fully cover and active appointments clear the quarters they touch. Masks
+are cached in Redis per (reader, day) and dropped whenever that reader's availability or
+bookings change. A slot of k quarters can start wherever k consecutive bits are set,
+which over the concatenated days is k-1 shifts and ANDs.
+"""
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from redis.asyncio import Redis as AsyncRedis
+from datetime import date, datetime, time, timedelta, timezone
+from collections import defaultdict
+from typing import Dict, Iterable, List
+from .. import models
+
+SLOT_MINUTES = 15
+SLOT_LENGTHS = (15, 30, 45, 60)
+QUARTERS_PER_DAY = 24 * 60 // SLOT_MINUTES
+DAY_MASK = (1 << QUARTERS_PER_DAY) - 1
+ACTIVE_APPOINTMENT_STATUSES = ('scheduled', 'in_progress')
+MASK_TTL_SECONDS = 6 * 3600
+MAX_DAYS = 31
+
+_QUARTER = timedelta(minutes=SLOT_MINUTES)
+
+
+def mask_key(reader_id: int, day: date) -> str:
+    return f"slots:{reader_id}:{day.isoformat()}"
+
+
+def _span_bits(start: int, end: int, limit: int) -> int:
+    start, end = max(start, 0), min(end, limit)
+    return ((1 << (end - start)) - 1) << start if end > start else 0
+
+
+async def _compute_masks(db: AsyncSession, reader_ids: Iterable[int], first_day: date, days: int) -> Dict[int, List[int]]:
+    origin = datetime.combine(first_day, time())
+    until = origin + timedelta(days=days)
+    limit = days * QUARTERS_PER_DAY
+    free: Dict[int, int] = defaultdict(int)
+    blocks = (await db.execute(
+        select(models.AvailabilityBlock.reader_id, models.AvailabilityBlock.start_time, models.AvailabilityBlock.end_time)
+        .where(models.AvailabilityBlock.reader_id.in_(reader_ids), models.AvailabilityBlock.start_time < until, models.AvailabilityBlock.end_time > origin)
+    )).all()
+    for reader_id, start, end in blocks:
+        # Only quarters the block covers completely are bookable
+        free[reader_id] |= _span_bits(-((origin - start) // _QUARTER), (end - origin) // _QUARTER, limit)
+    booked = (await db.execute(
+        select(models.Appointment.reader_id, models.Appointment.start_time, models.Appointment.end_time)
+        .where(
+            models.Appointment.reader_id.in_(reader_ids),
+            models.Appointment.status.in_(ACTIVE_APPOINTMENT_STATUSES),
+            models.Appointment.during.op('&&')(func.tsrange(origin, until)),
+        )
+    )).all()
+    for reader_id, start, end in booked:
+        free[reader_id] &= ~_span_bits((start - origin) // _QUARTER, -((origin - end) // _QUARTER), limit)
+    return {
+        reader_id: [(free[reader_id] >> (d * QUARTERS_PER_DAY)) & DAY_MASK for d in range(days)]
+        for reader_id in reader_ids
+    }
+
+
+async def load_masks(db: AsyncSession, r: AsyncRedis, reader_ids: List[int], first_day: date, days: int) -> Dict[int, List[int]]:
+    """Free-quarter masks for each reader and day, from cache where possible."""
+    pairs = [(reader_id, d) for reader_id in reader_ids for d in range(days)]
+    cached = await r.mget([mask_key(reader_id, first_day + timedelta(days=d)) for reader_id, d in pairs])
+    masks = {reader_id: [0] * days for reader_id in reader_ids}
+    missing = set()
+    for (reader_id, d), raw in zip(pairs, cached):
+        if raw is None:
+            missing.add(reader_id)
+        else:
+            masks[reader_id][d] = int(raw, 16)
+    if missing:
+        computed = await _compute_masks(db, missing, first_day, days)
+        pipe = r.pipeline(transaction=False)
+        for reader_id, day_masks in computed.items():
+            masks[reader_id] = day_masks
+            for d, mask in enumerate(day_masks):
+                pipe.set(mask_key(reader_id, first_day + timedelta(days=d)), format(mask, 'x'), ex=MASK_TTL_SECONDS)
+        await pipe.execute()
+    return masks
+
+
+def slot_starts(day_masks: List[int], first_day: date, length: int, not_before: datetime | None = None) -> List[datetime]:
+    """Start times of every free slot of `length` minutes across consecutive days."""
+    free = 0
+    for d, mask in enumerate(day_masks):
+        free |= mask << (d * QUARTERS_PER_DAY)
+    starts = free
+    for shift in range(1, length // SLOT_MINUTES):
+        starts &= free >> shift
+    origin = datetime.combine(first_day, time())
+    if not_before is not None and not_before > origin:
+        starts &= ~((1 << -((origin - not_before) // _QUARTER)) - 1)
+    out = []
+    while starts:
+        low = starts & -starts
+        out.append(origin + (low.bit_length() - 1) * _QUARTER)
+        starts ^= low
+    return out
+
+
+async def reader_slots(db: AsyncSession, r: AsyncRedis, reader_ids: List[int], first_day: date, days: int, lengths: Iterable[int] = SLOT_LENGTHS, not_before: datetime | None = None) -> Dict[int, Dict[int, List[datetime]]]:
+    masks = await load_masks(db, r, reader_ids, first_day, days)
+    return {
+        reader_id: {length: slot_starts(day_masks, first_day, length, not_before) for length in lengths}
+        for reader_id, day_masks in masks.items()
+    }
+
+
+async def is_bookable(db: AsyncSession, r: AsyncRedis, reader_id: int, start: datetime, length: int) -> bool:
+    """Whether [start, start + length) is free for the reader. `start` must be slot-aligned."""
+    first_day = start.date()
+    days = ((start + timedelta(minutes=length)) - datetime.combine(first_day, time())) // timedelta(days=1) + 1
+    masks = await load_masks(db, r, [reader_id], first_day, days)
+    return start in slot_starts(masks[reader_id], first_day, length)
+
+
+def parse_utc(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp into the naive UTC datetimes stored in the database.
+    Offsets (including a trailing `Z`, as sent by `Date.toISOString()`) are converted to UTC."""
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def is_slot_aligned(start: datetime) -> bool:
+    return start.second == 0 and start.microsecond == 0 and start.minute % SLOT_MINUTES == 0
+
+
+async def invalidate_slots(r: AsyncRedis, reader_id: int, start: datetime, end: datetime):
+    day, last = start.date(), end.date()
+    keys = []
+    while day <= last:
+        keys.append(mask_key(reader_id, day))
+        day += timedelta(days=1)
+    await r.delete(*keys)
@@ -0,0 +1,66 @@
+"""Running platform counters for the admin dashboard.
+
+Write paths call `bump` inside their own transaction, so a counter moves exactly when the
+row it counts commits. Each metric is spread over STAT_SLOTS rows picked at random so
+concurrent writers rarely wait on the same row lock; reads sum the slots.
+"""
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, timedelta
+from collections import defaultdict
+import random
+from .. import models
+
+STAT_SLOTS = 8
+METRICS = ("users", "readers", "sessions", "appointments", "orders", "revenue_transactions", "revenue_cents")
+
+
+async def bump(db: AsyncSession, **deltas: int):
+    """Add to today's and all-time counters, e.g. bump(db, orders=1)."""
+    # Sorted so concurrent transactions lock counter rows in the same order
+    deltas = {metric: delta for metric, delta in sorted(deltas.items()) if delta}
+    if not deltas:
+        return
+    slot = random.randrange(STAT_SLOTS)
+    day = datetime.utcnow().date()
+    daily = pg_insert(models.DailyStat).values([
+        {"day": day, "metric": metric, "slot": slot, "value": delta} for metric, delta in deltas.items()
+    ])
+    await db.execute(daily.on_conflict_do_update(
+        index_elements=[models.DailyStat.day, models.DailyStat.metric, models.DailyStat.slot],
+        set_={"value": models.DailyStat.value + daily.excluded.value},
+    ))
+    totals = pg_insert(models.StatTotal).values([
+        {"metric": metric, "slot": slot, "value": delta} for metric, delta in deltas.items()
+    ])
+    await db.execute(totals.on_conflict_do_update(
+        index_elements=[models.StatTotal.metric, models.StatTotal.slot],
+        set_={"value": models.StatTotal.value + totals.excluded.value},
+    ))
+
+
+async def get_totals(db: AsyncSession) -> dict:
+    rows = (await db.execute(
+        select(models.StatTotal.metric, func.sum(models.StatTotal.value)).group_by(models.StatTotal.metric)
+    )).all()
+    totals = dict.fromkeys(METRICS, 0)
+    totals.update({metric: int(value) for metric, value in rows})
+    return totals
+
+
+async def get_daily(db: AsyncSession, days: int) -> list:
+    """Per-day counters for the last `days` days, oldest first; days without activity are zero."""
+    first = datetime.utcnow().date() - timedelta(days=days - 1)
+    rows = (await db.execute(
+        select(models.DailyStat.day, models.DailyStat.metric, func.sum(models.DailyStat.value))
+        .where(models.DailyStat.day >= first)
+        .group_by(models.DailyStat.day, models.DailyStat.metric)
+    )).all()
+    by_day = defaultdict(dict)
+    for day, metric, value in rows:
+        by_day[day][metric] = int(value)
+    return [
+        {"day": day.isoformat(), **dict.fromkeys(METRICS, 0), **by_day.get(day, {})}
+        for day in (first + timedelta(days=i) for i in range(days))
+    ]
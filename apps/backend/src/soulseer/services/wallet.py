@@ -1,27 +1,56 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import HTTPException
+from datetime import datetime
 from .. import models
+from ..config import settings
+from ..db import on_rollback
+from ..redis_client import get_async_redis
+from .metering import release_funds, reserve_funds
 
-def get_or_create_wallet(db: Session, user_id: int) -> models.Wallet:
-    wallet = db.query(models.Wallet).filter(models.Wallet.user_id == user_id).one_or_none()
-    if not wallet:
-        wallet = models.Wallet(user_id=user_id, balance_cents=0)
-        db.add(wallet)
-        db.flush()
-    return wallet
+# Balance changes are single conditional statements so concurrent requests can't both
+# pass a balance check; the ledger row is added to the session and goes out with the
+# rest of the transaction's inserts at flush time.
 
-def credit(db: Session, user_id: int, amount_cents: int, ref_type: str, ref_id: str):
+async def credit(db: AsyncSession, user_id: int, amount_cents: int, ref_type: str, ref_id: str) -> int:
+    """Add to the user's wallet, creating it on first use. Returns the new balance."""
     if amount_cents <= 0:
         raise HTTPException(400, "amount must be positive")
-    wallet = get_or_create_wallet(db, user_id)
-    wallet.balance_cents += amount_cents
-    db.add(models.LedgerEntry(user_id=user_id, kind="credit", amount_cents=amount_cents, ref_type=ref_type, ref_id=ref_id))
+    now = datetime.utcnow()
+    stmt = pg_insert(models.Wallet).values(user_id=user_id, balance_cents=amount_cents, updated_at=now)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.Wallet.user_id],
+        set_={"balance_cents": models.Wallet.balance_cents + stmt.excluded.balance_cents, "updated_at": stmt.excluded.updated_at},
+    ).returning(models.Wallet.balance_cents)
+    balance = (await db.execute(stmt)).scalar_one()
+    db.add(models.LedgerEntry(user_id=user_id, kind="credit", amount_cents=amount_cents, ref_type=ref_type, ref_id=ref_id, created_at=now))
+    return balance
 
-def debit(db: Session, user_id: int, amount_cents: int, ref_type: str, ref_id: str):
+async def debit(db: AsyncSession, user_id: int, amount_cents: int, ref_type: str, ref_id: str) -> int:
+    """Take from the user's wallet if it covers the amount. Returns the new balance; 402 otherwise."""
     if amount_cents <= 0:
         raise HTTPException(400, "amount must be positive")
-    wallet = get_or_create_wallet(db, user_id)
-    if wallet.balance_cents < amount_cents:
+    reserved = None
+    if settings.billing_mode == 'metered':
+        # While a session is metered the spendable balance lives in Redis
+        r = await get_async_redis()
+        reserved = await reserve_funds(r, user_id, amount_cents)
+        if reserved is False:
+            raise HTTPException(402, "Insufficient balance")
+    now = datetime.utcnow()
+    balance = (await db.execute(
+        update(models.Wallet)
+        .where(models.Wallet.user_id == user_id, models.Wallet.balance_cents >= amount_cents)
+        .values(balance_cents=models.Wallet.balance_cents - amount_cents, updated_at=now)
+        .returning(models.Wallet.balance_cents)
+        .execution_options(synchronize_session=False)
+    )).scalar_one_or_none()
+    if balance is None:
+        if reserved:
+            await release_funds(r, user_id, amount_cents)
         raise HTTPException(402, "Insufficient balance")
-    wallet.balance_cents -= amount_cents
-    db.add(models.LedgerEntry(user_id=user_id, kind="debit", amount_cents=amount_cents, ref_type=ref_type, ref_id=ref_id))
\ No newline at end of file
+    if reserved:
+        on_rollback(db, lambda: release_funds(r, user_id, amount_cents))
+    db.add(models.LedgerEntry(user_id=user_id, kind="debit", amount_cents=amount_cents, ref_type=ref_type, ref_id=ref_id, created_at=now))
+    return balance
@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from soulseer.services.billing import MAX_BACKFILL_MINUTES, elapsed_minutes  # noqa: E402
+
+
+def test_next_minute_bills_one():
+    assert elapsed_minutes(last_minute=100, last_fence=7, minute=101, fence=8) == 1
+
+
+def test_late_retry_after_next_minute_is_covered():
+    # Minute 101's run never committed; 102 is claimed first and bills both minutes
+    assert elapsed_minutes(last_minute=100, last_fence=7, minute=102, fence=9) == 2
+    # The retry of 101 arrives afterwards and must not bill it a second time
+    assert elapsed_minutes(last_minute=102, last_fence=9, minute=101, fence=10) == 0
+
+
+def test_same_minute_is_not_billed_twice():
+    assert elapsed_minutes(last_minute=101, last_fence=8, minute=101, fence=9) == 0
+
+
+def test_stale_lease_holder_is_rejected():
+    assert elapsed_minutes(last_minute=100, last_fence=9, minute=101, fence=8) == 0
+
+
+def test_backfill_is_capped():
+    assert elapsed_minutes(last_minute=100, last_fence=1, minute=100 + 10 * MAX_BACKFILL_MINUTES, fence=2) == MAX_BACKFILL_MINUTES
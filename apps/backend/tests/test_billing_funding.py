@@ -0,0 +1,22 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from soulseer.services.billing import fund_sessions  # noqa: E402
+
+
+def test_balance_covering_everything_funds_every_session():
+    assert fund_sessions({1: 100}, [("a", 1, 40), ("b", 1, 60)]) == {"a", "b"}
+
+
+def test_only_sessions_the_balance_cannot_cover_are_left_out():
+    # 70 pays for "a" (40); "b" (60) no longer fits, "c" (30) still does
+    assert fund_sessions({1: 70}, [("c", 1, 30), ("b", 1, 60), ("a", 1, 40)]) == {"a", "c"}
+
+
+def test_clients_are_funded_independently():
+    assert fund_sessions({1: 10, 2: 50}, [("a", 1, 20), ("b", 2, 20)]) == {"b"}
+
+
+def test_missing_wallet_funds_nothing():
+    assert fund_sessions({}, [("a", 3, 1)]) == set()
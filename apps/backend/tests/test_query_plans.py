@@ -0,0 +1,115 @@
+"""Hot-path queries must use indexes instead of sequential scans.
+
+Seeds representative volumes into the database at DATABASE_URL inside a transaction,
+runs EXPLAIN on the queries the routers and workers issue, and fails if any plan scans a
+seeded table sequentially. Everything is rolled back at the end. Skipped unless
+DATABASE_URL points at a migrated Postgres:
+
+    DATABASE_URL=postgresql://localhost/soulseer_dev pytest tests/test_query_plans.py
+"""
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+if not os.environ.get("DATABASE_URL"):
+    pytest.skip("DATABASE_URL is not set", allow_module_level=True)
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from sqlalchemy import func, select, text  # noqa: E402
+from soulseer import models  # noqa: E402
+from soulseer.db import engine  # noqa: E402
+
+USERS = 20_000
+SEED = [
+    # 2% of sessions active, a few streams
+    """INSERT INTO sessions (session_uid, reader_id, client_id, mode, status, total_seconds, amount_charged_cents, per_minute)
+       SELECT 'plan-' || g, :base + g % 500, :base + g % :users,
+              (ARRAY['chat','voice','video','stream'])[1 + g % 4],
+              CASE WHEN g % 50 = 0 THEN 'active' WHEN g % 7 = 0 THEN 'requested' ELSE 'ended' END,
+              0, 0, g % 10 <> 0
+       FROM generate_series(1, 300000) g""",
+    """INSERT INTO appointments (booking_uid, reader_id, client_id, length_minutes, mode, price_cents, start_time, end_time, status)
+       SELECT 'plan-' || g, :base + g % 500, :base + g % :users, 30, 'chat', 6000,
+              timestamp '2024-01-01' + g * interval '1 hour', timestamp '2024-01-01' + g * interval '1 hour' + interval '30 minutes',
+              CASE WHEN g % 10 = 0 THEN 'scheduled' ELSE 'completed' END
+       FROM generate_series(1, 200000) g""",
+    """INSERT INTO availability_blocks (reader_id, start_time, end_time, timezone)
+       SELECT :base + g % 500, timestamp '2024-01-01' + g * interval '1 hour', timestamp '2024-01-01' + g * interval '1 hour' + interval '4 hours', 'UTC'
+       FROM generate_series(1, 100000) g""",
+    """INSERT INTO notifications (user_id, title, body, type, read, created_at)
+       SELECT :base + g % :users, 't', 'b', 'session_request', g % 3 = 0, timestamp '2024-01-01' + g * interval '1 minute'
+       FROM generate_series(1, 300000) g""",
+    """INSERT INTO ledger_entries (user_id, kind, amount_cents, ref_type, ref_id, created_at)
+       SELECT :base + g % :users, 'debit', 100, 'session', 'plan', timestamp '2024-01-01' + g * interval '1 minute'
+       FROM generate_series(1, 300000) g""",
+    """INSERT INTO reader_ledger_entries (reader_id, kind, amount_cents, ref_type, ref_id, created_at)
+       SELECT :base + g % 500, 'credit', 70, 'session', 'plan', timestamp '2024-01-01' + g * interval '1 minute'
+       FROM generate_series(1, 300000) g""",
+    """INSERT INTO wallets (user_id, balance_cents, updated_at)
+       SELECT id, 1000, now() FROM users ON CONFLICT (user_id) DO NOTHING""",
+    """INSERT INTO orders (order_uid, buyer_id, total_cents, status)
+       SELECT 'plan-' || g, :base + g % :users, 1000, 'paid' FROM generate_series(1, 100000) g""",
+]
+SEEDED_TABLES = ['sessions', 'appointments', 'availability_blocks', 'notifications', 'ledger_entries', 'reader_ledger_entries', 'wallets', 'orders', 'users']
+
+
+def queries(uid: int):
+    now = datetime(2030, 1, 1)
+    A, S = models.Appointment, models.Session
+    return {
+        "billing: active per-minute sessions": select(S.id).where(S.status == 'active', S.per_minute == True),
+        "sessions: reader incoming": select(S).where(S.reader_id == uid, S.status == 'requested'),
+        "streams: live listing": select(S).where(S.mode == 'stream', S.status == 'active'),
+        "appointments: reader upcoming": select(A).where(A.reader_id == uid, A.status.in_(['scheduled', 'in_progress'])).order_by(A.start_time),
+        "appointments: client upcoming": select(A).where(A.client_id == uid, A.status.in_(['scheduled', 'in_progress'])).order_by(A.start_time),
+        "appointments: reminder window": select(A).where(A.status == 'scheduled', A.start_time >= now, A.start_time <= now + timedelta(minutes=2)),
+        "appointments: slot overlap": select(A.start_time, A.end_time).where(A.reader_id.in_([uid, uid + 1]), A.status.in_(['scheduled', 'in_progress']), A.during.op('&&')(func.tsrange(now, now + timedelta(days=7)))),
+        "availability: reader range": select(models.AvailabilityBlock).where(models.AvailabilityBlock.reader_id == uid, models.AvailabilityBlock.start_time < now, models.AvailabilityBlock.end_time > now - timedelta(days=7)),
+        "notifications: latest for user": select(models.Notification).where(models.Notification.user_id == uid).order_by(models.Notification.created_at.desc()).limit(50),
+        "ledger: latest for user": select(models.LedgerEntry).where(models.LedgerEntry.user_id == uid).order_by(models.LedgerEntry.created_at.desc()).limit(50),
+        "reader ledger: latest for reader": select(models.ReaderLedgerEntry).where(models.ReaderLedgerEntry.reader_id == uid).order_by(models.ReaderLedgerEntry.created_at.desc()).limit(50),
+        "wallet: by user": select(models.Wallet.balance_cents).where(models.Wallet.user_id == uid),
+        "orders: latest for buyer": select(models.Order).where(models.Order.buyer_id == uid).order_by(models.Order.id.desc()).limit(50),
+    }
+
+
+def seq_scans(plan: dict) -> list[str]:
+    found = []
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in SEEDED_TABLES:
+        found.append(plan["Relation Name"])
+    for child in plan.get("Plans", []):
+        found += seq_scans(child)
+    return found
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    with engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            conn.execute(text(
+                "INSERT INTO users (clerk_user_id, email, role, display_name, created_at, updated_at) "
+                "SELECT 'plan-' || g, 'plan' || g || '@example.com', CASE WHEN g <= 500 THEN 'reader' ELSE 'client' END, '', now(), now() "
+                "FROM generate_series(1, :users) g"
+            ), {"users": USERS})
+            # Seeded rows reference users by offset from the first seeded id; the first 500 are readers
+            base = conn.scalar(text("SELECT min(id) FROM users WHERE clerk_user_id LIKE 'plan-%'"))
+            for sql in SEED:
+                conn.execute(text(sql), {"users": USERS, "base": base})
+            for table in SEEDED_TABLES:
+                conn.execute(text(f"ANALYZE {table}"))
+            yield conn, base + 41
+        finally:
+            trans.rollback()
+
+
+@pytest.mark.parametrize("name", list(queries(0)))
+def test_query_uses_indexes(seeded, name):
+    conn, uid = seeded
+    sql = str(queries(uid)[name].compile(engine, compile_kwargs={"literal_binds": True}))
+    plan = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+    plan = plan if isinstance(plan, list) else json.loads(plan)
+    assert seq_scans(plan[0]["Plan"]) == [], f"{name}: sequential scan"
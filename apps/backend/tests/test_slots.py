@@ -0,0 +1,25 @@
+import os
+import sys
+from datetime import date, datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from soulseer.services.slots import DAY_MASK, is_slot_aligned, parse_utc, slot_starts  # noqa: E402
+
+
+def test_booking_with_z_suffixed_start_matches_a_slot():
+    # What the booking page sends: new Date(start_local).toISOString()
+    start = parse_utc("2026-03-02T14:30:00.000Z")
+    assert start == datetime(2026, 3, 2, 14, 30)
+    assert start.tzinfo is None
+    assert is_slot_aligned(start)
+    # Fully free day: the parsed start can be compared with the naive slot starts
+    assert start in slot_starts([DAY_MASK], date(2026, 3, 2), 30)
+
+
+def test_offsets_are_converted_to_utc():
+    assert parse_utc("2026-03-02T16:30:00+02:00") == datetime(2026, 3, 2, 14, 30)
+
+
+def test_naive_and_date_only_values_are_kept_as_utc():
+    assert parse_utc("2026-03-02T14:30:00") == datetime(2026, 3, 2, 14, 30)
+    assert parse_utc("2026-03-02").date() == date(2026, 3, 2)
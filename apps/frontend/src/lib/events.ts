@@ -0,0 +1,49 @@
+import { env } from './env';
+import { getAuthToken } from './auth';
+
+export interface UserEvent {
+  id: string;
+  type: string;
+  data: any;
+}
+
+// Connects to the backend's per-user event socket and reconnects with backoff,
+// resuming from the last event id so nothing published meanwhile is missed.
+export function connectEvents(onEvent: (event: UserEvent) => void): () => void {
+  let ws: WebSocket | null = null;
+  let lastId = '';
+  let retryMs = 1000;
+  let stopped = false;
+  let timer: any = null;
+  const seen = new Set<string>();
+
+  async function open() {
+    const token = await getAuthToken();
+    if (stopped) return;
+    const params = new URLSearchParams({ token: token || '' });
+    if (lastId) params.set('last_event_id', lastId);
+    ws = new WebSocket(env.backendBase.replace('http', 'ws') + `/events/ws?${params}`);
+    ws.onopen = () => { retryMs = 1000; };
+    ws.onmessage = (ev) => {
+      const event: UserEvent = JSON.parse(ev.data);
+      // Replay and live delivery can overlap around a reconnect
+      if (seen.has(event.id) && event.type !== 'resync') return;
+      seen.add(event.id);
+      if (seen.size > 1000) seen.delete(seen.values().next().value as string);
+      lastId = event.id;
+      onEvent(event);
+    };
+    ws.onclose = () => {
+      if (stopped) return;
+      timer = setTimeout(open, retryMs);
+      retryMs = Math.min(retryMs * 2, 30000);
+    };
+  }
+
+  open();
+  return () => {
+    stopped = true;
+    clearTimeout(timer);
+    ws?.close();
+  };
+}